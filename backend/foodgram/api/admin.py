@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from recipes.models import Ingredients, RecipeIngredients, Recipes, Tags
+from api.matching import schedule_matcher_update
+from recipes.models import Ingredients, Job, RecipeIngredients, Recipes, Tags
 from users.models import CustomUser
 
 
@@ -10,21 +11,30 @@ class RecipeIngredientInline(admin.TabularInline):
 
 
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'name', 'author')
+    list_display = ('pk', 'name', 'author', 'favorites_count')
     list_display_links = ('name',)
     readonly_fields = ('total_favorited',)
     list_filter = ('author', 'name', 'tags')
     empty_value_display = '-пусто-'
     inlines = (RecipeIngredientInline,)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        schedule_matcher_update(
+            form.instance.pk,
+            form.instance.recipeingredients_set.values_list(
+                'ingredient_id', flat=True),
+        )
+
     @admin.display(description='В избранном')
     def total_favorited(self, obj):
         return ('Общее количество добавлений в избранное '
-                f'{obj.favorited.count()}')
+                f'{obj.favorites_count}')
 
 
 class UserAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'username', 'first_name', 'last_name', 'email')
+    list_display = ('pk', 'username', 'first_name', 'last_name', 'email',
+                    'recipes_count', 'followers_count')
     list_filter = ('first_name', 'email')
     empty_value_display = '-пусто-'
 
@@ -35,7 +45,16 @@ class IngredientAdmin(admin.ModelAdmin):
     empty_value_display = '-пусто-'
 
 
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'name', 'status', 'attempts', 'user', 'run_at',
+                    'finished')
+    list_filter = ('status', 'name')
+    readonly_fields = ('started', 'finished', 'result', 'error')
+    empty_value_display = '-пусто-'
+
+
 admin.site.register(Recipes, RecipeAdmin)
 admin.site.register(Tags)
 admin.site.register(Ingredients, IngredientAdmin)
 admin.site.register(CustomUser, UserAdmin)
+admin.site.register(Job, JobAdmin)
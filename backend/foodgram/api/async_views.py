@@ -0,0 +1,144 @@
+"""Async views of hot read endpoints, served in the ASGI deployment."""
+import asyncio
+from functools import partial
+
+from django.http import HttpResponse
+from django.urls import URLPattern
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+
+from .concurrency import in_thread
+from .reference import ingredients_reference, list_response, tags_reference
+from .response_cache import recipe_detail_cache, recipe_list_cache
+from .shopping import FILENAME, FORMATS, cart_rows
+from .user_state import get_user_state
+
+
+def authenticate(view, request):
+    """
+    Authenticate the request as the DRF view would, None on bad credentials.
+
+    The view falls back on the found user without authenticating again.
+    """
+    drf_request = Request(request, authenticators=[
+        authenticator() for authenticator in view.cls.authentication_classes])
+    try:
+        user, auth = drf_request.user, drf_request.auth
+    except APIException:
+        return None
+    if user.is_authenticated:
+        request._force_auth_user, request._force_auth_token = user, auth
+    request.auth = auth
+    return user
+
+
+def authenticate_with_state(view, request):
+    user = authenticate(view, request)
+    if user is not None:
+        # kept on the request, the DRF view reuses it on a cache miss
+        get_user_state(request)
+    return user
+
+
+def render(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    # otherwise Django renders it in its single thread for sync code
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+async def reference_list(reference, view, request):
+    if request.GET:
+        return None
+    return await in_thread(list_response)(request, reference)
+
+
+async def cached_read(cache, view, request):
+    """
+    Serve recipes from the response cache.
+
+    The user, with their state, and the cached body are looked up at the
+    same time. Misses and requests the cache doesn't take go to the view.
+    """
+    if (not cache.cacheable(request, view.cls.cached_query_params)
+            or 'text/html' in request.headers.get('Accept', '')):
+        return None
+    user, entry = await asyncio.gather(
+        in_thread(authenticate_with_state)(view, request),
+        in_thread(cache.lookup)(request, view.cls.cached_query_params),
+    )
+    if user is None or entry is None:
+        return None
+    return cache.serve(request, entry)
+
+
+def cart(view, request):
+    user = authenticate(view, request)
+    if user is None or not user.is_authenticated:
+        return None
+    return list(cart_rows(user.pk))
+
+
+async def shopping_list(view, request):
+    """
+    Render the shopping list at once instead of streaming it.
+
+    It has a row per ingredient, so it's small, and a streaming body would
+    be produced in a thread of its own, see foodgram.asgi.
+    """
+    file_format = request.GET.get(view.cls.format_query_param, 'txt')
+    if file_format not in FORMATS:
+        return None
+    rows = await in_thread(cart)(view, request)
+    if rows is None:
+        return None
+    content_type, writer = FORMATS[file_format]
+    response = HttpResponse(''.join(writer(rows)), content_type=content_type)
+    response['Content-Disposition'] = (
+        f'attachment; filename={FILENAME}.{file_format}')
+    return response
+
+
+# URL name -> coroutine trying to answer GET requests without the DRF view
+FAST_PATHS = {
+    'tags-list': partial(reference_list, tags_reference),
+    'tags-detail': None,
+    'ingredients-list': partial(reference_list, ingredients_reference),
+    'ingredients-detail': None,
+    'recipes-list': partial(cached_read, recipe_list_cache),
+    'recipes-detail': partial(cached_read, recipe_detail_cache),
+    'download_shopping_cart-list': shopping_list,
+}
+
+
+def async_view(view, fast_path=None):
+    """
+    Wrap a DRF view into an async one.
+
+    Requests the fast path doesn't answer run the DRF view in the
+    executor thread pool, so they don't queue up behind each other.
+    """
+    async def wrapper(request, *args, **kwargs):
+        response = None
+        if (fast_path is not None and request.method == 'GET'
+                and 'format' not in kwargs):
+            response = await fast_path(view, request)
+        if response is None:
+            response = await in_thread(render)(
+                view, request, *args, **kwargs)
+        return response
+
+    # csrf_exempt and the actions routing middleware reads
+    wrapper.__dict__.update(view.__dict__)
+    return wrapper
+
+
+def asyncify(urls):
+    """Replace views of hot read endpoints among router URLs."""
+    return [
+        URLPattern(url.pattern, async_view(url.callback, FAST_PATHS[url.name]),
+                   url.default_args, url.name)
+        if getattr(url, 'name', None) in FAST_PATHS else url
+        for url in urls
+    ]
@@ -0,0 +1,48 @@
+"""In-process prefix index for ingredient autocomplete."""
+from bisect import bisect_left
+
+from django.conf import settings
+
+from recipes.models import Ingredients
+
+from .local_index import LocalIndex
+
+
+class IngredientIndex(LocalIndex):
+    """
+    Sorted in-memory copy of the ingredients table.
+
+    Prefix matches are found with a binary search and ranked ahead of
+    substring matches. invalidate() is called on every Ingredients change.
+    """
+
+    def __init__(self, ttl):
+        super().__init__(ttl, empty=([], []))
+
+    def build(self):
+        rows = sorted(
+            Ingredients.objects.values('id', 'name', 'measurement_unit'),
+            key=lambda row: row['name'].lower(),
+        )
+        return [row['name'].lower() for row in rows], rows
+
+    def search(self, query, limit):
+        keys, rows = self.data
+        query = query.strip().lower()
+        result = []
+        position = bisect_left(keys, query)
+        while (position < len(keys) and len(result) < limit
+               and keys[position].startswith(query)):
+            result.append(rows[position])
+            position += 1
+        if len(result) < limit:
+            for key, row in zip(keys, rows):
+                if query in key and not key.startswith(query):
+                    result.append(row)
+                    if len(result) == limit:
+                        break
+        return result
+
+
+ingredient_index = IngredientIndex(
+    ttl=settings.INGREDIENT_AUTOCOMPLETE['TTL'])
@@ -0,0 +1,397 @@
+"""Synthetic dataset and API scenarios for the benchmark command."""
+import base64
+import io
+import json
+import math
+import random
+import statistics
+import time
+from typing import Callable, NamedTuple, Optional
+
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import (Ingredients, Job, RecipeIngredients, RecipeRank,
+                            Recipes, Tags, User)
+
+from .autocomplete import ingredient_index
+from .counters import recount
+from .matching import recipe_matcher
+from .ranking import rebuild
+from .reference import ingredients_reference, tags_reference
+
+PASSWORD = 'benchmark-password'
+WORDS = ('борщ', 'суп', 'салат', 'пирог', 'каша', 'соус', 'курица', 'рыба',
+         'овощи', 'сыр', 'грибы', 'тесто', 'картофель', 'капуста', 'рис')
+
+
+def make_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'orange').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+IMAGE_PNG = make_image()
+IMAGE = 'data:image/png;base64,' + base64.b64encode(IMAGE_PNG).decode()
+# storage name of seeded recipe images, uploaded before imports
+IMAGE_NAME = 'recipes/benchmark.png'
+IMPORTED_RECIPES = 5
+
+
+def user_factory(number, password):
+    return User(email=f'user{number}@example.com', username=f'user{number}',
+                first_name='Имя', last_name=f'Фамилия{number}',
+                password=password)
+
+
+def recipe_factory(number, author_id, rng):
+    words = rng.sample(WORDS, 3)
+    return Recipes(
+        author_id=author_id, name=f'{words[0].capitalize()} {number}',
+        text=' '.join(rng.choice(WORDS) for _ in range(40)),
+        image=IMAGE_NAME, cooking_time=rng.randint(5, 120),
+    )
+
+
+def seed(recipes, ingredients_per_recipe=8, follows=5, favorites=10,
+         seed_value=0):
+    """
+    Fill an empty database with users, tags, ingredients and recipes.
+
+    Rows are bulk inserted, so counters and rankings are recalculated
+    afterwards and in-process caches are dropped. Returns ids used to fill
+    scenario paths.
+    """
+    rng = random.Random(seed_value)
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        user_factory(number, password)
+        for number in range(max(recipes // 4, 4)))
+    user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+    Tags.objects.bulk_create(
+        Tags(name=f'Тег {number}', slug=f'tag{number}', color='#E26C2D')
+        for number in range(6))
+    tag_ids = list(Tags.objects.values_list('id', flat=True))
+    Ingredients.objects.bulk_create(
+        Ingredients(name=f'{rng.choice(WORDS)} {number}',
+                    measurement_unit='г')
+        for number in range(max(recipes * 2, ingredients_per_recipe * 4)))
+    ingredient_ids = list(Ingredients.objects.values_list('id', flat=True))
+    Recipes.objects.bulk_create(
+        recipe_factory(number, user_ids[number % len(user_ids)], rng)
+        for number in range(recipes))
+    recipe_ids = list(Recipes.objects.values_list('id', flat=True))
+
+    Recipes.tags.through.objects.bulk_create(
+        Recipes.tags.through(recipes_id=recipe_id, tags_id=tag_id)
+        for recipe_id in recipe_ids for tag_id in rng.sample(tag_ids, 2))
+    RecipeIngredients.objects.bulk_create(
+        RecipeIngredients(recipe_id=recipe_id, ingredient_id=ingredient_id,
+                          amount=rng.randint(1, 500))
+        for recipe_id in recipe_ids
+        for ingredient_id in rng.sample(ingredient_ids,
+                                        ingredients_per_recipe))
+    # the last user is left for the benchmark user (the first one) to
+    # subscribe to
+    User.subscribed.through.objects.bulk_create(
+        User.subscribed.through(from_customuser_id=author_id,
+                                to_customuser_id=user_id)
+        for user_id in user_ids
+        for author_id in rng.sample(user_ids[:-1],
+                                    min(follows, len(user_ids) - 1))
+        if author_id != user_id)
+    for through in (Recipes.favorited.through,
+                    Recipes.shopping_cart.through):
+        through.objects.bulk_create(
+            through(recipes_id=recipe_id, customuser_id=user_id)
+            for user_id in user_ids
+            for recipe_id in rng.sample(recipe_ids,
+                                        min(favorites, len(recipe_ids))))
+
+    # finished shopping list jobs of every user and a staff user for
+    # endpoints only staff can read
+    Job.objects.bulk_create(
+        Job(name='shopping_list', user_id=user_id, status=Job.DONE,
+            attempts=1, payload={'user_id': user_id, 'file_format': 'txt'},
+            result={'file': f'shopping_lists/{user_id}/shopping_list.txt'})
+        for user_id in user_ids for _ in range(max(recipes // 20, 3)))
+    staff = user_factory('staff', password)
+    staff.is_staff = True
+    staff.save()
+
+    recount()
+    for window, _ in RecipeRank.WINDOWS:
+        rebuild(window)
+    for cache in (tags_reference, ingredients_reference, ingredient_index,
+                  recipe_matcher):
+        cache.invalidate()
+    caches['default'].clear()
+
+    user_id = user_ids[0]
+    own = set(Recipes.objects.filter(author_id=user_id).values_list(
+        'id', flat=True))
+    taken = own | set(Recipes.objects.filter(
+        favorited=user_id).values_list('id', flat=True)) | set(
+        Recipes.objects.filter(shopping_cart=user_id).values_list(
+            'id', flat=True))
+    recipe_id = next(pk for pk in recipe_ids if pk not in taken)
+    return {
+        'user': user_id,
+        'staff': staff.pk,
+        'author': user_ids[-1],
+        'recipe': recipe_id,
+        'own_recipe': min(own),
+        'tag': Tags.objects.get(pk=tag_ids[0]).slug,
+        'tag_id': tag_ids[0],
+        'ingredient': ingredient_ids[0],
+        'ingredients': ','.join(map(str, RecipeIngredients.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient_id', flat=True))),
+        'ingredient_ids': ingredient_ids[:3],
+        'job': Job.objects.filter(user_id=user_id).latest('id').pk,
+    }
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    path: str
+    data: Optional[Callable] = None
+    status: int = 200
+    client: str = 'user'
+    # unmeasured calls preparing and reverting state around each run
+    setup: Optional[Callable] = None
+    undo: Optional[Callable] = None
+    # data is sent as it is with this content type instead of as JSON
+    content_type: Optional[str] = None
+
+    def send(self, clients, ids, data):
+        body = ({'content_type': self.content_type} if self.content_type
+                else {'format': 'json'})
+        return getattr(clients[self.client], self.method)(
+            self.path.format(**ids), data, **body)
+
+
+def recipe_data(ids, name='Benchmark recipe'):
+    return {
+        'name': name, 'text': 'Текст рецепта', 'cooking_time': 10,
+        'image': IMAGE, 'tags': [ids['tag_id']],
+        'ingredients': [{'id': pk, 'amount': 10}
+                        for pk in ids['ingredient_ids']],
+    }
+
+
+def create_recipe(clients, ids):
+    ids['created'] = clients['user'].post(
+        '/api/recipes/', recipe_data(ids, 'Temporary'), format='json'
+    ).json()['id']
+
+
+def login(clients, ids):
+    # the token of the previous run is gone after logging out
+    clients['other'].credentials()
+    response = clients['other'].post('/api/auth/token/login/', {
+        'email': 'user1@example.com', 'password': PASSWORD}, format='json')
+    clients['other'].credentials(
+        HTTP_AUTHORIZATION='Token ' + response.json()['auth_token'])
+
+
+def upload_image(clients, ids):
+    # imported recipes reference an already uploaded image
+    if not default_storage.exists(IMAGE_NAME):
+        default_storage.save(IMAGE_NAME, ContentFile(IMAGE_PNG))
+
+
+def import_data(ids):
+    names = dict(Ingredients.objects.filter(
+        pk__in=ids['ingredient_ids']).values_list('pk', 'name'))
+    return ''.join(
+        json.dumps({
+            'name': f'Imported recipe {number}', 'text': 'Текст рецепта',
+            'cooking_time': 10, 'image': IMAGE_NAME, 'tags': [ids['tag']],
+            'ingredients': [{'name': name, 'amount': 10}
+                            for name in names.values()],
+        }, ensure_ascii=False) + '\n'
+        for number in range(IMPORTED_RECIPES))
+
+
+def delete_imported(clients, ids, response):
+    Recipes.objects.filter(author_id=ids['user'],
+                           name__startswith='Imported recipe').delete()
+
+
+def delete_job(clients, ids, response):
+    Job.objects.filter(pk=response.json()['id']).delete()
+
+
+def call(method, path):
+    """Build setup/undo step making a plain request."""
+    def step(clients, ids, response=None):
+        getattr(clients['user'], method)(path.format(**ids), format='json')
+    return step
+
+
+SCENARIOS = (
+    Scenario('tags list', 'get', '/api/tags/', client='anonymous'),
+    Scenario('tag detail', 'get', '/api/tags/{tag_id}/', client='anonymous'),
+    Scenario('ingredients list', 'get', '/api/ingredients/',
+             client='anonymous'),
+    Scenario('ingredients search', 'get', '/api/ingredients/?name=бор',
+             client='anonymous'),
+    Scenario('ingredient detail', 'get', '/api/ingredients/{ingredient}/',
+             client='anonymous'),
+    Scenario('recipes list anonymous', 'get', '/api/recipes/',
+             client='anonymous'),
+    Scenario('recipes list', 'get', '/api/recipes/'),
+    Scenario('recipes list page 3', 'get', '/api/recipes/?page=3&limit=6'),
+    Scenario('recipes cursor', 'get', '/api/recipes/?pagination=cursor'),
+    Scenario('recipes by tag', 'get', '/api/recipes/?tags={tag}'),
+    Scenario('recipes by author', 'get', '/api/recipes/?author={author}'),
+    Scenario('recipes favorited', 'get', '/api/recipes/?is_favorited=1'),
+    Scenario('recipes in cart', 'get',
+             '/api/recipes/?is_in_shopping_cart=1'),
+    Scenario('recipes search', 'get', '/api/recipes/?search=борщ'),
+    Scenario('recipes popular', 'get', '/api/recipes/?ordering=popular'),
+    Scenario('recipes trending', 'get', '/api/recipes/?ordering=trending'),
+    Scenario('recipes match', 'get',
+             '/api/recipes/match/?ingredients={ingredients}&missing=1'),
+    Scenario('recipes feed', 'get', '/api/recipes/feed/'),
+    Scenario('recipe detail', 'get', '/api/recipes/{recipe}/'),
+    Scenario('recipes export', 'get', '/api/recipes/export/'),
+    Scenario('recipes import', 'post', '/api/recipes/import/',
+             data=import_data, content_type='application/x-ndjson',
+             setup=upload_image, undo=delete_imported),
+    Scenario('recipe create', 'post', '/api/recipes/',
+             data=recipe_data, status=201,
+             undo=lambda clients, ids, response: Recipes.objects.filter(
+                 pk=response.json()['id']).delete()),
+    Scenario('recipe update', 'patch', '/api/recipes/{own_recipe}/',
+             data=lambda ids: recipe_data(ids, 'Updated recipe')),
+    Scenario('recipe delete', 'delete', '/api/recipes/{created}/',
+             status=204, setup=create_recipe),
+    Scenario('favorite add', 'post', '/api/recipes/{recipe}/favorite/',
+             status=201,
+             undo=call('delete', '/api/recipes/{recipe}/favorite/')),
+    Scenario('favorite remove', 'delete', '/api/recipes/{recipe}/favorite/',
+             status=204,
+             setup=call('post', '/api/recipes/{recipe}/favorite/')),
+    Scenario('cart add', 'post', '/api/recipes/{recipe}/shopping_cart/',
+             status=201,
+             undo=call('delete', '/api/recipes/{recipe}/shopping_cart/')),
+    Scenario('cart remove', 'delete',
+             '/api/recipes/{recipe}/shopping_cart/', status=204,
+             setup=call('post', '/api/recipes/{recipe}/shopping_cart/')),
+    Scenario('shopping list', 'get', '/api/recipes/download_shopping_cart/'),
+    Scenario('shopping list job', 'post',
+             '/api/recipes/download_shopping_cart/', status=202,
+             undo=delete_job),
+    Scenario('jobs list', 'get', '/api/jobs/'),
+    Scenario('job detail', 'get', '/api/jobs/{job}/'),
+    Scenario('metrics', 'get', '/api/metrics/', client='staff'),
+    Scenario('users list', 'get', '/api/users/'),
+    Scenario('user detail', 'get', '/api/users/{author}/'),
+    Scenario('user me', 'get', '/api/users/me/'),
+    Scenario('user create', 'post', '/api/users/', status=201,
+             client='anonymous',
+             data=lambda ids: {
+                 'email': 'new@example.com', 'username': 'new_user',
+                 'first_name': 'Имя', 'last_name': 'Фамилия',
+                 'password': PASSWORD},
+             undo=lambda clients, ids, response: User.objects.filter(
+                 email='new@example.com').delete()),
+    Scenario('set password', 'post', '/api/users/set_password/',
+             status=204,
+             data=lambda ids: {'current_password': PASSWORD,
+                               'new_password': PASSWORD}),
+    Scenario('subscriptions', 'get',
+             '/api/users/subscriptions/?recipes_limit=3'),
+    Scenario('subscribe', 'post', '/api/users/{author}/subscribe/',
+             status=201,
+             undo=call('delete', '/api/users/{author}/subscribe/')),
+    Scenario('unsubscribe', 'delete', '/api/users/{author}/subscribe/',
+             status=204,
+             setup=call('post', '/api/users/{author}/subscribe/')),
+    Scenario('batch toggles', 'post', '/api/users/me/toggles/',
+             data=lambda ids: {'favorite': {'add': [ids['recipe']]},
+                               'shopping_cart': {'add': [ids['recipe']]}},
+             undo=lambda clients, ids, response: clients['user'].post(
+                 '/api/users/me/toggles/', {
+                     'favorite': {'remove': [ids['recipe']]},
+                     'shopping_cart': {'remove': [ids['recipe']]},
+                 }, format='json')),
+    Scenario('token login', 'post', '/api/auth/token/login/',
+             client='anonymous',
+             data=lambda ids: {'email': 'user1@example.com',
+                               'password': PASSWORD}),
+    Scenario('token logout', 'post', '/api/auth/token/logout/',
+             status=204, client='other', setup=login),
+)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def run_scenario(scenario, clients, ids, repeat):
+    """
+    Run scenario repeat times after one warm-up run.
+
+    Returns queries of the warm-up run, the most queries of measured runs
+    and latency statistics in milliseconds.
+    """
+    counts, timings = [], []
+    for _ in range(repeat + 1):
+        if scenario.setup:
+            scenario.setup(clients, ids)
+        data = scenario.data(ids) if scenario.data else None
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = scenario.send(clients, ids, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            timings.append((time.perf_counter() - started) * 1000)
+        counts.append(len(captured))
+        if response.status_code != scenario.status:
+            raise AssertionError(
+                f'{scenario.name}: expected {scenario.status}, got '
+                f'{response.status_code} {getattr(response, "data", "")}')
+        if scenario.undo:
+            scenario.undo(clients, ids, response)
+    timings = timings[1:]
+    return {
+        'queries_cold': counts[0],
+        'queries': max(counts[1:]),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'mean_ms': round(statistics.mean(timings), 2),
+    }
+
+
+def make_clients(ids):
+    """API clients scenarios are run with, 'user' and 'staff' are logged in."""
+    clients = {'anonymous': APIClient(), 'other': APIClient()}
+    for name in ('user', 'staff'):
+        user = User.objects.get(pk=ids[name])
+        clients[name] = APIClient()
+        clients[name].credentials(
+            HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    return clients
+
+
+def run(ids, repeat, names=None):
+    """Run scenarios against a seeded database."""
+    clients = make_clients(ids)
+    return {
+        scenario.name: run_scenario(scenario, clients, ids, repeat)
+        for scenario in SCENARIOS
+        if not names or scenario.name in names
+    }
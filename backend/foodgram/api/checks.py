@@ -0,0 +1,35 @@
+"""System checks of settings the api app relies on."""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Warning, register
+
+
+def is_local(alias):
+    return isinstance(caches[alias], LocMemCache)
+
+
+@register()
+def check_shared_caches(app_configs, **kwargs):
+    """Caches invalidated from other processes must not be per process."""
+    errors = []
+    if (settings.RESPONSE_CACHE['ENABLED']
+            and is_local(settings.RESPONSE_CACHE['CACHE_ALIAS'])):
+        errors.append(Warning(
+            'RESPONSE_CACHE is enabled on a per-process LocMemCache.',
+            hint='Generation bumps made by other workers, commands and '
+                 'runworker never reach this process and stale responses '
+                 'are served until they expire. Set a shared CACHE_BACKEND '
+                 'or RESPONSE_CACHE_ENABLED=0.',
+            id='api.W001',
+        ))
+    if (settings.USER_STATE['CACHED']
+            and is_local(settings.USER_STATE['CACHE_ALIAS'])):
+        errors.append(Warning(
+            'USER_STATE is cached in a per-process LocMemCache.',
+            hint='Favorites, carts and subscriptions changed in another '
+                 'worker look unchanged here until the state expires. Set '
+                 'a shared CACHE_BACKEND or USER_STATE_CACHED=0.',
+            id='api.W002',
+        ))
+    return errors
@@ -0,0 +1,31 @@
+"""Running blocking code of async views under ASGI."""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from foodgram.db.middleware import check_connections, mark_connections_used
+
+from .profiling import profiled_connections
+
+
+def in_thread(func):
+    """
+    Make a blocking function awaitable, run in the executor thread pool.
+
+    Unlike Django's default for sync code under ASGI, calls of concurrent
+    requests don't wait for each other in one shared thread. Connections
+    of the executor thread are checked before the call and closed after
+    it by the same rules as around a WSGI request.
+    """
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        check_connections()
+        try:
+            with profiled_connections():
+                return func(*args, **kwargs)
+        finally:
+            mark_connections_used()
+            close_old_connections()
+
+    return sync_to_async(call, thread_sensitive=False)
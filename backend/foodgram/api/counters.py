@@ -0,0 +1,88 @@
+"""Denormalized counters of favorites, cart additions, followers, recipes."""
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from recipes.models import Recipes, User
+
+# m2m through model -> (model holding the counter, counter field,
+# accessor on the forward side, accessor on the reverse side)
+M2M_COUNTERS = {
+    Recipes.favorited.through: (
+        Recipes, 'favorites_count', 'favorited', 'favorites'),
+    Recipes.shopping_cart.through: (
+        Recipes, 'shopping_cart_count', 'shopping_cart', 'shopping'),
+    User.subscribed.through: (
+        User, 'followers_count', 'subscribed', 'customuser_set'),
+}
+
+# (model, counter field, counted model, its column referencing the model)
+RECOUNTS = (
+    (Recipes, 'favorites_count', Recipes.favorited.through, 'recipes_id'),
+    (Recipes, 'shopping_cart_count', Recipes.shopping_cart.through,
+     'recipes_id'),
+    (User, 'followers_count', User.subscribed.through, 'from_customuser_id'),
+    (User, 'recipes_count', Recipes, 'author_id'),
+)
+
+
+def increment(model, pks, field, delta):
+    """Shift counters of given rows atomically on the database side."""
+    if pks and delta:
+        # drifted counters mustn't break the request, recount repairs them
+        model.objects.filter(pk__in=pks).update(
+            **{field: Greatest(F(field) + delta, 0)})
+
+
+def m2m_counter_changed(sender, instance, action, reverse, pk_set,
+                        **kwargs):
+    """
+    Keep counters in sync with m2m_changed signals.
+
+    Django sends requested rather than removed ids on remove and no ids on
+    clear, so rows which really are about to go are collected beforehand.
+    Return ids of actually changed relations and the counter change.
+    """
+    model, field, forward, backward = M2M_COUNTERS[sender]
+    if action in ('pre_remove', 'pre_clear'):
+        related = getattr(instance, backward if reverse else forward)
+        if pk_set is not None:
+            related = related.filter(pk__in=pk_set)
+        instance.__dict__.setdefault('_removed_for_counters', {})[sender] = (
+            set(related.values_list('pk', flat=True)))
+        return None
+    if action == 'post_add':
+        delta = 1
+    elif action in ('post_remove', 'post_clear'):
+        delta = -1
+        pk_set = instance.__dict__.get(
+            '_removed_for_counters', {}).pop(sender, set())
+    else:
+        return None
+    if not pk_set:
+        return None
+    if reverse:
+        increment(model, pk_set, field, delta)
+    else:
+        increment(model, [instance.pk], field, delta * len(pk_set))
+    return pk_set, delta
+
+
+def actual_count(source, column):
+    return Coalesce(Subquery(
+        source.objects.filter(**{column: OuterRef('pk')})
+        .order_by().values(column).annotate(total=Count('*'))
+        .values('total')
+    ), 0)
+
+
+def recount():
+    """Recalculate every counter, return number of drifted rows for each."""
+    drifted = {}
+    for model, field, source, column in RECOUNTS:
+        actual = actual_count(source, column)
+        label = f'{model._meta.model_name}.{field}'
+        drifted[label] = model.objects.annotate(actual=actual).exclude(
+            **{field: F('actual')}).count()
+        if drifted[label]:
+            model.objects.update(**{field: actual})
+    return drifted
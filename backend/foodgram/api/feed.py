@@ -0,0 +1,150 @@
+"""Feed of recipes by followed authors, precomputed for heavy followers."""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+
+from recipes.models import FeedEntry, Recipes, User, UserFeed
+
+from .jobs import enqueue
+
+Follow = User.subscribed.through
+
+
+def followed_authors(user_id):
+    return Follow.objects.filter(to_customuser_id=user_id).values(
+        'from_customuser_id')
+
+
+def followed_recipes(user_id):
+    """
+    Recipes of followed authors newest first, merged on read.
+
+    A single query with the follows as a subquery, served by the
+    (author, pub_date, id) index.
+    """
+    return Recipes.objects.filter(
+        author_id__in=followed_authors(user_id)).order_by('-pub_date', '-id')
+
+
+def feed_entries(user_id):
+    """Precomputed feed of the user newest first, None if there's none."""
+    if not UserFeed.objects.filter(pk=user_id).exists():
+        return None
+    return FeedEntry.objects.filter(user_id=user_id).order_by(
+        '-pub_date', '-recipe_id')
+
+
+def make_entries(user_id, recipes):
+    return [
+        FeedEntry(user_id=user_id, recipe_id=recipe_id, author_id=author_id,
+                  pub_date=pub_date)
+        for recipe_id, author_id, pub_date in recipes
+    ]
+
+
+def latest(recipes):
+    return recipes.order_by('-pub_date', '-id').values_list(
+        'id', 'author_id', 'pub_date')[:settings.FEED['MAX_ENTRIES']]
+
+
+def build(user_id):
+    """Fill the user's feed with the latest recipes of followed authors."""
+    FeedEntry.objects.filter(user_id=user_id).delete()
+    FeedEntry.objects.bulk_create(
+        make_entries(user_id, latest(followed_recipes(user_id))))
+    UserFeed.objects.update_or_create(user_id=user_id)
+
+
+def drop(user_id):
+    FeedEntry.objects.filter(user_id=user_id).delete()
+    UserFeed.objects.filter(user_id=user_id).delete()
+
+
+def trim(user_id):
+    """Delete entries past the newest FEED['MAX_ENTRIES'] ones."""
+    oldest_kept = FeedEntry.objects.filter(user_id=user_id).order_by(
+        '-pub_date', '-recipe_id').values_list(
+        'pub_date', 'recipe_id')[settings.FEED['MAX_ENTRIES'] - 1:][:1]
+    for pub_date, recipe_id in oldest_kept:
+        FeedEntry.objects.filter(user_id=user_id).filter(
+            Q(pub_date__lt=pub_date)
+            | Q(pub_date=pub_date, recipe_id__lt=recipe_id)).delete()
+
+
+def fan_out(recipes):
+    """Add new recipes to precomputed feeds of their authors' followers."""
+    by_author = defaultdict(list)
+    for recipe in recipes:
+        by_author[recipe.author_id].append(recipe)
+    followers = Follow.objects.filter(
+        from_customuser_id__in=by_author,
+        to_customuser_id__in=UserFeed.objects.values('user_id'),
+    ).values_list('to_customuser_id', 'from_customuser_id')
+    FeedEntry.objects.bulk_create(
+        [entry for user_id, author_id in followers
+         for entry in make_entries(user_id, [
+             (recipe.pk, author_id, recipe.pub_date)
+             for recipe in by_author[author_id]])],
+        ignore_conflicts=True,
+    )
+
+
+def schedule_fan_out(recipes):
+    """Fan new recipes out in a job or once the transaction commits."""
+    if settings.JOBS['ENABLED']:
+        enqueue('fan_out', {'recipe_ids': [recipe.pk for recipe in recipes]})
+    else:
+        transaction.on_commit(lambda: fan_out(recipes))
+
+
+def follows_changed(follows, delta):
+    """
+    Update precomputed feeds after follows were added or removed.
+
+    Takes (follower id, author id) pairs, users without a precomputed
+    feed cost a single query.
+    """
+    authors = defaultdict(set)
+    for user_id, author_id in follows:
+        authors[user_id].add(author_id)
+    with_feed = UserFeed.objects.filter(
+        user_id__in=authors).values_list('user_id', flat=True)
+    for user_id in with_feed:
+        if delta < 0:
+            FeedEntry.objects.filter(
+                user_id=user_id, author_id__in=authors[user_id]).delete()
+            continue
+        FeedEntry.objects.bulk_create(
+            make_entries(user_id, latest(Recipes.objects.filter(
+                author_id__in=authors[user_id]))),
+            ignore_conflicts=True,
+        )
+        trim(user_id)
+
+
+def refresh():
+    """
+    Precompute feeds of users following at least MATERIALIZE_FROM authors.
+
+    Feeds of users who dropped below half of it are removed, the rest are
+    trimmed. Return numbers of built and dropped feeds.
+    """
+    threshold = settings.FEED['MATERIALIZE_FROM']
+    heavy = set(Follow.objects.values('to_customuser_id').annotate(
+        follows=Count('*')).filter(follows__gte=threshold).values_list(
+        'to_customuser_id', flat=True))
+    existing = set(UserFeed.objects.values_list('user_id', flat=True))
+    kept = set(Follow.objects.filter(
+        to_customuser_id__in=existing).values('to_customuser_id').annotate(
+        follows=Count('*')).filter(follows__gte=threshold // 2).values_list(
+        'to_customuser_id', flat=True))
+    to_drop = existing - kept
+    for user_id in heavy - existing:
+        build(user_id)
+    for user_id in to_drop:
+        drop(user_id)
+    for user_id in existing - to_drop:
+        trim(user_id)
+    return len(heavy - existing), len(to_drop)
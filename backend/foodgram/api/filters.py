@@ -1,15 +1,11 @@
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.forms.fields import MultipleChoiceField
 from django_filters import rest_framework as filters
 
-from recipes.models import Ingredients, Recipes
+from recipes.models import RecipeRank, Recipes
 
-
-class IngredientFilter(filters.FilterSet):
-    name = filters.CharFilter(field_name='name', lookup_expr='icontains')
-
-    class Meta:
-        model = Ingredients
-        fields = ['name']
+from .reference import tags_reference
 
 
 # next two classes is a way to filter (possibly) multiple tags
@@ -25,13 +21,24 @@ class MultipleFilter(filters.MultipleChoiceFilter):
 
 class RecipeFilter(filters.FilterSet):
     author = filters.CharFilter(field_name='author__id')
-    tags = MultipleFilter(field_name='tags__slug')
+    tags = MultipleFilter(field_name='tags__slug', method='filter_tags')
     is_favorited = filters.CharFilter(
         field_name='favorited', method='filter_favorited'
     )
     is_in_shopping_cart = filters.CharFilter(
         field_name='shopping_cart', method='filter_shopping'
     )
+    search = filters.CharFilter(method='filter_search')
+    ordering = filters.ChoiceFilter(
+        choices=RecipeRank.WINDOWS, method='filter_ordering'
+    )
+
+    # semi-join on tag ids instead of a join: recipes with several of the
+    # selected tags are listed once without DISTINCT over whole rows
+    def filter_tags(self, queryset, name, value):
+        tag_ids = tags_reference.pks_by('slug', value).values()
+        return queryset.filter(id__in=Recipes.tags.through.objects.filter(
+            tags_id__in=tag_ids).values('recipes_id'))
 
     # if we have anonymous request or query with zero value - return basic
     # queryset, fitered queryset otherwise
@@ -45,6 +52,18 @@ class RecipeFilter(filters.FilterSet):
             return queryset
         return queryset.filter(shopping_cart=self.request.user)
 
+    # full-text search over name and text, ranked by relevance
+    def filter_search(self, queryset, name, value):
+        return queryset.search(value)
+
+    # sort by precomputed scores, recipes without one go last by date
+    def filter_ordering(self, queryset, name, value):
+        score = RecipeRank.objects.filter(
+            recipe=OuterRef('pk'), window=value).values('score')[:1]
+        return queryset.annotate(
+            window_score=Coalesce(Subquery(score), 0)
+        ).order_by('-window_score', '-pub_date', '-id')
+
     class Meta:
         model = Recipes
         fields = ['author', 'tags']
@@ -0,0 +1,184 @@
+"""Recipe image decoding and resized variants."""
+import base64
+import binascii
+import io
+import logging
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            TemporaryUploadedFile)
+from django.db import connections, transaction
+from drf_extra_fields.fields import Base64ImageField
+from PIL import Image
+from rest_framework import serializers
+
+from recipes.models import Recipes
+
+from .jobs import enqueue
+from .response_cache import bump_generations
+
+logger = logging.getLogger(__name__)
+
+# multiple of 4 so that every chunk decodes on its own
+DECODE_CHUNK_SIZE = 64 * 1024
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif'}
+# line breaks of wrapped base64, they would shift chunk boundaries
+WHITESPACE = re.compile(r'\s+')
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_PIPELINE['WORKERS'],
+    thread_name_prefix='recipe-images',
+)
+
+
+class StreamingBase64ImageField(Base64ImageField):
+    """
+    Base64 image field decoding the payload chunk by chunk.
+
+    Decoded bytes go straight into an uploaded file object, which is spooled
+    to disk for large images, instead of being copied between several
+    in-memory buffers.
+    """
+
+    def to_internal_value(self, base64_data):
+        if base64_data in self.EMPTY_VALUES:
+            return None
+        if not isinstance(base64_data, str):
+            raise ValidationError(self.INVALID_FILE_MESSAGE)
+        content_type = None
+        start = base64_data.find(';base64,')
+        if start != -1:
+            if self.trust_provided_content_type:
+                content_type = base64_data[:start].replace('data:', '')
+            start += len(';base64,')
+        else:
+            start = 0
+        if WHITESPACE.search(base64_data, start):
+            base64_data, start = WHITESPACE.sub('', base64_data[start:]), 0
+        file = self.decode(base64_data, start, content_type)
+        extension = self.detect_extension(file)
+        if extension not in self.ALLOWED_TYPES:
+            raise ValidationError(self.INVALID_TYPE_MESSAGE)
+        file.name = file.name.replace('.img', f'.{extension}')
+        # skip base64 handling of the parent class, validate as a plain file
+        return serializers.ImageField.to_internal_value(self, file)
+
+    def decode(self, base64_data, start, content_type):
+        name = f'{uuid.uuid4()}.img'
+        if (len(base64_data) - start) * 3 // 4 > (
+                settings.FILE_UPLOAD_MAX_MEMORY_SIZE):
+            file = TemporaryUploadedFile(name, content_type, 0, None)
+        else:
+            file = InMemoryUploadedFile(
+                io.BytesIO(), None, name, content_type, 0, None)
+        try:
+            for offset in range(start, len(base64_data), DECODE_CHUNK_SIZE):
+                file.write(base64.b64decode(
+                    base64_data[offset:offset + DECODE_CHUNK_SIZE],
+                    validate=True))
+        except (TypeError, binascii.Error, ValueError):
+            raise ValidationError(self.INVALID_FILE_MESSAGE) from None
+        file.size = file.tell()
+        file.seek(0)
+        return file
+
+    @staticmethod
+    def detect_extension(file):
+        try:
+            with Image.open(file) as image:
+                return FORMAT_EXTENSIONS.get(image.format)
+        except (OSError, SyntaxError):
+            return None
+        finally:
+            file.seek(0)
+
+
+class ImageVariantField(serializers.Field):
+    """URL of a resized image variant, the original until it's ready."""
+
+    def __init__(self, variant, **kwargs):
+        self.variant = variant
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        name = recipe.image_variants.get(self.variant) or recipe.image.name
+        if not name:
+            return None
+        url = default_storage.url(name)
+        request = self.context.get('request')
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+def save_image(image, name, image_format):
+    buffer = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(buffer, 'WEBP',
+                   quality=settings.IMAGE_PIPELINE['WEBP_QUALITY'])
+    else:
+        image.save(buffer, image_format)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def generate_variants(recipe_id, image_name):
+    """Save resized and WebP variants of the image, then record them."""
+    stem = os.path.join(
+        'recipes', 'variants', os.path.splitext(os.path.basename(
+            image_name))[0])
+    with default_storage.open(image_name) as file:
+        with Image.open(file) as original:
+            original.load()
+            image_format = original.format
+            if original.mode not in ('RGB', 'RGBA'):
+                original = original.convert(
+                    'RGBA' if 'transparency' in original.info else 'RGB')
+    variants = {'webp': save_image(original, f'{stem}.webp', 'WEBP')}
+    for variant, size in settings.IMAGE_PIPELINE['VARIANTS'].items():
+        resized = original.copy()
+        resized.thumbnail((size, size))
+        if image_format == 'JPEG' and resized.mode == 'RGBA':
+            resized = resized.convert('RGB')
+        variants[variant] = save_image(
+            resized, f'{stem}_{variant}.{FORMAT_EXTENSIONS[image_format]}',
+            image_format)
+        variants[f'{variant}_webp'] = save_image(
+            resized, f'{stem}_{variant}.webp', 'WEBP')
+    # the image may have been replaced while variants were generated
+    if Recipes.objects.filter(pk=recipe_id, image=image_name).update(
+            image_variants=variants):
+        bump_generations('recipes')
+    return variants
+
+
+def run_in_worker(recipe_id, image_name):
+    try:
+        generate_variants(recipe_id, image_name)
+    except Exception:
+        logger.exception('Failed to generate variants of %s', image_name)
+    finally:
+        # worker threads get their own connections
+        connections.close_all()
+
+
+def schedule_variants(recipe):
+    """Generate variants in the background once the recipe is committed."""
+    recipe_id, image_name = recipe.pk, recipe.image.name
+    if settings.JOBS['ENABLED']:
+        enqueue('image_variants',
+                {'recipe_id': recipe_id, 'image_name': image_name})
+    elif settings.IMAGE_PIPELINE['ASYNC']:
+        transaction.on_commit(
+            lambda: executor.submit(run_in_worker, recipe_id, image_name))
+    else:
+        transaction.on_commit(
+            lambda: generate_variants(recipe_id, image_name))
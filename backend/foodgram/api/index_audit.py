@@ -0,0 +1,114 @@
+"""EXPLAIN of the queries API endpoints make, for the auditindexes command."""
+import re
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+
+from .benchmark import SCENARIOS
+
+# tables every row of which the endpoint returns, a scan is the plan there
+FULL_READS = {
+    'tags list': {'recipes_tags'},
+    'ingredients list': {'recipes_ingredients'},
+    'recipes export': {'recipes_recipes'},
+}
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(.*)$')
+POSTGRESQL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def is_read(sql):
+    return sql.lstrip().upper().startswith(('SELECT', 'WITH'))
+
+
+@contextmanager
+def captured_reads():
+    """Collect (sql, params) of read queries run in the block."""
+    reads = []
+
+    def capture(execute, sql, params, many, context):
+        if not many and is_read(sql):
+            reads.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(capture):
+        yield reads
+
+
+def explain(sql, params):
+    """Plan of a query as lines, sequential scans are taken if possible."""
+    if connection.vendor == 'postgresql':
+        # on small tables a scan is cheapest, only ask what can't be served
+        # by an index, SET LOCAL is only kept inside a transaction
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            return [row[0] for row in cursor.fetchall()]
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def is_first_rows(sql, plan):
+    """
+    An unfiltered page in primary key order: the scan walks rowids in order
+    and LIMIT stops it early. A WHERE clause may make it read every row.
+    """
+    return (' LIMIT ' in sql and ' WHERE ' not in sql
+            and not any('FOR ORDER BY' in line for line in plan))
+
+
+def scanned_tables(sql, plan):
+    """Tables the plan reads whole instead of looking rows up."""
+    if connection.vendor == 'postgresql':
+        return {table for line in plan
+                for table in POSTGRESQL_SCAN.findall(line)}
+    if is_first_rows(sql, plan):
+        return set()
+    tables, subqueries = set(), {'CONSTANT'}
+    for line in plan:
+        line = line.strip()
+        # subqueries in FROM are scanned by name like tables
+        if line.startswith(('CO-ROUTINE', 'MATERIALIZE')):
+            subqueries.add(line.split(' ', 1)[1])
+        match = SQLITE_SCAN.match(line)
+        # SCAN ... USING INDEX walks an index in order, e.g. for ORDER BY,
+        # virtual tables, the search index, are read by their own index
+        if match and 'INDEX' not in match.group(2):
+            tables.add(match.group(1))
+    return tables - subqueries
+
+
+def request(scenario, clients, ids):
+    if scenario.setup:
+        scenario.setup(clients, ids)
+    data = scenario.data(ids) if scenario.data else None
+    with captured_reads() as reads:
+        response = scenario.send(clients, ids, data)
+        if response.streaming:
+            b''.join(response.streaming_content)
+    if scenario.undo:
+        scenario.undo(clients, ids, response)
+    return reads
+
+
+def audit(clients, ids, names=None):
+    """
+    Call every scenario once and explain its read queries.
+
+    Returns the queries with the tables they scan by scenario name, tables
+    in FULL_READS are not reported.
+    """
+    report = {}
+    for scenario in SCENARIOS:
+        if names and scenario.name not in names:
+            continue
+        expected = FULL_READS.get(scenario.name, set())
+        queries = []
+        for sql, params in request(scenario, clients, ids):
+            plan = explain(sql, params)
+            scans = scanned_tables(sql, plan) - expected
+            if scans:
+                queries.append({'sql': sql, 'scans': sorted(scans),
+                                'plan': plan})
+        report[scenario.name] = queries
+    return report
@@ -0,0 +1,206 @@
+"""Job queue kept in the database and run by the runworker command."""
+import logging
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from recipes.models import Job
+
+logger = logging.getLogger(__name__)
+
+# task name -> function taking the job payload as keyword arguments
+tasks = {}
+
+
+def task(name, max_attempts=None):
+    """Register a function as a task, see api.tasks."""
+    def register(func):
+        func.max_attempts = max_attempts or settings.JOBS['MAX_ATTEMPTS']
+        tasks[name] = func
+        return func
+    return register
+
+
+def enqueue(name, payload=None, user=None, delay=0):
+    """
+    Queue a job, workers see it once the current transaction commits.
+
+    Without JOBS['ENABLED'] there may be no worker, so the job runs in
+    this process right after the commit.
+    """
+    job = Job.objects.create(
+        name=name, payload=payload or {}, user=user,
+        max_attempts=tasks[name].max_attempts,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+    if not settings.JOBS['ENABLED']:
+        transaction.on_commit(lambda: run_job(job.pk))
+    return job
+
+
+def claim(job_id=None):
+    """
+    Mark the oldest due job as running and return it, None if there's none.
+
+    PostgreSQL workers lock the job and skip rows locked by each other.
+    Other backends don't lock, there the conditional update decides who
+    got the job.
+    """
+    now = timezone.now()
+    using = router.db_for_write(Job)
+    due = Job.objects.using(using).filter(status=Job.QUEUED, run_at__lte=now)
+    if job_id is not None:
+        due = due.filter(pk=job_id)
+    locking = connections[using].features.has_select_for_update_skip_locked
+    # SQLite fails to upgrade a read transaction when another one writes
+    with transaction.atomic(using) if locking else nullcontext():
+        if locking:
+            due = due.select_for_update(skip_locked=True)
+        job = due.order_by('run_at', 'id').first()
+        if job is None or not Job.objects.using(using).filter(
+                pk=job.pk, status=Job.QUEUED).update(
+                status=Job.RUNNING, started=now,
+                attempts=F('attempts') + 1):
+            return None
+    job.status, job.started, job.attempts = (
+        Job.RUNNING, now, job.attempts + 1)
+    return job
+
+
+def run(job):
+    """Run a claimed job, record its result or schedule a retry."""
+    try:
+        result = tasks[job.name](**job.payload)
+    except Exception:
+        logger.exception('Job %s %s failed', job.pk, job.name)
+        fail(Job.objects.filter(pk=job.pk), job.attempts,
+             job.max_attempts, traceback.format_exc())
+        return
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.DONE, result=result, error='',
+        finished=timezone.now())
+
+
+def fail(jobs, attempts, max_attempts, error):
+    now = timezone.now()
+    if attempts < max_attempts:
+        delay = settings.JOBS['RETRY_DELAY'] * 2 ** (attempts - 1)
+        jobs.update(status=Job.QUEUED, error=error,
+                    run_at=now + timedelta(seconds=delay))
+    else:
+        jobs.update(status=Job.FAILED, error=error, finished=now)
+
+
+def run_job(job_id):
+    job = claim(job_id)
+    if job is not None:
+        run(job)
+
+
+def requeue_stale():
+    """Retry or fail jobs running longer than JOBS['TIMEOUT'] seconds."""
+    stale = Job.objects.filter(
+        status=Job.RUNNING, started__lt=timezone.now() - timedelta(
+            seconds=settings.JOBS['TIMEOUT']))
+    # the worker running them is most likely gone
+    for job in stale.only('attempts', 'max_attempts'):
+        fail(stale.filter(pk=job.pk), job.attempts, job.max_attempts,
+             'Timed out')
+
+
+def purge():
+    """Delete finished jobs past JOBS['KEEP_FINISHED'] with their files."""
+    old = Job.objects.filter(
+        status__in=(Job.DONE, Job.FAILED),
+        finished__lt=timezone.now() - timedelta(
+            seconds=settings.JOBS['KEEP_FINISHED']))
+    for result in old.filter(status=Job.DONE).values_list(
+            'result', flat=True):
+        if isinstance(result, dict) and result.get('file'):
+            default_storage.delete(result['file'])
+    return old.delete()[0]
+
+
+def schedule():
+    """Queue JOBS['SCHEDULE'] tasks whose interval has passed."""
+    now = timezone.now()
+    for name, interval in settings.JOBS['SCHEDULE'].items():
+        if not interval or Job.objects.filter(name=name).filter(
+                Q(status__in=(Job.QUEUED, Job.RUNNING))
+                | Q(created__gt=now - timedelta(seconds=interval))
+        ).exists():
+            continue
+        enqueue(name)
+
+
+class Worker:
+    """
+    Threads claiming and running jobs until stopped.
+
+    The calling thread does the housekeeping: it queues scheduled tasks,
+    requeues stale jobs and purges old ones. With 'burst' the worker
+    exits once there are no due jobs.
+    """
+
+    MAINTENANCE_INTERVAL = 60
+
+    def __init__(self, threads, burst=False):
+        self.threads = threads
+        self.burst = burst
+        self.stopping = threading.Event()
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self.loop, name=f'jobs-{number}')
+            for number in range(self.threads)
+        ]
+        self.maintain()
+        maintained = time.monotonic()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            self.stopping.wait(settings.JOBS['POLL_INTERVAL'])
+            if (not self.stopping.is_set() and time.monotonic()
+                    - maintained >= self.MAINTENANCE_INTERVAL):
+                self.maintain()
+                maintained = time.monotonic()
+        connections.close_all()
+        return self.processed
+
+    def maintain(self):
+        try:
+            requeue_stale()
+            if not self.burst:
+                schedule()
+            purge()
+        except Exception:
+            logger.exception('Job queue maintenance failed')
+
+    def loop(self):
+        try:
+            while not self.stopping.is_set():
+                job = claim()
+                if job is None:
+                    if self.burst:
+                        break
+                    self.stopping.wait(settings.JOBS['POLL_INTERVAL'])
+                    continue
+                run(job)
+                with self._lock:
+                    self.processed += 1
+        finally:
+            # threads get their own connections
+            connections.close_all()
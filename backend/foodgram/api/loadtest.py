@@ -0,0 +1,139 @@
+"""Concurrent HTTP load against running servers for the loadtest command."""
+import http.client
+import json
+import threading
+import time
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+from .benchmark import percentile
+
+
+class Scenario(NamedTuple):
+    name: str
+    paths: tuple
+    # sends the token, skipped without one
+    auth: bool = False
+
+
+SCENARIOS = (
+    Scenario('tags', ('/api/tags/',)),
+    Scenario('ingredients', ('/api/ingredients/',)),
+    Scenario('ingredient search', ('/api/ingredients/?name={word}',)),
+    Scenario('recipes list', ('/api/recipes/?limit=6',)),
+    Scenario('recipes list auth', ('/api/recipes/?limit=6',), auth=True),
+    Scenario('recipe detail', ('/api/recipes/{recipe}/',)),
+    Scenario('shopping list', ('/api/recipes/download_shopping_cart/',),
+             auth=True),
+    Scenario('mixed', (
+        '/api/tags/', '/api/recipes/?limit=6', '/api/recipes/{recipe}/',
+        '/api/ingredients/?name={word}',
+        '/api/recipes/download_shopping_cart/'), auth=True),
+)
+
+
+class Client:
+    """Keep-alive connection of one simulated user."""
+
+    def __init__(self, url, token=None):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(
+            parts.hostname, parts.port, timeout=30)
+        self.headers = {'Authorization': f'Token {token}'} if token else {}
+
+    def get(self, path):
+        try:
+            self.connection.request('GET', path, headers=self.headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0, b''
+        return response.status, body
+
+    def close(self):
+        self.connection.close()
+
+
+def fill(paths, ids):
+    return [path.format(**ids) for path in paths]
+
+
+def discover(url, token=None):
+    """Ids the scenario paths need, taken from the server itself."""
+    client = Client(url, token)
+    try:
+        status, body = client.get('/api/recipes/?limit=1')
+        recipes = json.loads(body)['results'] if status == 200 else []
+        status, body = client.get('/api/ingredients/')
+        ingredients = json.loads(body) if status == 200 else []
+    finally:
+        client.close()
+    if not recipes or not ingredients:
+        raise ValueError(f'{url} has no recipes or ingredients to load')
+    return {
+        'recipe': recipes[0]['id'],
+        'word': ingredients[len(ingredients) // 2]['name'][:3],
+    }
+
+
+def load(url, paths, concurrency, duration, token=None):
+    """
+    Request paths in turn from 'concurrency' clients for 'duration' seconds.
+
+    Return requests per second, latency percentiles and failed requests.
+    """
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def user(offset):
+        client = Client(url, token)
+        done, failed = [], 0
+        number = offset
+        while time.monotonic() < deadline:
+            path = paths[number % len(paths)]
+            number += 1
+            started = time.perf_counter()
+            status, _ = client.get(path)
+            done.append(time.perf_counter() - started)
+            if not 200 <= status < 300:
+                failed += 1
+        client.close()
+        with lock:
+            latencies.extend(done)
+            errors[0] += failed
+
+    started = time.monotonic()
+    users = [threading.Thread(target=user, args=(number,))
+             for number in range(concurrency)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies = [latency * 1000 for latency in latencies] or [0]
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'errors': errors[0],
+    }
+
+
+def run(targets, concurrency, duration, token=None, names=None):
+    """Load every target with every scenario, return results by target."""
+    ids = discover(next(iter(targets.values())), token)
+    results = {}
+    for label, url in targets.items():
+        results[label] = {}
+        for scenario in SCENARIOS:
+            if names and scenario.name not in names:
+                continue
+            if scenario.auth and not token:
+                continue
+            results[label][scenario.name] = load(
+                url, fill(scenario.paths, ids), concurrency, duration,
+                token if scenario.auth else None)
+    return results
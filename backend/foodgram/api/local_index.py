@@ -0,0 +1,42 @@
+"""Base of in-process copies of tables with lazy rebuilds."""
+import threading
+import time
+
+
+class LocalIndex:
+    """
+    Per-process copy of a table rebuilt lazily by build().
+
+    The copy is rebuilt on the next read after invalidate() is called or
+    when it gets older than ttl seconds, which bounds staleness across
+    worker processes. Readers get the data of the last build and never
+    wait for the lock unless the copy is stale.
+    """
+
+    def __init__(self, ttl, empty):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._data = empty
+        self._built_at = 0
+
+    def build(self):
+        raise NotImplementedError
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _is_stale(self):
+        return (self._dirty
+                or time.monotonic() - self._built_at > self.ttl)
+
+    @property
+    def data(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    # reset first so changes made while loading aren't lost
+                    self._dirty = False
+                    self._data = self.build()
+                    self._built_at = time.monotonic()
+        return self._data
@@ -0,0 +1,77 @@
+"""Custom manage.py command for finding queries without an index."""
+import json
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+from api.benchmark import SCENARIOS, make_clients, seed
+from api.index_audit import audit
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway test database, call every API endpoint and run"
+        " EXPLAIN on each query it reads with. Reports queries whose plan"
+        " scans a whole table, apart from the lists that return every row,"
+        " and fails with --strict if there are any. PostgreSQL plans are"
+        " made with sequential scans disabled, so only scans no index can"
+        " replace are reported. Example: python manage.py auditindexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=200,
+                            help="Number of recipes.")
+        parser.add_argument("--scenario", action="append",
+                            choices=[scenario.name for scenario in SCENARIOS],
+                            help="Audit only given scenarios.")
+        parser.add_argument("--strict", action="store_true",
+                            help="Fail if any query scans a table.")
+        parser.add_argument("--output", help="Report file, stdout if empty.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        for alias in settings.DATABASE_ROUTING["REPLICAS"]:
+            connections[alias].creation.set_as_test_mirror(
+                connection.settings_dict)
+        try:
+            call_command("flush", interactive=False, verbosity=0)
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(
+                        MEDIA_ROOT=media_root,
+                        IMAGE_PIPELINE={**settings.IMAGE_PIPELINE,
+                                        "ASYNC": False},
+                        RESPONSE_CACHE={**settings.RESPONSE_CACHE,
+                                        "ENABLED": False}):
+                ids = seed(options["size"])
+                report = audit(make_clients(ids), ids, options["scenario"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps({"database": connection.vendor,
+                             "scenarios": report},
+                            indent=2, ensure_ascii=False)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        else:
+            sys.stdout.write(output + "\n")
+
+        found = 0
+        for name, queries in report.items():
+            for query in queries:
+                found += 1
+                self.stderr.write(self.style.WARNING(
+                    f"{name}: scans {', '.join(query['scans'])}"))
+        if found and options["strict"]:
+            raise CommandError("%d queries scan tables" % found)
+        self.stderr.write(self.style.SUCCESS(
+            "%d queries scan tables" % found))
@@ -0,0 +1,120 @@
+"""Custom manage.py command for benchmarking API endpoints."""
+import json
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+from api.benchmark import SCENARIOS, run, seed
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway test database with synthetic data at several sizes"
+        " and run every API endpoint against it, recording queries per"
+        " request and latency percentiles. Writes a JSON report which can"
+        " be diffed across commits and fails when an endpoint's query count"
+        " grows with the data size or exceeds --baseline. Example:"
+        " python manage.py benchmark --sizes 50 500 --output report.json"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+",
+                            default=[50, 500], help="Numbers of recipes.")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Measured runs of every scenario.")
+        parser.add_argument("--ingredients", type=int, default=8,
+                            help="Ingredients per recipe.")
+        parser.add_argument("--follows", type=int, default=5,
+                            help="Authors followed by each user.")
+        parser.add_argument("--scenario", action="append",
+                            choices=[scenario.name for scenario in SCENARIOS],
+                            help="Run only given scenarios.")
+        parser.add_argument("--baseline",
+                            help="Previous report to compare queries with.")
+        parser.add_argument("--output", help="Report file, stdout if empty.")
+        parser.add_argument("--response-cache", action="store_true",
+                            help="Keep the response cache on, by default"
+                                 " endpoints are measured without it.")
+
+    def handle(self, *args, **options):
+        sizes = sorted(set(options["sizes"]))
+        results = {}
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        # replicas read the test database as in Django's test runner
+        for alias in settings.DATABASE_ROUTING["REPLICAS"]:
+            connections[alias].creation.set_as_test_mirror(
+                connection.settings_dict)
+        try:
+            for size in sizes:
+                self.stderr.write(f"Benchmarking with {size} recipes")
+                call_command("flush", interactive=False, verbosity=0)
+                results[size] = self.run_size(size, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            "database": connection.vendor,
+            "sizes": sizes,
+            "repeat": options["repeat"],
+            "endpoints": {
+                name: {str(size): results[size][name] for size in sizes}
+                for name in results[sizes[0]]
+            },
+        }
+        output = json.dumps(report, indent=2, ensure_ascii=False,
+                            sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        else:
+            sys.stdout.write(output + "\n")
+
+        problems = self.regressions(report, options["baseline"])
+        for problem in problems:
+            self.stderr.write(self.style.ERROR(problem))
+        if problems:
+            raise CommandError("%d query count regressions" % len(problems))
+        self.stderr.write(self.style.SUCCESS("No query count regressions"))
+
+    def run_size(self, size, options):
+        """Seed the empty test database and measure scenarios."""
+        # variants are generated in-request so that image work doesn't
+        # leak between runs, uploaded files go to a temporary directory
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+                MEDIA_ROOT=media_root,
+                IMAGE_PIPELINE={**settings.IMAGE_PIPELINE, "ASYNC": False},
+                RESPONSE_CACHE={**settings.RESPONSE_CACHE,
+                                "ENABLED": options["response_cache"]}):
+            ids = seed(size, options["ingredients"], options["follows"])
+            return run(ids, options["repeat"], options["scenario"])
+
+    @staticmethod
+    def regressions(report, baseline):
+        """List endpoints whose query count grows with data or baseline."""
+        problems = []
+        for name, by_size in report["endpoints"].items():
+            counts = [result["queries"] for result in by_size.values()]
+            if len(set(counts)) > 1:
+                problems.append(
+                    f"{name}: queries grow with data size {counts}")
+        if not baseline:
+            return problems
+        with open(baseline, encoding="utf-8") as f:
+            previous = json.load(f)["endpoints"]
+        for name, by_size in report["endpoints"].items():
+            for size, result in by_size.items():
+                before = previous.get(name, {}).get(size)
+                if before and result["queries"] > before["queries"]:
+                    problems.append(
+                        f"{name} ({size} recipes): {before['queries']} ->"
+                        f" {result['queries']} queries")
+        return problems
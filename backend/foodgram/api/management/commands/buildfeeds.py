@@ -0,0 +1,42 @@
+"""Custom manage.py command for maintaining precomputed following feeds."""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api import feed
+from recipes.models import UserFeed
+
+
+class Command(BaseCommand):
+    help = (
+        "Precompute /api/recipes/feed/ of users following at least"
+        " FEED['MATERIALIZE_FROM'] authors, drop feeds of users who follow"
+        " less than half of it and trim the rest to FEED['MAX_ENTRIES']."
+        " New recipes and follows update existing feeds right away, run the"
+        " command from cron or keep it running with --loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true",
+                            help="Rebuild every precomputed feed.")
+        parser.add_argument("--loop", type=int, metavar="SECONDS",
+                            help="Keep refreshing with given interval.")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            with transaction.atomic():
+                if options["rebuild"]:
+                    for user_id in UserFeed.objects.values_list(
+                            "user_id", flat=True):
+                        feed.build(user_id)
+                built, dropped = feed.refresh()
+            self.stdout.write(
+                "%d feeds built, %d dropped in %.2f s"
+                % (built, dropped, time.monotonic() - started))
+            if not options["loop"]:
+                break
+            options["rebuild"] = False
+            time.sleep(options["loop"])
+        self.stdout.write(self.style.SUCCESS("Feeds are up to date"))
@@ -0,0 +1,48 @@
+"""Custom manage.py command for exporting recipes as NDJSON."""
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.recipe_io import export_recipes, ndjson
+from recipes.models import Recipes
+
+
+class Command(BaseCommand):
+    help = (
+        "Write recipes as newline delimited JSON, one recipe per line with"
+        " tags, ingredients and the storage name of the image. Recipes are"
+        " read with a server-side cursor, so memory use doesn't depend on"
+        " the number of recipes. Load the file back with:"
+        " python manage.py loadcsv recipes recipes.ndjson"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="File name, stdout if empty.")
+        parser.add_argument("--author", type=int, action="append",
+                            help="Export only recipes of given authors.")
+        parser.add_argument(
+            "--chunk-size", type=int,
+            default=settings.RECIPE_BULK["EXPORT_CHUNK_SIZE"])
+
+    def handle(self, *args, **options):
+        recipes = Recipes.objects.all()
+        if options["author"]:
+            recipes = recipes.filter(author_id__in=options["author"])
+        started = time.monotonic()
+        total = 0
+        output = (open(options["output"], "w", encoding="utf-8")
+                  if options["output"] else sys.stdout)
+        try:
+            for line in ndjson(export_recipes(recipes,
+                                              options["chunk_size"])):
+                output.write(line)
+                total += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        elapsed = time.monotonic() - started
+        self.stderr.write(self.style.SUCCESS(
+            "%d recipes, %.1f s, %.0f recipes/s"
+            % (total, elapsed, total / elapsed if elapsed else 0)))
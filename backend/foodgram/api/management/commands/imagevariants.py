@@ -0,0 +1,32 @@
+"""Custom manage.py command for generating resized recipe images."""
+from django.core.management.base import BaseCommand
+
+from api.images import generate_variants
+from recipes.models import Recipes
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate resized and WebP variants for recipe images which don't"
+        " have them yet, for example ones uploaded before variants existed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true",
+                            help="Regenerate variants of every recipe.")
+
+    def handle(self, *args, **options):
+        recipes = Recipes.objects.exclude(image="")
+        if not options["all"]:
+            recipes = recipes.filter(image_variants={})
+        done = failed = 0
+        for recipe_id, image_name in recipes.values_list(
+                "id", "image").iterator():
+            try:
+                generate_variants(recipe_id, image_name)
+                done += 1
+            except OSError as error:
+                failed += 1
+                self.stderr.write(f"{image_name}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Variants generated for {done} recipes, {failed} failed"))
@@ -1,56 +1,235 @@
-"""Custom manage.py command for loading csv files into project database."""
+"""Custom manage.py command for loading csv and json files into db."""
 import csv
+import io
+import json
+import os
+import time
 
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 
+from api.autocomplete import ingredient_index
+from api.matching import recipe_matcher
+from api.recipe_io import RecipeImporter, chunks
+from api.reference import ingredients_reference, tags_reference
+from api.response_cache import (recipes_generation, reference_generation,
+                                users_generation)
 from recipes.models import Ingredients, Recipes, Tags
 from users.models import CustomUser
 
+# command -> (model, fields identifying an existing row)
 COMMANDS = {
-    "tags": Tags,
-    "ingredients": Ingredients,
-    "recipes": Recipes,
-    "users": CustomUser,
+    "tags": (Tags, ("slug",)),
+    "ingredients": (Ingredients, ("name",)),
+    "recipes": (Recipes, ("author", "name")),
+    "users": (CustomUser, ("email",)),
 }
+# tables simple enough to be loaded with COPY on PostgreSQL
+COPY_COMMANDS = ("tags", "ingredients")
+# rows are written in bulk, so model signals don't invalidate them
+CACHES_TO_INVALIDATE = {
+    "tags": (tags_reference, reference_generation),
+    "ingredients": (ingredients_reference, ingredient_index,
+                    reference_generation),
+    "recipes": (recipe_matcher, recipes_generation),
+    "users": (users_generation,),
+}
+
+
+def read_csv(file):
+    yield from csv.DictReader(file)
+
+
+def read_json(file):
+    """Read either a JSON array or newline delimited JSON objects."""
+    first = file.read(1)
+    while first.isspace():
+        first = file.read(1)
+    if first == "[":
+        yield from json.loads(first + file.read())
+        return
+    line = first + file.readline()
+    while line:
+        if line.strip():
+            yield json.loads(line)
+        line = file.readline()
+
+
+READERS = {
+    "csv": read_csv,
+    "json": read_json,
+    "ndjson": read_json,
+    "jsonl": read_json,
+}
+
+
+def clean(row):
+    return {
+        key.strip(): value.strip() if isinstance(value, str) else value
+        for key, value in row.items()
+    }
 
 
 class Command(BaseCommand):
     help = (
-        "The command for loading csv files into projects db."
+        "The command for loading csv or json files into projects db."
         " Takes command-line arguments. For example to load"
-        "file genre.csv you need to enter the following command:"
-        " python manage.py loadcsv review"
-        " /home/kubanez/Dev/api_yamdb/api_yamdb/static/data/review.csv."
-        " Also you need to load files in order:\n"
-        "first - files with models without foreign keys ( genre"
-        " category, user, title)\n"
-        "then - models with them ( titles, genre_title, review and comment)"
+        " file ingredients.csv you need to enter the following command:"
+        " python manage.py loadcsv ingredients ../../data/ingredients.csv."
+        " Rows are written in batches inside a single transaction, rows"
+        " which already exist are updated (or skipped with"
+        " --on-conflict=ignore). Load files in order: tags, ingredients,"
+        " users and then recipes.\n"
+        "Recipes rows take 'author' (user id), 'name', 'text',"
+        " 'cooking_time', 'image' (path inside MEDIA_ROOT), 'tags' (slugs"
+        " separated by commas) and 'ingredients' (name:amount pairs"
+        " separated by semicolons, or a list of objects in json)."
+        " Existing recipes are always skipped."
     )
 
     def add_arguments(self, parser):
         # Positional arguments
-        parser.add_argument("command", nargs="+", type=str)
+        parser.add_argument("command", nargs="+", type=str,
+                            choices=COMMANDS)
         parser.add_argument("filename", nargs="+", type=str)
+        parser.add_argument("--format", choices=READERS,
+                            help="Input format, guessed by file extension.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--on-conflict", choices=("update", "ignore"),
+                            default="update")
+        parser.add_argument("--no-copy", action="store_true",
+                            help="Don't use COPY on PostgreSQL.")
 
     def handle(self, *args, **options):
         command: str = options["command"][0]
         filename: str = options["filename"][0]
+        file_format = (options["format"]
+                       or os.path.splitext(filename)[1].lstrip(".").lower())
+        if file_format not in READERS:
+            raise CommandError(
+                "Unknown format '%s', use --format" % file_format)
+        self.model, self.keys = COMMANDS[command]
+        self.command = command
+        self.options = options
+        if (command in COPY_COMMANDS and not options["no_copy"]
+                and connection.vendor == "postgresql"):
+            load_batch = self.copy_batch
+        elif command == "recipes":
+            load_batch = self.load_recipes
+        else:
+            load_batch = self.load_batch
 
+        started = time.monotonic()
+        total = 0
         try:
-            model = COMMANDS.get(command)
-            with open(filename) as f:
-                reader = csv.reader(f)
-                field_names = next(reader)
-
-                for row in reader:
-                    data_to_insert = dict(zip(field_names, row, strict=True))
-                    special_models = ["recipes"]
-                    if command not in special_models:
-                        model.objects.create(**data_to_insert)
-
-            self.stdout.write(
-                self.style.SUCCESS('Successfully loaded the file "%s"'
-                                   % filename)
-            )
+            with open(filename, encoding="utf-8") as f, \
+                    transaction.atomic():
+                rows = (clean(row) for row in READERS[file_format](f))
+                for batch in chunks(rows, options["batch_size"]):
+                    load_batch(batch)
+                    total += len(batch)
+                    self.report(total, started, ending="\r")
         except IOError:
             raise CommandError("File '%s' does not exist" % filename) from None
+        except (KeyError, TypeError, ValueError) as error:
+            raise CommandError(
+                "Bad row in '%s' after %d rows: %r" % (filename, total, error)
+            ) from None
+        for cache in CACHES_TO_INVALIDATE.get(command, ()):
+            cache.invalidate()
+
+        self.report(total, started)
+        self.stdout.write(
+            self.style.SUCCESS('Successfully loaded the file "%s"'
+                               % filename)
+        )
+
+    def report(self, total, started, ending="\n"):
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            "%d rows, %.1f s, %.0f rows/s"
+            % (total, elapsed, total / elapsed if elapsed else 0),
+            ending=ending,
+        )
+        self.stdout.flush()
+
+    def load_batch(self, batch):
+        """Insert new rows and update (or skip) already existing ones."""
+        if self.command == "users":
+            for row in batch:
+                if row.get("password"):
+                    row["password"] = make_password(row["password"])
+        # the last row wins if the file repeats a key
+        objects = {
+            tuple(row[key] for key in self.keys): self.model(**row)
+            for row in batch
+        }
+        if self.options["on_conflict"] == "ignore":
+            self.model.objects.bulk_create(
+                objects.values(), ignore_conflicts=True)
+            return
+        (key,) = self.keys
+        existing = self.model.objects.in_bulk(
+            [value for value, in objects], field_name=key)
+        to_update = []
+        for (value,), obj in objects.items():
+            if value in existing:
+                obj.pk = existing[value].pk
+                to_update.append(obj)
+        self.model.objects.bulk_create(
+            [obj for obj in objects.values() if obj.pk is None])
+        if to_update:
+            fields = {
+                field for row in batch for field in row if field != key
+            }
+            self.model.objects.bulk_update(to_update, fields)
+
+    def copy_batch(self, batch):
+        """Load batch through COPY into a temporary table and merge it."""
+        table = self.model._meta.db_table
+        (key,) = self.keys
+        columns = list(batch[0])
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            [row[column] for column in columns] for row in batch)
+        buffer.seek(0)
+        column_list = ", ".join(connection.ops.quote_name(column)
+                                for column in columns)
+        if self.options["on_conflict"] == "ignore":
+            on_conflict = "DO NOTHING"
+        else:
+            on_conflict = "DO UPDATE SET " + ", ".join(
+                f"{quoted} = EXCLUDED.{quoted}"
+                for quoted in map(connection.ops.quote_name, columns)
+                if quoted != connection.ops.quote_name(key)
+            )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS loadcsv_{table} "
+                f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            cursor.execute(f"TRUNCATE loadcsv_{table}")
+            cursor.copy_expert(
+                f"COPY loadcsv_{table} ({column_list}) FROM STDIN WITH CSV",
+                buffer,
+            )
+            # DISTINCT ON keeps a single row per key, ON CONFLICT can't
+            # touch the same row twice within one statement
+            cursor.execute(
+                f"INSERT INTO {table} ({column_list}) "
+                f"SELECT DISTINCT ON ({key}) {column_list} "
+                f"FROM loadcsv_{table} ORDER BY {key}, id DESC "
+                f"ON CONFLICT ({key}) {on_conflict}"
+            )
+
+    def load_recipes(self, batch):
+        """Validate and insert recipes with their tags and ingredients."""
+        if not hasattr(self, "importer"):
+            self.importer = RecipeImporter()
+            self.loaded = 0
+        self.importer.load(enumerate(batch, self.loaded + 1))
+        self.loaded += len(batch)
+        if self.importer.errors:
+            number, messages = self.importer.errors[0]
+            raise ValueError("row %d: %s" % (number, " ".join(messages)))
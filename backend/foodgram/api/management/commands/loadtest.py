@@ -0,0 +1,127 @@
+"""Custom manage.py command for load testing WSGI and ASGI servers."""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from api.loadtest import SCENARIOS, run
+from recipes.models import User
+
+# ASGI value of gunicorn.conf.py for the servers started by --serve
+MODES = {"wsgi": "0", "asgi": "1"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Load running servers with concurrent keep-alive clients and report"
+        " requests per second and latency percentiles of every scenario."
+        " With --serve starts gunicorn in both modes of gunicorn.conf.py on"
+        " this database and compares the sync WSGI path with the ASGI one."
+        " The database has to have recipes, e.g. loaded with loadcsv."
+        " Example: python manage.py loadtest --serve --concurrency 32"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("urls", nargs="*",
+                            help="Base URLs of running servers.")
+        parser.add_argument("--serve", action="store_true",
+                            help="Start WSGI and ASGI servers to compare.")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Gunicorn workers of started servers.")
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument("--duration", type=float, default=10,
+                            help="Seconds every scenario runs.")
+        parser.add_argument("--token", help="Token of the user to load"
+                            " authenticated scenarios as, with --serve the"
+                            " first user's one by default.")
+        parser.add_argument("--scenario", action="append",
+                            choices=[scenario.name for scenario in SCENARIOS],
+                            help="Run only given scenarios.")
+        parser.add_argument("--output", help="Report file, stdout if empty.")
+
+    def handle(self, *args, **options):
+        if not options["serve"] and not options["urls"]:
+            raise CommandError("Give server URLs or --serve")
+        targets = {url: url for url in options["urls"]}
+        servers = []
+        token = options["token"]
+        try:
+            if options["serve"]:
+                for mode, asgi in MODES.items():
+                    url, server = self.start(asgi, options["workers"])
+                    targets[mode] = url
+                    servers.append(server)
+                if token is None:
+                    token = self.first_user_token()
+            results = run(targets, options["concurrency"],
+                          options["duration"], token, options["scenario"])
+        except ValueError as error:
+            raise CommandError(error)
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+        report = {
+            "concurrency": options["concurrency"],
+            "duration": options["duration"],
+            "targets": targets,
+            "results": results,
+        }
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        else:
+            sys.stdout.write(output + "\n")
+        self.summary(results)
+
+    def start(self, asgi, workers):
+        """Start gunicorn on a free port, return its URL once it answers."""
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            ["gunicorn", "--config", "gunicorn.conf.py"],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, "ASGI": asgi,
+                 "GUNICORN_BIND": f"127.0.0.1:{port}",
+                 "GUNICORN_WORKERS": str(workers)},
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                urlopen(f"{url}/api/tags/", timeout=1).close()
+                return url, server
+            except (URLError, OSError):
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError("Server with ASGI=%s didn't start" % asgi)
+
+    @staticmethod
+    def first_user_token():
+        user = User.objects.order_by("id").first()
+        if user is None:
+            return None
+        return Token.objects.get_or_create(user=user)[0].key
+
+    def summary(self, results):
+        labels = list(results)
+        for name in results[labels[0]]:
+            line = "; ".join(
+                "%s %.0f rps, p99 %.1f ms%s" % (
+                    label, results[label][name]["rps"],
+                    results[label][name]["p99_ms"],
+                    ", %d errors" % results[label][name]["errors"]
+                    if results[label][name]["errors"] else "")
+                for label in labels)
+            self.stderr.write(f"{name}: {line}")
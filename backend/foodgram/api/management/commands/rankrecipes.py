@@ -0,0 +1,43 @@
+"""Custom manage.py command for refreshing recipe popularity rankings."""
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.ranking import prune_events, rebuild, refresh
+from api.response_cache import bump_generations
+from recipes.models import RecipeRank
+
+
+class Command(BaseCommand):
+    help = (
+        "Refresh materialized recipe rankings used by"
+        " /api/recipes/?ordering=popular|trending. By default only events"
+        " since the previous run are applied. Run it from cron or keep it"
+        " running with --loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true",
+                            help="Recalculate rankings from scratch.")
+        parser.add_argument("--loop", type=int, metavar="SECONDS",
+                            help="Keep refreshing with given interval.")
+
+    def handle(self, *args, **options):
+        while True:
+            for window, _ in RecipeRank.WINDOWS:
+                started = time.monotonic()
+                if options["rebuild"]:
+                    changed = rebuild(window)
+                else:
+                    changed = refresh(window)
+                self.stdout.write(
+                    "%s: %d recipes updated in %.2f s"
+                    % (window, changed, time.monotonic() - started))
+                if changed:
+                    bump_generations("ranking")
+            self.stdout.write("%d old events pruned" % prune_events())
+            if not options["loop"]:
+                break
+            options["rebuild"] = False
+            time.sleep(options["loop"])
+        self.stdout.write(self.style.SUCCESS("Rankings are up to date"))
@@ -0,0 +1,19 @@
+"""Custom manage.py command for repairing denormalized counters."""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.counters import recount
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalculate favorites, shopping cart, followers and recipes"
+        " counters and report how many rows have drifted."
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifted = recount()
+        for label, rows in drifted.items():
+            self.stdout.write(f"{label}: {rows} rows fixed")
+        self.stdout.write(self.style.SUCCESS("Counters are up to date"))
@@ -0,0 +1,61 @@
+"""Custom manage.py command for running background jobs."""
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run jobs queued in the database: image variants, feed fan-out,"
+        " shopping lists and scheduled ranking and feed refreshes. Every"
+        " process runs its own threads, each claiming one job at a time, so"
+        " several workers may share the queue. Failed jobs are retried with"
+        " a growing delay. SIGTERM lets running jobs finish."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int,
+                            default=settings.JOBS["PROCESSES"])
+        parser.add_argument("--threads", type=int,
+                            default=settings.JOBS["THREADS"])
+        parser.add_argument("--burst", action="store_true",
+                            help="Exit once there are no due jobs.")
+
+    def handle(self, *args, **options):
+        if options["processes"] <= 1:
+            processed = work(options["threads"], options["burst"])
+            self.stdout.write(self.style.SUCCESS(
+                "%d jobs processed" % processed))
+            return
+        # children must not share the parent's connections
+        connections.close_all()
+        children = [
+            multiprocessing.Process(
+                target=work, args=(options["threads"], options["burst"]))
+            for _ in range(options["processes"])
+        ]
+        for child in children:
+            child.start()
+
+        def stop(*args):
+            for child in children:
+                child.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for child in children:
+            child.join()
+        self.stdout.write(self.style.SUCCESS(
+            "%d worker processes stopped" % len(children)))
+
+
+def work(threads, burst):
+    worker = Worker(threads, burst)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    return worker.run()
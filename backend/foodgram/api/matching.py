@@ -0,0 +1,93 @@
+"""In-process inverted index matching recipes to a set of ingredients."""
+from array import array
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from recipes.models import RecipeIngredients
+
+from .local_index import LocalIndex
+
+
+class RecipeMatcher(LocalIndex):
+    """
+    Inverted index from ingredient id to ids of recipes using it.
+
+    Postings are compact unsigned int arrays, so a match only counts hits
+    over the postings of the requested ingredients and never joins the
+    recipe tables. API writes update the index in place, other changes
+    are picked up after invalidate().
+    """
+
+    def __init__(self, ttl):
+        # (ingredient id -> recipe ids, recipe id -> ingredient ids)
+        super().__init__(ttl, empty=({}, {}))
+
+    def build(self):
+        postings = defaultdict(lambda: array('I'))
+        recipes = defaultdict(list)
+        rows = RecipeIngredients.objects.order_by().values_list(
+            'recipe_id', 'ingredient_id').iterator(chunk_size=10000)
+        for recipe_id, ingredient_id in rows:
+            postings[ingredient_id].append(recipe_id)
+            recipes[recipe_id].append(ingredient_id)
+        return (
+            dict(postings),
+            {pk: tuple(items) for pk, items in recipes.items()},
+        )
+
+    def update(self, recipe_id, ingredient_ids):
+        """Replace postings of the recipe with the given ingredients."""
+        with self._lock:
+            if self._dirty:
+                return
+            # arrays are copied, concurrent matches keep reading old ones
+            postings, recipes = self._data
+            old, new = set(recipes.get(recipe_id, ())), set(ingredient_ids)
+            for ingredient_id in old - new:
+                ids = array('I', postings[ingredient_id])
+                ids.remove(recipe_id)
+                postings[ingredient_id] = ids
+            for ingredient_id in new - old:
+                ids = array('I', postings.get(ingredient_id, ()))
+                ids.append(recipe_id)
+                postings[ingredient_id] = ids
+            if new:
+                recipes[recipe_id] = tuple(new)
+            else:
+                recipes.pop(recipe_id, None)
+
+    def remove(self, recipe_id):
+        self.update(recipe_id, ())
+
+    def match(self, ingredient_ids, max_missing=0):
+        """
+        Return (recipe id, missing ingredients count) pairs.
+
+        Recipes missing at most max_missing of their ingredients are
+        ranked by the number missing, then by the number of requested
+        ingredients used, newest first.
+        """
+        postings, recipes = self.data
+        hits = Counter()
+        for ingredient_id in set(ingredient_ids):
+            hits.update(postings.get(ingredient_id, ()))
+        matches = []
+        for recipe_id, count in hits.items():
+            missing = len(recipes.get(recipe_id, ())) - count
+            if missing <= max_missing:
+                matches.append((missing, -count, -recipe_id))
+        matches.sort()
+        return [(-recipe_id, missing)
+                for missing, _, recipe_id in matches]
+
+
+recipe_matcher = RecipeMatcher(ttl=settings.RECIPE_MATCHING['TTL'])
+
+
+def schedule_matcher_update(recipe_id, ingredient_ids):
+    """Update the index once the surrounding transaction commits."""
+    ingredient_ids = tuple(ingredient_ids)
+    transaction.on_commit(
+        lambda: recipe_matcher.update(recipe_id, ingredient_ids))
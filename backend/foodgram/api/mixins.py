@@ -9,3 +9,29 @@ class ReadOrListOnlyViewSet(
 
 class ListViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     pass
+
+
+class CachedResponseMixin:
+    """
+    Serve list and retrieve actions through response caches.
+
+    'response_caches' maps an action to its ResponseCache, requests with
+    query parameters outside 'cached_query_params' are never cached.
+    """
+
+    response_caches = {}
+    cached_query_params = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(super().retrieve, request, *args, **kwargs)
+
+    def cached(self, handler, request, *args, **kwargs):
+        # other actions may call list or retrieve for a different object
+        cache = self.response_caches.get(self.action)
+        if cache is None:
+            return handler(request, *args, **kwargs)
+        return cache.respond(request, self.cached_query_params,
+                             lambda: handler(request, *args, **kwargs))
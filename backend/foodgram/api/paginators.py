@@ -1,6 +1,95 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+def estimated_count(queryset):
+    """Return planner's row estimate for a whole PostgreSQL table."""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+            [queryset.model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    return int(row[0]) if row else None
+
+
+class FastCountPaginator(Paginator):
+    """
+    Paginator which avoids exact COUNT(*) of unfiltered querysets.
+
+    Large tables are counted with the planner's estimate on PostgreSQL,
+    other unfiltered counts are cached for a short time. Filtered counts
+    depend on the user and are always exact. Selected annotations are left
+    out of counting queries.
+    """
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'query'):
+            return super().count
+        queryset = self.object_list.values('pk')
+        if queryset.query.where:
+            return queryset.count()
+        estimate = estimated_count(queryset)
+        if (estimate is not None
+                and estimate >= settings.PAGINATION['ESTIMATE_COUNT_FROM']):
+            return estimate
+        sql, params = queryset.query.sql_with_params()
+        key = 'count:' + hashlib.md5(
+            f'{sql}{params}'.encode()).hexdigest()
+        return cache.get_or_set(
+            key, queryset.count, settings.PAGINATION['COUNT_CACHE_TIMEOUT'])
+
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination over the view's 'cursor_ordering' fields."""
+
+    page_size = 6
+    page_size_query_param = 'limit'
+
+    def get_ordering(self, request, queryset, view):
+        return view.cursor_ordering
 
 
 class MyPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination with an opt-in keyset mode.
+
+    Views declaring 'cursor_ordering' switch to cursor pagination when a
+    request has '?pagination=cursor' or a 'cursor' parameter. Such pages
+    have no count and cost the same however deep they are.
+    """
+
     page_size = 6
     page_size_query_param = 'limit'
+    django_paginator_class = FastCountPaginator
+    mode_query_param = 'pagination'
+
+    def __init__(self):
+        self.keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_keyset(request, view):
+            self.keyset = KeysetPagination()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def use_keyset(self, request, view):
+        return getattr(view, 'cursor_ordering', None) and (
+            request.query_params.get(self.mode_query_param) == 'cursor'
+            or KeysetPagination.cursor_query_param in request.query_params
+        )
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
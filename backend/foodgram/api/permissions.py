@@ -1,3 +1,6 @@
+import hmac
+
+from django.conf import settings
 from rest_framework import permissions
 
 
@@ -8,3 +11,14 @@ class IsAuthorOrReadOnlyPermission(permissions.BasePermission):
             return True
 
         return request.user == obj.author
+
+
+class CanReadMetrics(permissions.BasePermission):
+    """Staff users or scrapers sending 'Authorization: Bearer <token>'."""
+
+    def has_permission(self, request, view):
+        token = settings.PROFILING['METRICS_TOKEN']
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and hmac.compare_digest(header, f'Bearer {token}'):
+            return True
+        return request.user.is_staff
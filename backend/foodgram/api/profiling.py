@@ -0,0 +1,274 @@
+"""Opt-in request profiling: SQL, serializer time and Prometheus metrics."""
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.serializers import BaseSerializer
+
+from foodgram.middleware import HybridMiddleware
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+def fingerprint(sql):
+    """Reduce SQL to its shape: literals and IN lists are replaced."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    sql = re.sub(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)', '(...)', sql)
+    return sql.replace('%s', '?')
+
+
+class Profile:
+    """Queries and serializer time of one sampled request."""
+
+    def __init__(self):
+        self.queries = []
+        self.serializer_time = 0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # used as a database execute wrapper
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - started, sql))
+
+    @property
+    def db_time(self):
+        return sum(duration for duration, _ in self.queries)
+
+    def duplicates(self):
+        """Query shapes repeated often enough to look like N+1."""
+        counts = Counter(fingerprint(sql) for _, sql in self.queries)
+        return {
+            shape: count for shape, count in counts.most_common()
+            if count >= settings.PROFILING['DUPLICATE_QUERIES']
+        }
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Per-endpoint aggregates kept in the worker process.
+
+    Every request is timed, database and serializer figures come from
+    sampled requests only.
+    """
+
+    HISTOGRAMS = {
+        'foodgram_request_duration_seconds': (
+            'Request processing time.', DURATION_BUCKETS),
+        'foodgram_request_db_seconds': (
+            'Time spent in SQL queries of sampled requests.',
+            DURATION_BUCKETS),
+        'foodgram_request_serializer_seconds': (
+            'Time spent in serializers of sampled requests.',
+            DURATION_BUCKETS),
+        'foodgram_request_queries': (
+            'SQL queries per sampled request.', QUERY_BUCKETS),
+    }
+    COUNTERS = {
+        'foodgram_slow_requests_total': 'Requests over the slow threshold.',
+        'foodgram_duplicate_queries_total': (
+            'Sampled requests repeating a query shape (N+1).'),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {
+            name: defaultdict(lambda buckets=buckets: Histogram(buckets))
+            for name, (_, buckets) in self.HISTOGRAMS.items()
+        }
+        self.counters = {name: Counter() for name in self.COUNTERS}
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self.histograms[name][labels].observe(value)
+
+    def increment(self, name, labels):
+        with self._lock:
+            self.counters[name][labels] += 1
+
+    def render(self):
+        """Return metrics in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in self.HISTOGRAMS.items():
+                lines += [f'# HELP {name} {help_text}',
+                          f'# TYPE {name} histogram']
+                for labels, histogram in sorted(
+                        self.histograms[name].items()):
+                    label_text = format_labels(labels)
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        lines.append(f'{name}_bucket{{{label_text},'
+                                     f'le="{bound}"}} {count}')
+                    lines += [
+                        f'{name}_bucket{{{label_text},le="+Inf"}} '
+                        f'{histogram.count}',
+                        f'{name}_sum{{{label_text}}} {histogram.total}',
+                        f'{name}_count{{{label_text}}} {histogram.count}',
+                    ]
+            for name, help_text in self.COUNTERS.items():
+                lines += [f'# HELP {name} {help_text}',
+                          f'# TYPE {name} counter']
+                for labels, count in sorted(self.counters[name].items()):
+                    lines.append(f'{name}{{{format_labels(labels)}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    endpoint, method = labels
+    return f'endpoint="{endpoint}",method="{method}"'
+
+
+metrics = Metrics()
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+@contextmanager
+def profiled_connections():
+    """Record queries of this thread's connections in the current profile."""
+    profile = current_profile.get()
+    with ExitStack() as stack:
+        if profile is not None:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile))
+        yield
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """
+    Time requests and profile a sample of them.
+
+    Sampled requests record every SQL query through an execute wrapper
+    and the time spent in top-level serializers. Requests slower than
+    PROFILING['SLOW_REQUEST_MS'] are logged, sampled ones with their
+    worst and repeated queries. Under ASGI only queries of async views,
+    made through api.concurrency.in_thread, are recorded.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING['ENABLED']:
+            raise MiddlewareNotUsed
+        instrument_serializers()
+        super().__init__(get_response)
+
+    def handle(self, request):
+        profile = self.sample()
+        started = time.perf_counter()
+        token = current_profile.set(profile)
+        try:
+            with profiled_connections():
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        self.record(request, time.perf_counter() - started, profile)
+        return response
+
+    async def ahandle(self, request):
+        profile = self.sample()
+        started = time.perf_counter()
+        token = current_profile.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        self.record(request, time.perf_counter() - started, profile)
+        return response
+
+    @staticmethod
+    def sample():
+        if random.random() < settings.PROFILING['SAMPLE_RATE']:
+            return Profile()
+        return None
+
+    def record(self, request, duration, profile):
+        labels = (endpoint_name(request), request.method)
+        metrics.observe('foodgram_request_duration_seconds', labels, duration)
+        duplicates = {}
+        if profile is not None:
+            duplicates = profile.duplicates()
+            metrics.observe('foodgram_request_db_seconds', labels,
+                            profile.db_time)
+            metrics.observe('foodgram_request_serializer_seconds', labels,
+                            profile.serializer_time)
+            metrics.observe('foodgram_request_queries', labels,
+                            len(profile.queries))
+            if duplicates:
+                metrics.increment('foodgram_duplicate_queries_total', labels)
+        if duration * 1000 < settings.PROFILING['SLOW_REQUEST_MS']:
+            return
+        metrics.increment('foodgram_slow_requests_total', labels)
+        if profile is None:
+            logger.warning('Slow request %s %s: %.0f ms (not sampled)',
+                           request.method, request.get_full_path(),
+                           duration * 1000)
+            return
+        worst = sorted(profile.queries, reverse=True)[:3]
+        logger.warning(
+            'Slow request %s %s: %.0f ms, db %.0f ms in %d queries, '
+            'serializers %.0f ms\nworst queries:\n%s%s',
+            request.method, request.get_full_path(), duration * 1000,
+            profile.db_time * 1000, len(profile.queries),
+            profile.serializer_time * 1000,
+            '\n'.join(f'  {seconds * 1000:.1f} ms {sql}'
+                      for seconds, sql in worst),
+            ''.join(f'\nrepeated {count} times: {shape}'
+                    for shape, count in duplicates.items()),
+        )
+
+
+def instrument_serializers():
+    """Time BaseSerializer.data of top-level serializers while profiling."""
+    original = BaseSerializer.data.fget
+    if getattr(original, 'profiled', False):
+        return
+
+    def data(self):
+        profile = current_profile.get()
+        # nested .data calls are already counted by the outer one
+        if profile is None or profile.serializer_depth:
+            return original(self)
+        profile.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return original(self)
+        finally:
+            profile.serializer_time += time.perf_counter() - started
+            profile.serializer_depth -= 1
+
+    data.profiled = True
+    BaseSerializer.data = property(data)
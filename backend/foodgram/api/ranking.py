@@ -0,0 +1,167 @@
+"""Materialized popularity rankings of recipes."""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Max, Sum, Value, When
+from django.utils import timezone
+
+from recipes.models import RankingState, RecipeEvent, RecipeRank, Recipes
+
+# m2m through model -> kind of logged event
+RANKED_RELATIONS = {
+    Recipes.favorited.through: RecipeEvent.FAVORITE,
+    Recipes.shopping_cart.through: RecipeEvent.SHOPPING_CART,
+}
+
+
+def weights():
+    return settings.RECIPE_RANKING['WEIGHTS']
+
+
+def log_events(sender, instance, reverse, pk_set, delta):
+    """Record favorite/cart changes reported by the counters handler."""
+    recipe_ids = pk_set if reverse else [instance.pk] * len(pk_set)
+    RecipeEvent.objects.bulk_create(
+        RecipeEvent(recipe_id=recipe_id, kind=RANKED_RELATIONS[sender],
+                    delta=delta)
+        for recipe_id in recipe_ids
+    )
+
+
+def event_scores(events):
+    """Sum weighted events per recipe."""
+    weight = Case(
+        *(When(kind=kind, then=Value(value))
+          for kind, value in weights().items()),
+        default=Value(0), output_field=IntegerField(),
+    )
+    return dict(
+        events.order_by().values('recipe_id').annotate(
+            score=Sum(weight * F('delta'))).values_list('recipe_id', 'score')
+    )
+
+
+def trending_cutoff(now):
+    return now - timedelta(days=settings.RECIPE_RANKING['TRENDING_DAYS'])
+
+
+def settled_event_id(now):
+    """
+    Last event id no open transaction can still commit below.
+
+    Ids are taken at insert, so a slow transaction may commit an event
+    under an id already read. Only events older than SETTLE_SECONDS are
+    passed, later ones are read by the next run.
+    """
+    settled = now - timedelta(
+        seconds=settings.RECIPE_RANKING['SETTLE_SECONDS'])
+    return RecipeEvent.objects.filter(created__lt=settled).aggregate(
+        last=Max('id'))['last'] or 0
+
+
+def apply_changes(window, changes):
+    """Add score changes to stored ranks, drop ranks which fell to zero."""
+    changes = {pk: score for pk, score in changes.items() if score}
+    if not changes:
+        return
+    ranks = RecipeRank.objects.filter(window=window)
+    existing = {
+        rank.recipe_id: rank
+        for rank in ranks.filter(recipe_id__in=changes.keys())
+    }
+    new = []
+    for recipe_id, change in changes.items():
+        if recipe_id in existing:
+            existing[recipe_id].score += change
+        else:
+            new.append(RecipeRank(window=window, recipe_id=recipe_id,
+                                  score=change))
+    RecipeRank.objects.bulk_update(existing.values(), ['score'])
+    # events of deleted recipes are gone together with the recipes
+    alive = set(Recipes.objects.filter(
+        pk__in=[rank.recipe_id for rank in new]).values_list('pk', flat=True))
+    RecipeRank.objects.bulk_create(
+        rank for rank in new if rank.recipe_id in alive)
+    ranks.filter(score__lte=0).delete()
+
+
+@transaction.atomic
+def refresh(window):
+    """
+    Bring ranks of the window up to date incrementally.
+
+    Only events logged since the previous run are added and, for trending,
+    only events which slid out of the time window since then are
+    subtracted, so a run costs proportionally to the activity in between.
+    """
+    state, created = RankingState.objects.select_for_update().get_or_create(
+        window=window)
+    if created:
+        return rebuild(window)
+    now = timezone.now()
+    last_event_id = max(settled_event_id(now), state.last_event_id)
+    events = RecipeEvent.objects.filter(
+        id__gt=state.last_event_id, id__lte=last_event_id)
+    changes = {}
+    if window == RecipeRank.TRENDING:
+        cutoff = trending_cutoff(now)
+        changes = {
+            pk: -score for pk, score in event_scores(
+                RecipeEvent.objects.filter(
+                    id__lte=state.last_event_id,
+                    created__gt=state.cutoff, created__lte=cutoff)
+            ).items()
+        }
+        events = events.filter(created__gt=cutoff)
+        state.cutoff = cutoff
+    for pk, score in event_scores(events).items():
+        changes[pk] = changes.get(pk, 0) + score
+    apply_changes(window, changes)
+    state.last_event_id = last_event_id
+    state.save()
+    return len(changes)
+
+
+@transaction.atomic
+def rebuild(window):
+    """Recalculate ranks of the window from scratch."""
+    state, _ = RankingState.objects.select_for_update().get_or_create(
+        window=window)
+    now = timezone.now()
+    if window == RecipeRank.POPULAR:
+        # counters hold the whole history, events may be pruned already,
+        # they commit together with their events, so events up to the
+        # last one are counted
+        state.last_event_id = RecipeEvent.objects.aggregate(
+            last=Max('id'))['last'] or 0
+        score = (F('favorites_count') * weights()[RecipeEvent.FAVORITE]
+                 + F('shopping_cart_count')
+                 * weights()[RecipeEvent.SHOPPING_CART])
+        scores = dict(Recipes.objects.annotate(score=score).filter(
+            score__gt=0).values_list('id', 'score'))
+    else:
+        state.last_event_id = settled_event_id(now)
+        state.cutoff = trending_cutoff(now)
+        scores = event_scores(RecipeEvent.objects.filter(
+            id__lte=state.last_event_id, created__gt=state.cutoff))
+    RecipeRank.objects.filter(window=window).delete()
+    RecipeRank.objects.bulk_create(
+        RecipeRank(window=window, recipe_id=recipe_id, score=score)
+        for recipe_id, score in scores.items() if score > 0
+    )
+    state.save()
+    return len(scores)
+
+
+def prune_events():
+    """Delete events which no ranking window will read again."""
+    states = {state.window: state for state in RankingState.objects.all()}
+    if any(window not in states for window, _ in RecipeRank.WINDOWS):
+        return 0
+    # trending still has to subtract events newer than its cutoff
+    deleted, _ = RecipeEvent.objects.filter(
+        id__lte=min(state.last_event_id for state in states.values()),
+        created__lte=states[RecipeRank.TRENDING].cutoff,
+    ).delete()
+    return deleted
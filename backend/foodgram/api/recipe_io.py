@@ -0,0 +1,316 @@
+"""Bulk export of recipes as NDJSON and validated bulk import."""
+import json
+import posixpath
+from collections import Counter, defaultdict
+from itertools import islice
+
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+
+from recipes.models import RecipeIngredients, Recipes, User
+
+from .counters import increment
+from .feed import schedule_fan_out
+from .reference import ingredients_reference, tags_reference
+from .serializers import (AMOUNT_LOWER_BOUND, AMOUNT_UPPER_BOUND,
+                          TEXT_LENGTH_UPPER_BOUND)
+
+COOKING_TIME_BOUNDS = (1, 10080)
+NAME_LENGTH_UPPER_BOUND = Recipes._meta.get_field('name').max_length
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def export_recipes(queryset, chunk_size):
+    """
+    Yield recipes as rows RecipeImporter takes, in id order.
+
+    Recipes are read through a server-side cursor, tags and ingredients
+    with two queries per chunk, so memory doesn't grow with the table.
+    Images are referenced by storage name.
+    """
+    recipes = queryset.order_by('id').values(
+        'id', 'author_id', 'name', 'text', 'cooking_time', 'image',
+        'pub_date').iterator(chunk_size=chunk_size)
+    for batch in chunks(recipes, chunk_size):
+        ids = [recipe['id'] for recipe in batch]
+        tags, ingredients = defaultdict(list), defaultdict(list)
+        for recipe_id, slug in Recipes.tags.through.objects.filter(
+                recipes_id__in=ids).values_list('recipes_id', 'tags__slug'):
+            tags[recipe_id].append(slug)
+        for recipe_id, name, unit, amount in RecipeIngredients.objects.filter(
+                recipe_id__in=ids).order_by('id').values_list(
+                'recipe_id', 'ingredient__name',
+                'ingredient__measurement_unit', 'amount'):
+            ingredients[recipe_id].append(
+                {'name': name, 'measurement_unit': unit, 'amount': amount})
+        for recipe in batch:
+            yield {
+                'author': recipe['author_id'],
+                'name': recipe['name'],
+                'text': recipe['text'],
+                'cooking_time': recipe['cooking_time'],
+                'image': recipe['image'],
+                # isoformat keeps microseconds DjangoJSONEncoder drops
+                'pub_date': recipe['pub_date'].isoformat(),
+                'tags': tags[recipe['id']],
+                'ingredients': ingredients[recipe['id']],
+            }
+
+
+def ndjson(rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+class RecipeImporter:
+    """
+    Validate recipe rows and insert them in batches.
+
+    Rows have 'author' (user id), 'name', 'text', 'cooking_time', 'image'
+    (storage name of an already uploaded file), 'tags' (slugs, a list or
+    separated by commas), 'ingredients' (objects with 'name' and 'amount'
+    or name:amount pairs separated by semicolons) and optionally
+    'pub_date'. Tags and ingredients of a batch are resolved at once
+    through the reference caches. Invalid rows are collected in 'errors'
+    as (row number, messages), recipes the author already has with the
+    same name are skipped.
+    """
+
+    def __init__(self, author_id=None):
+        # forces the author of every row when given
+        self.author_id = author_id
+        self.created = 0
+        self.skipped = 0
+        self.errors = []
+
+    def load(self, rows):
+        """Insert a batch of (row number, row) pairs, return created ids."""
+        valid = {}
+        for number, row in rows:
+            try:
+                valid[number] = self.clean(row)
+            except ValueError as error:
+                self.errors.append((number, error.args[0]))
+        recipes = self.new_recipes(self.resolve(valid).values())
+        if not recipes:
+            return []
+        created = self.insert(recipes)
+        # bulk inserts don't send signals maintaining counters and feeds
+        for author_id, count in Counter(
+                author for author, _ in recipes).items():
+            increment(User, [author_id], 'recipes_count', count)
+        schedule_fan_out(created)
+        self.created += len(created)
+        return [recipe.pk for recipe in created]
+
+    def new_recipes(self, recipes):
+        """Key recipes on (author, name), skipping ones that exist."""
+        keys = {(recipe['author'], recipe['name']) for recipe in recipes}
+        existing = set(Recipes.objects.filter(
+            author_id__in={author for author, _ in keys},
+            name__in={name for _, name in keys},
+        ).values_list('author_id', 'name'))
+        new = {}
+        for recipe in recipes:
+            key = (recipe['author'], recipe['name'])
+            if key in existing or key in new:
+                self.skipped += 1
+                continue
+            new[key] = recipe
+        return new
+
+    def insert(self, recipes):
+        created = [
+            Recipes(author_id=author, name=name, text=recipe['text'],
+                    cooking_time=recipe['cooking_time'],
+                    image=recipe['image'])
+            for (author, name), recipe in recipes.items()
+        ]
+        Recipes.objects.bulk_create(created)
+        # not every backend returns primary keys from bulk inserts
+        if any(recipe.pk is None for recipe in created):
+            ids = {
+                (author_id, name): pk
+                for pk, author_id, name in Recipes.objects.filter(
+                    author_id__in={author for author, _ in recipes},
+                    name__in={name for _, name in recipes},
+                ).values_list('id', 'author_id', 'name')
+            }
+            for recipe in created:
+                recipe.pk = ids[(recipe.author_id, recipe.name)]
+        dated = []
+        for recipe in created:
+            row = recipes[(recipe.author_id, recipe.name)]
+            row['id'] = recipe.pk
+            # auto_now_add overwrote the date the recipe was published on
+            if row['pub_date']:
+                recipe.pub_date = row['pub_date']
+                dated.append(recipe)
+        if dated:
+            Recipes.objects.bulk_update(dated, ['pub_date'])
+        Recipes.tags.through.objects.bulk_create(
+            Recipes.tags.through(recipes_id=recipe['id'], tags_id=tag_id)
+            for recipe in recipes.values() for tag_id in recipe['tags']
+        )
+        RecipeIngredients.objects.bulk_create(
+            RecipeIngredients(recipe_id=recipe['id'], ingredient_id=pk,
+                              amount=amount)
+            for recipe in recipes.values()
+            for pk, amount in recipe['ingredients']
+        )
+        return created
+
+    def clean(self, row):
+        """Check a row on its own, raise ValueError with messages."""
+        if not isinstance(row, dict):
+            raise ValueError(['A recipe must be a JSON object.'])
+        errors = []
+        recipe = {
+            'author': self.author_id or row.get('author'),
+            'name': str(row.get('name') or '').strip(),
+            'text': str(row.get('text') or ''),
+            'image': str(row.get('image') or ''),
+            'pub_date': None,
+        }
+        clean_length(recipe['name'], NAME_LENGTH_UPPER_BOUND,
+                     'Name is required.', 'Name is too long.', errors)
+        clean_length(recipe['text'], TEXT_LENGTH_UPPER_BOUND,
+                     'Text is required.',
+                     'Text for a recipe is too long. Consider writing a book.',
+                     errors)
+        try:
+            recipe['author'] = int(recipe['author'])
+        except (TypeError, ValueError):
+            errors.append('Author must be a user id.')
+        recipe['cooking_time'] = clean_cooking_time(
+            row.get('cooking_time'), errors)
+        if row.get('pub_date'):
+            recipe['pub_date'] = parse_datetime(str(row['pub_date']))
+            if recipe['pub_date'] is None:
+                errors.append('Publication date must be in ISO 8601.')
+        if not is_uploaded_image(recipe['image']):
+            errors.append('Image must be an uploaded file in recipes/.')
+        recipe['tags'] = clean_tags(row.get('tags'), errors)
+        recipe['ingredients'] = clean_ingredients(
+            row.get('ingredients'), errors)
+        if errors:
+            raise ValueError(errors)
+        return recipe
+
+    def resolve(self, recipes):
+        """Replace slugs and names with ids, drop rows with unknown ones."""
+        tag_ids = tags_reference.pks_by(
+            'slug', {slug for recipe in recipes.values()
+                     for slug in recipe['tags']})
+        ingredient_ids = ingredients_reference.pks_by(
+            'name', {name for recipe in recipes.values()
+                     for name in recipe['ingredients']})
+        authors = set(User.objects.filter(
+            pk__in={recipe['author'] for recipe in recipes.values()}
+        ).values_list('pk', flat=True))
+        resolved = {}
+        for number, recipe in recipes.items():
+            errors = [f'Unknown tag {slug}.' for slug in recipe['tags']
+                      if slug not in tag_ids]
+            errors += [f'Unknown ingredient {name}.'
+                       for name in recipe['ingredients']
+                       if name not in ingredient_ids]
+            if recipe['author'] not in authors:
+                errors.append(f'Unknown author {recipe["author"]}.')
+            if errors:
+                self.errors.append((number, errors))
+                continue
+            recipe['tags'] = [tag_ids[slug] for slug in recipe['tags']]
+            recipe['ingredients'] = [
+                (ingredient_ids[name], amount)
+                for name, amount in recipe['ingredients'].items()]
+            resolved[number] = recipe
+        return resolved
+
+
+def clean_length(value, upper_bound, required, too_long, errors):
+    if not value:
+        errors.append(required)
+    elif len(value) > upper_bound:
+        errors.append(too_long)
+
+
+def clean_cooking_time(value, errors):
+    try:
+        minutes = int(value)
+    except (TypeError, ValueError):
+        minutes = None
+    if minutes is None or not (
+            COOKING_TIME_BOUNDS[0] <= minutes <= COOKING_TIME_BOUNDS[1]):
+        errors.append('Cooking time must be from %d to %d minutes.'
+                      % COOKING_TIME_BOUNDS)
+    return minutes
+
+
+def is_uploaded_image(name):
+    return (name and posixpath.normpath(name) == name
+            and name.startswith('recipes/') and default_storage.exists(name))
+
+
+def clean_tags(tags, errors):
+    """Return a set of slugs from a list or a comma separated string."""
+    tags = tags or []
+    if isinstance(tags, str):
+        tags = [slug.strip() for slug in tags.split(',')]
+    slugs = {str(slug) for slug in tags if slug}
+    if not slugs:
+        errors.append('At least one tag is required.')
+    return slugs
+
+
+def clean_ingredients(ingredients, errors):
+    """
+    Return amounts by ingredient name.
+
+    Takes a list of objects with 'name' and 'amount' or name:amount pairs
+    separated by semicolons.
+    """
+    ingredients = ingredients or []
+    if isinstance(ingredients, str):
+        ingredients = [
+            dict(zip(('name', 'amount'), pair.strip().rpartition(':')[::2]))
+            for pair in ingredients.split(';') if pair.strip()
+        ]
+    amounts = {}
+    for item in ingredients:
+        try:
+            name = str(item['name'])
+            amount = int(float(item['amount']))
+            if not AMOUNT_LOWER_BOUND <= amount <= AMOUNT_UPPER_BOUND:
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            errors.append(
+                f'Bad ingredient {item!r}: amount must be from '
+                f'{AMOUNT_LOWER_BOUND} to {AMOUNT_UPPER_BOUND}.')
+            continue
+        if name in amounts:
+            errors.append('Ingredients of a recipe must not repeat.')
+        amounts[name] = amount
+    if not ingredients:
+        errors.append('At least one ingredient is required.')
+    return amounts
+
+
+def parse_lines(lines):
+    """Yield (line number, row) of NDJSON lines, None for broken ones."""
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
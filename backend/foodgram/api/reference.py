@@ -0,0 +1,208 @@
+"""Cache of almost static reference tables (tags and ingredients)."""
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.module_loading import import_string
+from rest_framework.renderers import JSONRenderer
+
+from foodgram.db.routers import primary_reads
+from recipes.models import Ingredients, Tags
+
+
+class LocalBackend:
+    """Per-process storage, invalidation is visible only to this process."""
+
+    def __init__(self):
+        self._store = {}
+
+    def get(self, key):
+        expires, value = self._store.get(key, (0, None))
+        if expires < time.monotonic():
+            return None
+        return value
+
+    def set(self, key, value, timeout):
+        expires = math.inf if timeout is None else time.monotonic() + timeout
+        self._store[key] = (expires, value)
+
+    def delete(self, key):
+        self._store.pop(key, None)
+
+
+class SharedBackend:
+    """Storage in one of Django's CACHES shared by all workers."""
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def get(self, key):
+        return caches[self.alias].get(key)
+
+    def set(self, key, value, timeout):
+        caches[self.alias].set(key, value, timeout)
+
+    def delete(self, key):
+        caches[self.alias].delete(key)
+
+
+def get_backend():
+    if settings.REFERENCE_CACHE['BACKEND'] == 'shared':
+        return SharedBackend(settings.REFERENCE_CACHE['CACHE_ALIAS'])
+    return LocalBackend()
+
+
+class ReferenceData:
+    """
+    Cached view of a reference table.
+
+    Keeps the list endpoint's rendered JSON body together with its ETag and
+    Last-Modified values, and an id -> instance map for write validation.
+    Both are stored under separate keys so list requests never unpickle
+    model instances when a shared backend is used. Keys include a version
+    changed on invalidation, so a build which read the table before the
+    change can't store stale data where later reads find it.
+    """
+
+    def __init__(self, name, model, serializer_class, backend, timeout):
+        self.name = name
+        self.model = model
+        self.serializer_class = serializer_class
+        self.backend = backend
+        self.timeout = timeout
+
+    @property
+    def version_key(self):
+        return f'reference:{self.name}:version'
+
+    def version(self):
+        version = self.backend.get(self.version_key)
+        if version is None:
+            version = time.time_ns()
+            self.backend.set(self.version_key, version, None)
+        return version
+
+    def response_key(self, version):
+        return f'reference:{self.name}:{version}:response'
+
+    def objects_key(self, version):
+        return f'reference:{self.name}:{version}:objects'
+
+    def response(self):
+        """Return dict with rendered 'body', 'etag' and 'last_modified'."""
+        version = self.version()
+        cached = self.backend.get(self.response_key(version))
+        if cached is None:
+            cached = self._build(version)[0]
+        return cached
+
+    def objects(self):
+        """Return mapping of primary keys to model instances."""
+        version = self.version()
+        cached = self.backend.get(self.objects_key(version))
+        if cached is None:
+            cached = self._build(version)[1]
+        return cached
+
+    def in_bulk(self, pks):
+        """
+        Map given primary keys to instances.
+
+        Keys missing from the cache (it may be stale in other processes with
+        the local backend) are looked up with one query.
+        """
+        try:
+            pks = {int(pk) for pk in pks}
+        except (TypeError, ValueError):
+            raise Http404(
+                f'No {self.model._meta.object_name} matches the given query.'
+            ) from None
+        cached = self.objects()
+        found = {pk: cached[pk] for pk in pks if pk in cached}
+        if len(found) < len(pks):
+            found.update(self.model.objects.in_bulk(pks - found.keys()))
+        return found
+
+    def in_bulk_or_404(self, pks):
+        found = self.in_bulk(pks)
+        if len(found) < len(set(map(int, pks))):
+            raise Http404(
+                f'No {self.model._meta.object_name} matches the given query.')
+        return found
+
+    def pks_by(self, field, values):
+        """
+        Map values of a unique field to primary keys.
+
+        Values missing from the cache are looked up with one query.
+        """
+        values = set(values)
+        found = {
+            getattr(instance, field): pk
+            for pk, instance in self.objects().items()
+            if getattr(instance, field) in values
+        }
+        if len(found) < len(values):
+            found.update(self.model.objects.filter(
+                **{f'{field}__in': values - found.keys()}
+            ).values_list(field, 'pk'))
+        return found
+
+    def get_or_404(self, pk):
+        return self.in_bulk_or_404([pk])[int(pk)]
+
+    def invalidate(self):
+        """Move to a new version now and again after commit."""
+        def bump():
+            self.backend.set(self.version_key, time.time_ns(), None)
+
+        # a build reading the table before commit could still miss the change
+        bump()
+        transaction.on_commit(bump)
+
+    def _build(self, version):
+        with primary_reads():
+            instances = list(self.model.objects.all())
+        serializer = import_string(self.serializer_class)
+        body = JSONRenderer().render(serializer(instances, many=True).data)
+        response = {
+            'body': body,
+            'etag': f'"{hashlib.md5(body).hexdigest()}"',
+            'last_modified': int(time.time()),
+        }
+        objects = {instance.pk: instance for instance in instances}
+        self.backend.set(self.response_key(version), response, self.timeout)
+        self.backend.set(self.objects_key(version), objects, self.timeout)
+        return response, objects
+
+
+def list_response(request, reference):
+    """Return cached list body or 304 if the client copy is still fresh."""
+    cached = reference.response()
+    response = get_conditional_response(
+        request,
+        etag=cached['etag'],
+        last_modified=cached['last_modified'],
+    )
+    if response is None:
+        response = HttpResponse(cached['body'],
+                                content_type='application/json')
+    response['ETag'] = cached['etag']
+    response['Last-Modified'] = http_date(cached['last_modified'])
+    return response
+
+
+tags_reference = ReferenceData(
+    'tags', Tags, 'api.serializers.TagSerializer',
+    backend=get_backend(), timeout=settings.REFERENCE_CACHE['TIMEOUT'],
+)
+ingredients_reference = ReferenceData(
+    'ingredients', Ingredients, 'api.serializers.IngredientSerializer',
+    backend=get_backend(), timeout=settings.REFERENCE_CACHE['TIMEOUT'],
+)
@@ -0,0 +1,181 @@
+"""Shared cache of rendered read responses with user flags overlaid."""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+from foodgram.db.routers import primary_reads
+
+from .user_state import ANONYMOUS_STATE, get_user_state
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE['CACHE_ALIAS']]
+
+
+def generation_key(name):
+    return f'generation:{name}'
+
+
+def current_generations(names):
+    """Return generation numbers, starting missing ones from the clock."""
+    cache = get_cache()
+    keys = [generation_key(name) for name in names]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # the clock keeps an evicted counter from reusing old values
+            cache.add(key, time.time_ns(), None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump_generations(*names):
+    """Make entries depending on the given data stale, now and on commit."""
+    def bump():
+        cache = get_cache()
+        for name in names:
+            try:
+                cache.incr(generation_key(name))
+            except ValueError:
+                cache.add(generation_key(name), time.time_ns(), None)
+
+    # a response cached before commit could still miss the change
+    bump()
+    transaction.on_commit(bump)
+
+
+class Generation:
+    """Generation of one kind of data, for callers invalidating caches."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def invalidate(self):
+        bump_generations(self.name)
+
+
+def overlay_user(user, subscriptions):
+    user['is_subscribed'] = user['id'] in subscriptions
+    return (user['is_subscribed'],)
+
+
+def overlay_recipe(recipe, state, subscriptions):
+    recipe['is_favorited'] = recipe['id'] in state.favorites
+    recipe['is_in_shopping_cart'] = recipe['id'] in state.shopping_cart
+    return (recipe['is_favorited'], recipe['is_in_shopping_cart'],
+            *overlay_user(recipe['author'], subscriptions))
+
+
+def overlay(data, state, subscriptions=()):
+    """
+    Set flags of a user in serialized recipes or users.
+
+    Return the flags, they tell apart bodies of different users.
+    """
+    flags = []
+    for item in data['results'] if 'results' in data else [data]:
+        if 'author' in item:
+            flags.extend(overlay_recipe(item, state, subscriptions))
+        else:
+            flags.extend(overlay_user(item, subscriptions))
+    return flags
+
+
+class ResponseCache:
+    """
+    Rendered responses of a read endpoint as an anonymous user gets them.
+
+    Entries are keyed on the URL with its query parameters sorted and on
+    generations of the data they show, so a change of that data makes
+    them unreachable instead of deleting them. Authenticated users get
+    the same body with their flags overlaid. Every response has an ETag,
+    matching If-None-Match gets 304 without a body.
+    """
+
+    def __init__(self, name, generations):
+        self.name = name
+        self.generations = generations
+
+    def key(self, request, params):
+        query = sorted(
+            (name, sorted(request.GET.getlist(name)))
+            for name in params if name in request.GET
+        )
+        # host and scheme end up in the pagination links
+        url = f'{request.scheme}://{request.get_host()}{request.path}{query}'
+        generations = '.'.join(
+            map(str, current_generations(self.generations)))
+        return (f'response:{self.name}:{generations}:'
+                f'{hashlib.md5(url.encode()).hexdigest()}')
+
+    @staticmethod
+    def cacheable(request, params):
+        return (settings.RESPONSE_CACHE['ENABLED']
+                and set(request.GET) <= set(params))
+
+    def lookup(self, request, params):
+        """Return the entry of a cacheable request, None on a miss."""
+        return get_cache().get(self.key(request, params))
+
+    def respond(self, request, params, build):
+        """Serve the request from cache, call 'build' on a miss."""
+        if (not self.cacheable(request, params)
+                or request.accepted_renderer.format != 'json'):
+            return build()
+        key = self.key(request, params)
+        entry = get_cache().get(key)
+        if entry is None:
+            with primary_reads():
+                response = build()
+            if response.status_code != 200:
+                return response
+            data = response.data
+            if request.user.is_authenticated:
+                overlay(data, ANONYMOUS_STATE)
+            body = JSONRenderer().render(data)
+            entry = {
+                'body': body,
+                'etag': f'"{hashlib.md5(body).hexdigest()}"',
+            }
+            get_cache().set(key, entry, settings.RESPONSE_CACHE['TIMEOUT'])
+        return self.serve(request, entry)
+
+    def serve(self, request, entry):
+        body, etag = entry['body'], entry['etag']
+        data = None
+        if request.user.is_authenticated:
+            data = json.loads(body)
+            state = get_user_state(request)
+            # CustomUserSerializer shows subscriptions to token holders only
+            flags = overlay(data, state,
+                            state.subscriptions if request.auth else ())
+            etag = '"{}"'.format(hashlib.md5(
+                f'{etag}{flags}'.encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            if data is not None:
+                body = JSONRenderer().render(data)
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
+
+# generations: recipes - recipes with their tags and ingredients,
+# reference - tags and ingredients themselves, users - profiles,
+# ranking - popularity scores
+recipe_list_cache = ResponseCache(
+    'recipe-list', ('recipes', 'reference', 'users', 'ranking'))
+recipe_detail_cache = ResponseCache(
+    'recipe-detail', ('recipes', 'reference', 'users'))
+user_cache = ResponseCache('user', ('users',))
+recipes_generation = Generation('recipes')
+reference_generation = Generation('reference')
+users_generation = Generation('users')
@@ -1,15 +1,22 @@
-from django.shortcuts import get_object_or_404
+from django.core.files.storage import default_storage
+from django.db import transaction
 from djoser.serializers import (SetPasswordSerializer, UserCreateSerializer,
                                 UserSerializer)
-from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 
-from recipes.models import Ingredients, RecipeIngredients, Recipes, Tags
+from recipes.models import Ingredients, Job, RecipeIngredients, Recipes, Tags
 from users.models import CustomUser
 
+from .images import (ImageVariantField, StreamingBase64ImageField,
+                     schedule_variants)
+from .matching import schedule_matcher_update
+from .reference import ingredients_reference, tags_reference
+from .user_state import get_user_state
+
 AMOUNT_LOWER_BOUND = 1
 AMOUNT_UPPER_BOUND = 1000000
 TEXT_LENGTH_UPPER_BOUND = 20000
+TOGGLES_UPPER_BOUND = 100
 
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
@@ -17,7 +24,7 @@ class TagSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def to_internal_value(self, data):
-        return get_object_or_404(Tags, pk=data)
+        return tags_reference.get_or_404(data)
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -39,7 +46,7 @@ class CustomUserSerializer(UserSerializer):
         request = self.context.get('request')
         if not request.auth:
             return False
-        return request.user in obj.subscribed.all()
+        return obj.pk in get_user_state(request).subscriptions
 
 
 class RecipeIngredientSerializer(serializers.ModelSerializer):
@@ -49,12 +56,17 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
     def validate(self, attrs):
         """Validate ingredients quantities."""
-        quantity = float(attrs.get('amount'))
+        try:
+            quantity = float(attrs.get('amount'))
+        except (TypeError, ValueError):
+            raise serializers.ValidationError(
+                'Amount for an ingredient must be a number.') from None
         if any((quantity < AMOUNT_LOWER_BOUND, quantity > AMOUNT_UPPER_BOUND)):
             raise serializers.ValidationError(
                 ('Amount for an ingredient cannot be less then 1 or '
                 'greater then 1 million no matter how we measure it.')
             )
+        attrs['amount'] = int(quantity)
         return attrs
 
     # rewrote method to comply with technical specifications
@@ -66,18 +78,20 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
             'amount': value.amount
         }
 
-    # rewrote method to comply with technical specifications
+    # rewrote method to comply with technical specifications, ingredients
+    # are resolved all at once in RecipeCreateSerializer.validate_ingredients
     def to_internal_value(self, data):
-        inst = get_object_or_404(Ingredients, pk=data.get('id'))
         return {
-            'name': inst.name,
-            'measurement_unit': inst.measurement_unit,
+            'id': data.get('id'),
             'amount': data.get('amount'),
         }
 
 
 class RecipeSerializer(serializers.ModelSerializer):
-    image = Base64ImageField(max_length=None, use_url=True)
+    image = StreamingBase64ImageField(max_length=None, use_url=True)
+    image_small = ImageVariantField('small')
+    image_small_webp = ImageVariantField('small_webp')
+    image_webp = ImageVariantField('webp')
     tags = TagSerializer(many=True)
     ingredients = RecipeIngredientSerializer(
         many=True, source='recipeingredients_set')
@@ -96,6 +110,9 @@ class RecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_small',
+            'image_small_webp',
+            'image_webp',
             'text',
             'cooking_time',
         )
@@ -104,25 +121,23 @@ class RecipeSerializer(serializers.ModelSerializer):
         """
         Check whether the request user has the recipe in favorites.
         """
-        return obj.favorited.filter(
-            id=self.context.get('request').user.id).exists()
+        return obj.pk in get_user_state(
+            self.context.get('request')).favorites
 
     def get_is_in_shopping_cart(self, obj):
         """
         Check whether the request user has the recipe in a cart.
         """
-        return obj.shopping_cart.filter(
-            id=self.context.get('request').user.id).exists()
+        return obj.pk in get_user_state(
+            self.context.get('request')).shopping_cart
 
 
 class RecipeCreateSerializer(serializers.ModelSerializer):
-    image = Base64ImageField()
+    image = StreamingBase64ImageField()
     tags = TagSerializer(many=True)
     ingredients = RecipeIngredientSerializer(
         many=True, source='recipeingredients_set')
     author = CustomUserSerializer(required=False)
-    is_favorited = serializers.SerializerMethodField()
-    is_in_shopping_cart = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipes
@@ -135,83 +150,104 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
             'name',
             'text',
             'cooking_time',
-            'is_favorited',
-            'is_in_shopping_cart',
         )
 
+    def validate_ingredients(self, value):
+        """Resolve all ingredients with a single lookup."""
+        ids = [item['id'] for item in value]
+        if len(set(map(str, ids))) < len(ids):
+            raise serializers.ValidationError(
+                'Ingredients of a recipe must not repeat.')
+        ingredients = ingredients_reference.in_bulk_or_404(ids)
+        for item in value:
+            item['ingredient'] = ingredients[int(item.pop('id'))]
+        return value
+
     def validate(self, attrs):
         """Validate user's input."""
         recipe = Recipes.objects.filter(name=attrs.get('name'),
                                         author=self.context['request'].user)
-        if recipe:
+        if self.instance is not None:
+            recipe = recipe.exclude(pk=self.instance.pk)
+        if recipe.exists():
             raise serializers.ValidationError(
                 'Name of a recipe must be unique for any particular user.')
-        if len(attrs.get('text')) > TEXT_LENGTH_UPPER_BOUND:
+        if len(attrs.get('text', '')) > TEXT_LENGTH_UPPER_BOUND:
             raise serializers.ValidationError(
                 'Text for a recipe is too long. Consider writing a book.')
         return attrs
 
-    def get_is_favorited(self, obj):
-        """
-        Check whether the request user has the recipe in favorites.
-        """
-        return obj.favorited.filter(
-            id=self.context.get('request').user.id).exists()
-
-    def get_is_in_shopping_cart(self, obj):
-        """
-        Check whether the request user has the recipe in a cart.
-        """
-        return obj.shopping_cart.filter(
-            id=self.context.get('request').user.id).exists()
+    def to_representation(self, instance):
+        """Render saved recipe the same way the read endpoints do."""
+        instance = Recipes.objects.with_related().get(pk=instance.pk)
+        return RecipeSerializer(instance, context=self.context).data
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('recipeingredients_set')
         tags = validated_data.pop('tags')
         recipe = Recipes.objects.create(**validated_data)
-        recipe_ingredients = []
-        for ingredient in ingredients:
-            current_ingredient = get_object_or_404(
-                Ingredients, name=ingredient.get('name'))
-            recipe_ingredients.append(RecipeIngredients(
-                recipe=recipe, ingredient=current_ingredient,
-                amount=ingredient.get('amount')
-            ))
-        RecipeIngredients.objects.bulk_create(recipe_ingredients)
+        RecipeIngredients.objects.bulk_create(
+            RecipeIngredients(recipe=recipe, **ingredient)
+            for ingredient in ingredients
+        )
         recipe.tags.add(*tags)
+        schedule_variants(recipe)
+        schedule_matcher_update(
+            recipe.pk, [item['ingredient'].pk for item in ingredients])
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         instance.text = validated_data.get('text', instance.text)
         instance.name = validated_data.get('name', instance.name)
         instance.cooking_time = validated_data.get(
             'cooking_time', instance.cooking_time
         )
-        instance.image = validated_data.get('image', instance.image)
+        if 'image' in validated_data:
+            instance.image = validated_data['image']
+            instance.image_variants = {}
         if 'tags' in validated_data:
             instance.tags.set(validated_data.pop('tags'))
-        if 'ingredients' in validated_data:
-            ingredients_data = validated_data.pop('ingredients')
-            lst = []
-            for ingredient in ingredients_data:
-                if not RecipeIngredients.objects.filter(
-                    recipe=instance,
-                    ingredient=get_object_or_404(
-                        Ingredients,
-                        name=ingredient.get('name')),
-                    amount=ingredient.get('amount')
-                ).exists():
-                    lst.append(RecipeIngredients(
-                        recipe=instance,
-                        ingredient=get_object_or_404(
-                            Ingredients,
-                            name=ingredient.get('name')),
-                        amount=ingredient.get('amount')
-                    ))
-            RecipeIngredients.objects.bulk_create(lst)
+        if 'recipeingredients_set' in validated_data:
+            ingredients = validated_data.pop('recipeingredients_set')
+            self.update_ingredients(instance, ingredients)
+            schedule_matcher_update(
+                instance.pk, [item['ingredient'].pk for item in ingredients])
         instance.save()
+        if 'image' in validated_data:
+            schedule_variants(instance)
         return instance
 
+    def update_ingredients(self, instance, ingredients):
+        """Apply the difference between stored and requested ingredients."""
+        current = {
+            item.ingredient_id: item
+            for item in instance.recipeingredients_set.all()
+        }
+        requested = {
+            item['ingredient'].pk: item for item in ingredients
+        }
+        instance.recipeingredients_set.filter(
+            ingredient_id__in=current.keys() - requested.keys()).delete()
+        RecipeIngredients.objects.bulk_create(
+            RecipeIngredients(recipe=instance, **requested[pk])
+            for pk in requested.keys() - current.keys()
+        )
+        changed = []
+        for pk in requested.keys() & current.keys():
+            if current[pk].amount != requested[pk]['amount']:
+                current[pk].amount = requested[pk]['amount']
+                changed.append(current[pk])
+        RecipeIngredients.objects.bulk_update(changed, ['amount'])
+
+
+class RecipeMatchSerializer(RecipeSerializer):
+    missing_ingredients = serializers.IntegerField(read_only=True)
+
+    class Meta(RecipeSerializer.Meta):
+        fields = RecipeSerializer.Meta.fields + ('missing_ingredients',)
+
 
 class CustomUserCreateSerializer(UserCreateSerializer):
     class Meta(UserCreateSerializer.Meta):
@@ -239,36 +275,26 @@ class CustomSetPasswordSerializer(SetPasswordSerializer):
 
 
 class FavoritesSerializer(serializers.ModelSerializer):
+    image_small = ImageVariantField('small')
+
     class Meta:
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_small', 'cooking_time')
         model = Recipes
 
-    def validate(self, data):
-        request_author = self.initial_data.get('favorited')
-        recipe_id = self.instance.id
-        favorites = request_author.favorites.select_related('author')
-        if favorites.filter(id=recipe_id).exists():
-            raise serializers.ValidationError('Данный рецепт уже в избранных.')
-        return data
-
 
 class ShoppingSerializer(serializers.ModelSerializer):
+    image_small = ImageVariantField('small')
+
     class Meta:
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_small', 'cooking_time')
         model = Recipes
 
-    def validate(self, data):
-        request_author = self.initial_data.get('shopping_cart')
-        recipe_id = self.instance.id
-        shopping = request_author.shopping.select_related('author')
-        if shopping.filter(id=recipe_id).exists():
-            raise serializers.ValidationError('Данный рецепт уже в корзине.')
-        return data
-
 
 class RecipeFollowSerializer(serializers.ModelSerializer):
+    image_small = ImageVariantField('small')
+
     class Meta:
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_small', 'cooking_time')
         model = Recipes
 
 
@@ -294,17 +320,21 @@ class FollowSerializer(serializers.ModelSerializer):
         """
         Check whether the request user is subscribed.
 
-        Returns bool value which answer whether the request user is subscribed
-         to the user which token was provided in request.
+        Authors are serialized here only for their followers: in the
+        subscriptions list and in the subscribe response.
         """
-        links = obj.subscribed.through.objects.select_related()
-        if hasattr(self, 'initial_data'):
-            return links.filter(
-                from_customuser=obj,
-                to_customuser=self.initial_data.get('subscribed')
-            ).exists()
         return True
 
+    def get_recipes_limit(self):
+        """Return 'recipes_limit' query parameter as a number if any."""
+        query = self.context.get('request')
+        if not query:
+            return None
+        try:
+            return max(int(query.query_params['recipes_limit']), 0)
+        except (KeyError, ValueError):
+            return None
+
     def get_recipes_count(self, obj):
         """
         Return number of recipes.
@@ -313,11 +343,10 @@ class FollowSerializer(serializers.ModelSerializer):
         recipes the author of request has and recipes_limit query
         if there is any.
         """
-        query = self.context.get('request')
-        if query and query.query_params.get('recipes_limit'):
-            return min(int(query.query_params.get('recipes_limit')[0]),
-                       obj.recipes.count())
-        return obj.recipes.count()
+        limit = self.get_recipes_limit()
+        if limit is not None:
+            return min(limit, obj.recipes_count)
+        return obj.recipes_count
 
     def get_recipes(self, obj):
         """
@@ -326,34 +355,62 @@ class FollowSerializer(serializers.ModelSerializer):
         Return serialized recipe objects potentially filtered against
         'recipes_limit' query.
         """
-        query = self.context.get('request')
-        if query and query.query_params.get('recipes_limit'):
-            qs = obj.recipes.all(
-            )[: int(query.query_params.get('recipes_limit')[0])]
-            serializer = RecipeFollowSerializer(qs, many=True)
-            return serializer.data
-        serializer = RecipeFollowSerializer(obj.recipes.all(), many=True)
-        return serializer.data
-
-    def validate(self, data):
-        if not (self.instance != self.initial_data.get('subscribed')):
+        # attached by SubscriptionsViewSet
+        recipes = getattr(obj, 'latest_recipes', None)
+        if recipes is None:
+            recipes = obj.recipes.all()[:self.get_recipes_limit()]
+        return RecipeFollowSerializer(recipes, many=True).data
+
+
+class ToggleSerializer(serializers.Serializer):
+    add = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False,
+        default=list, max_length=TOGGLES_UPPER_BOUND)
+    remove = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False,
+        default=list, max_length=TOGGLES_UPPER_BOUND)
+
+    def validate(self, attrs):
+        if set(attrs['add']) & set(attrs['remove']):
             raise serializers.ValidationError(
-                'Подписаться на самого себя не возможно')
+                'Нельзя одновременно добавить и удалить объект.')
+        return attrs
+
 
-        user_following = self.instance.subscribed.select_related()
-        if self.initial_data.get('subscribed') in user_following:
+class TogglesSerializer(serializers.Serializer):
+    """Batch of favorite, shopping cart and subscription changes."""
+
+    favorite = ToggleSerializer(required=False)
+    shopping_cart = ToggleSerializer(required=False)
+    subscribe = ToggleSerializer(required=False)
+
+    def validate_subscribe(self, value):
+        if self.context['request'].user.pk in value['add']:
             raise serializers.ValidationError(
-                'Вы уже подписаны на данного автора')
-        return data
+                'Подписаться на самого себя не возможно')
+        return value
 
 
-class DownloadSerializer(serializers.ModelSerializer):
-    amount = serializers.SerializerMethodField()
+class JobSerializer(serializers.ModelSerializer):
+    result = serializers.SerializerMethodField()
+    error = serializers.SerializerMethodField()
 
     class Meta:
-        fields = ('name', 'amount', 'measurement_unit')
-        model = Ingredients
-
-    # return annotated value for an ingredient
-    def get_amount(self, obj):
-        return obj.total
+        fields = ('id', 'name', 'status', 'attempts', 'created', 'started',
+                  'finished', 'result', 'error')
+        model = Job
+
+    def get_result(self, job):
+        result = job.result
+        if isinstance(result, dict) and result.get('file'):
+            url = default_storage.url(result['file'])
+            request = self.context.get('request')
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            result = {**result, 'url': url}
+        return result
+
+    def get_error(self, job):
+        # the last line of a traceback names the exception
+        lines = job.error.strip().splitlines()
+        return lines[-1] if lines else None
@@ -0,0 +1,57 @@
+"""Streaming writers for the shopping list download."""
+import csv
+import json
+
+from django.db.models import F, Sum
+
+from recipes.models import RecipeIngredients
+
+FILENAME = 'shopping_list'
+
+
+def cart_rows(user_id):
+    """Amounts of ingredients in the user's cart summed by one query."""
+    return RecipeIngredients.objects.filter(
+        recipe__shopping_cart=user_id
+    ).values(
+        name=F('ingredient__name'),
+        measurement_unit=F('ingredient__measurement_unit'),
+    ).annotate(amount=Sum('amount')).order_by('name')
+
+
+class Echo:
+    """File-like object which returns written value instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def stream_txt(rows):
+    for row in rows:
+        yield (f' - {row["name"]} ({row["measurement_unit"]}) - '
+               f'{row["amount"]}\n')
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'measurement_unit', 'amount'))
+    for row in rows:
+        yield writer.writerow(
+            (row['name'], row['measurement_unit'], row['amount']))
+
+
+def stream_json(rows):
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(row, ensure_ascii=False)
+        separator = ','
+    yield ']'
+
+
+# file format -> (content type, writer)
+FORMATS = {
+    'txt': ('text/plain; charset=utf-8', stream_txt),
+    'csv': ('text/csv; charset=utf-8', stream_csv),
+    'json': ('application/json', stream_json),
+}
@@ -0,0 +1,78 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from recipes.models import Ingredients, RecipeIngredients, Recipes, Tags, User
+
+from . import feed
+from .autocomplete import ingredient_index
+from .counters import M2M_COUNTERS, increment, m2m_counter_changed
+from .matching import recipe_matcher
+from .ranking import RANKED_RELATIONS, log_events
+from .reference import ingredients_reference, tags_reference
+from .response_cache import bump_generations
+from .user_state import invalidate_user_state
+
+
+@receiver([post_save, post_delete], sender=Ingredients)
+def invalidate_ingredients(sender, **kwargs):
+    ingredient_index.invalidate()
+    ingredients_reference.invalidate()
+    bump_generations('reference')
+
+
+@receiver([post_save, post_delete], sender=Tags)
+def invalidate_tags(sender, **kwargs):
+    tags_reference.invalidate()
+    bump_generations('reference')
+
+
+@receiver([post_save, post_delete], sender=Recipes)
+@receiver([post_save, post_delete], sender=RecipeIngredients)
+def invalidate_recipe_responses(sender, **kwargs):
+    bump_generations('recipes')
+
+
+@receiver(m2m_changed, sender=Recipes.tags.through)
+def recipe_tags_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        bump_generations('recipes')
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_responses(sender, update_fields=None, **kwargs):
+    # logins save last_login only
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        bump_generations('users')
+
+
+@receiver(post_save, sender=Recipes)
+def count_created_recipe(sender, instance, created, **kwargs):
+    if created:
+        increment(User, [instance.author_id], 'recipes_count', 1)
+        feed.schedule_fan_out([instance])
+
+
+@receiver(post_delete, sender=Recipes)
+def count_deleted_recipe(sender, instance, **kwargs):
+    increment(User, [instance.author_id], 'recipes_count', -1)
+    transaction.on_commit(lambda: recipe_matcher.remove(instance.pk))
+
+
+def relations_changed(sender, instance, reverse, **kwargs):
+    changed = m2m_counter_changed(sender, instance, reverse=reverse, **kwargs)
+    if not changed:
+        return
+    # forward changes pass users as pk_set, reverse ones are made on a user
+    invalidate_user_state([instance.pk] if reverse else changed[0])
+    if sender in RANKED_RELATIONS:
+        log_events(sender, instance, reverse, *changed)
+    if sender is User.subscribed.through:
+        pk_set, delta = changed
+        feed.follows_changed(
+            [(instance.pk, pk) if reverse else (pk, instance.pk)
+             for pk in pk_set], delta)
+
+
+for through in M2M_COUNTERS:
+    m2m_changed.connect(relations_changed, sender=through)
@@ -0,0 +1,53 @@
+"""Tasks run by the job queue, see api.jobs."""
+import uuid
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from recipes.models import RecipeRank, Recipes
+
+from . import feed, ranking
+from .images import generate_variants
+from .jobs import task
+from .response_cache import bump_generations
+from .shopping import FILENAME, FORMATS, cart_rows
+
+
+@task('image_variants')
+def image_variants(recipe_id, image_name):
+    generate_variants(recipe_id, image_name)
+
+
+@task('fan_out')
+def fan_out(recipe_ids):
+    feed.fan_out(Recipes.objects.filter(pk__in=recipe_ids).only(
+        'id', 'author_id', 'pub_date'))
+
+
+@task('shopping_list', max_attempts=1)
+def shopping_list(user_id, file_format):
+    """Render the user's shopping list into a file in the storage."""
+    _, writer = FORMATS[file_format]
+    content = ''.join(writer(cart_rows(user_id).iterator()))
+    name = default_storage.save(
+        f'shopping_lists/{uuid.uuid4().hex}/{FILENAME}.{file_format}',
+        ContentFile(content.encode()))
+    return {'file': name}
+
+
+@task('rank_recipes')
+def rank_recipes():
+    changed = {window: ranking.refresh(window)
+               for window, _ in RecipeRank.WINDOWS}
+    if any(changed.values()):
+        bump_generations('ranking')
+    changed['pruned'] = ranking.prune_events()
+    return changed
+
+
+@task('build_feeds')
+def build_feeds():
+    with transaction.atomic():
+        built, dropped = feed.refresh()
+    return {'built': built, 'dropped': dropped}
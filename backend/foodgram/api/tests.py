@@ -0,0 +1,253 @@
+"""API tests: query budgets of the benchmark scenarios, toggles and jobs."""
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from recipes.models import Job, RecipeEvent, RecipeRank, Recipes, User
+
+from . import toggles
+from .benchmark import SCENARIOS, make_clients, run, seed
+from .jobs import claim
+from .management.commands.benchmark import Command as BenchmarkCommand
+
+SIZES = (20, 60)
+# most queries a scenario may make, counted as the benchmark command does
+QUERY_BUDGET = {
+    'tags list': 0,
+    'tag detail': 0,
+    'ingredients list': 0,
+    'ingredients search': 0,
+    'ingredient detail': 0,
+    'recipes list anonymous': 3,
+    'recipes list': 5,
+    'recipes list page 3': 5,
+    'recipes cursor': 5,
+    'recipes by tag': 6,
+    'recipes by author': 6,
+    'recipes favorited': 6,
+    'recipes in cart': 6,
+    'recipes search': 6,
+    'recipes popular': 5,
+    'recipes trending': 5,
+    'recipes match': 5,
+    'recipes feed': 6,
+    'recipe detail': 5,
+    'recipes export': 4,
+    'recipes import': 10,
+    'recipe create': 14,
+    'recipe update': 13,
+    'recipe delete': 15,
+    'favorite add': 6,
+    'favorite remove': 5,
+    'cart add': 6,
+    'cart remove': 5,
+    'shopping list': 2,
+    'shopping list job': 7,
+    'jobs list': 3,
+    'job detail': 2,
+    'metrics': 1,
+    'users list': 3,
+    'user detail': 3,
+    'user me': 2,
+    'user create': 4,
+    'set password': 2,
+    'subscriptions': 4,
+    'subscribe': 7,
+    'unsubscribe': 5,
+    'batch toggles': 8,
+    'token login': 3,
+    'token logout': 3,
+}
+
+
+def benchmark_settings(media_root):
+    """Settings the benchmark command measures scenarios with."""
+    return override_settings(
+        MEDIA_ROOT=media_root,
+        IMAGE_PIPELINE={**settings.IMAGE_PIPELINE, 'ASYNC': False},
+        RESPONSE_CACHE={**settings.RESPONSE_CACHE, 'ENABLED': False},
+    )
+
+
+class QueryBudgetTests(TransactionTestCase):
+    """
+    Every benchmark scenario at small sizes.
+
+    Runs outside of a test transaction, so atomic blocks don't add
+    savepoints and counts match reports of the benchmark command.
+    """
+
+    # replicas mirror the default database
+    databases = '__all__'
+
+    def test_scenarios(self):
+        results = {}
+        with tempfile.TemporaryDirectory() as media_root, \
+                benchmark_settings(media_root):
+            for size in SIZES:
+                call_command('flush', interactive=False, verbosity=0)
+                results[size] = run(seed(size, favorites=3), repeat=1)
+        report = {'endpoints': {
+            name: {str(size): results[size][name] for size in SIZES}
+            for name in results[SIZES[0]]
+        }}
+        self.assertEqual(
+            BenchmarkCommand.regressions(report, baseline=None), [])
+        self.assertEqual(
+            set(QUERY_BUDGET), {scenario.name for scenario in SCENARIOS})
+        for name, by_size in report['endpoints'].items():
+            for size, result in by_size.items():
+                with self.subTest(scenario=name, size=size):
+                    self.assertLessEqual(result['queries'],
+                                         QUERY_BUDGET[name])
+
+
+# replicas mirroring the database of the test transaction don't see its
+# rows, requests read from the primary
+@override_settings(DATABASE_ROUTING={**settings.DATABASE_ROUTING,
+                                     'REPLICAS': []})
+class ToggleTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ids = seed(20, favorites=3)
+
+    def setUp(self):
+        self.client = make_clients(self.ids)['user']
+        self.user = self.ids['user']
+        self.recipe = Recipes.objects.get(pk=self.ids['recipe'])
+
+    def test_add_is_idempotent(self):
+        self.assertEqual(
+            toggles.add('favorite', self.user, [self.recipe.pk]),
+            {self.recipe.pk})
+        self.assertEqual(
+            toggles.add('favorite', self.user, [self.recipe.pk]), set())
+        self.recipe.refresh_from_db()
+        self.assertEqual(
+            self.recipe.favorites_count, self.recipe.favorited.count())
+        self.assertEqual(RecipeEvent.objects.filter(
+            recipe=self.recipe, kind=RecipeEvent.FAVORITE).count(), 1)
+
+    def test_add_skips_missing_targets(self):
+        missing = Recipes.objects.order_by('-pk').first().pk + 1
+        self.assertEqual(
+            toggles.add('shopping_cart', self.user,
+                        [self.recipe.pk, missing]),
+            {self.recipe.pk})
+
+    def test_remove_returns_linked_only(self):
+        toggles.add('shopping_cart', self.user, [self.recipe.pk])
+        self.assertEqual(
+            toggles.remove('shopping_cart', self.user, [self.recipe.pk]),
+            {self.recipe.pk})
+        self.assertEqual(
+            toggles.remove('shopping_cart', self.user, [self.recipe.pk]),
+            set())
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.shopping_cart_count,
+                         self.recipe.shopping_cart.count())
+
+    def test_subscribe(self):
+        author = self.ids['author']
+        self.assertEqual(toggles.add('subscribe', self.user, [author]),
+                         {author})
+        self.assertTrue(User.objects.get(pk=author).subscribed.filter(
+            pk=self.user).exists())
+        self.assertEqual(toggles.remove('subscribe', self.user, [author]),
+                         {author})
+
+    def test_favorite_endpoint(self):
+        path = f'/api/recipes/{self.recipe.pk}/favorite/'
+        self.assertEqual(self.client.post(path).status_code, 201)
+        self.assertEqual(self.client.post(path).status_code, 400)
+        self.assertEqual(self.client.delete(path).status_code, 204)
+        self.assertEqual(self.client.delete(path).status_code, 400)
+        missing = Recipes.objects.order_by('-pk').first().pk + 1
+        self.assertEqual(self.client.delete(
+            f'/api/recipes/{missing}/favorite/').status_code, 404)
+
+    def test_batch_endpoint(self):
+        path = '/api/users/me/toggles/'
+        data = {'favorite': {'add': [self.recipe.pk]},
+                'shopping_cart': {'add': [self.recipe.pk]}}
+        response = self.client.post(path, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['favorite'],
+                         {'added': [self.recipe.pk], 'removed': []})
+        response = self.client.post(path, data, format='json')
+        self.assertEqual(response.json()['shopping_cart'],
+                         {'added': [], 'removed': []})
+
+
+@override_settings(DATABASE_ROUTING={**settings.DATABASE_ROUTING,
+                                     'REPLICAS': []})
+class RankingOrderTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ids = seed(20, favorites=3)
+
+    def setUp(self):
+        self.client = make_clients(self.ids)['anonymous']
+
+    def listed(self, window):
+        response = self.client.get(
+            f'/api/recipes/?ordering={window}&limit=100')
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.json()['results']]
+
+    def test_unranked_recipes_are_kept(self):
+        ranked = dict(RecipeRank.objects.filter(
+            window=RecipeRank.POPULAR).values_list('recipe_id', 'score'))
+        unranked = Recipes.objects.exclude(pk__in=ranked).order_by(
+            '-pub_date', '-id')
+        self.assertTrue(ranked)
+        self.assertTrue(unranked)
+        listed = self.listed(RecipeRank.POPULAR)
+        self.assertEqual(len(listed), Recipes.objects.count())
+        scores = [ranked[pk] for pk in listed[:len(ranked)]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(listed[len(ranked):],
+                         [recipe.pk for recipe in unranked])
+
+    def test_empty_window_lists_every_recipe(self):
+        self.assertFalse(RecipeRank.objects.filter(
+            window=RecipeRank.TRENDING).exists())
+        self.assertEqual(
+            self.listed(RecipeRank.TRENDING),
+            list(Recipes.objects.order_by(
+                '-pub_date', '-id').values_list('pk', flat=True)))
+
+
+class ClaimTests(TestCase):
+
+    def queue(self, **kwargs):
+        return Job.objects.create(name='rank_recipes', **kwargs)
+
+    def test_claims_oldest_due_job_once(self):
+        now = timezone.now()
+        self.queue(run_at=now + timedelta(hours=1))
+        newer = self.queue(run_at=now - timedelta(minutes=1))
+        older = self.queue(run_at=now - timedelta(minutes=2))
+        job = claim()
+        self.assertEqual(job.pk, older.pk)
+        self.assertEqual((job.status, job.attempts), (Job.RUNNING, 1))
+        older.refresh_from_db()
+        self.assertEqual((older.status, older.attempts), (Job.RUNNING, 1))
+        self.assertEqual(claim().pk, newer.pk)
+        self.assertIsNone(claim())
+
+    def test_claims_given_job(self):
+        first, second = self.queue(), self.queue()
+        self.assertEqual(claim(second.pk).pk, second.pk)
+        self.assertIsNone(claim(second.pk))
+        self.assertEqual(claim().pk, first.pk)
+
+    def test_skips_finished_jobs(self):
+        self.queue(status=Job.DONE)
+        self.assertIsNone(claim())
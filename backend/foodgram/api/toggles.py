@@ -0,0 +1,96 @@
+"""Favorite, cart and subscription toggles on the m2m through tables."""
+from django.db import connections, router, transaction
+
+from recipes.models import Recipes, User
+
+from . import feed
+from .counters import M2M_COUNTERS, increment
+from .ranking import RANKED_RELATIONS, log_events
+from .user_state import invalidate_user_state
+
+# toggle -> (through model, field of the target, field of the user)
+RELATIONS = {
+    'favorite': (Recipes.favorited.through, 'recipes', 'customuser'),
+    'shopping_cart': (
+        Recipes.shopping_cart.through, 'recipes', 'customuser'),
+    'subscribe': (
+        User.subscribed.through, 'from_customuser', 'to_customuser'),
+}
+
+
+def execute(relation, sql, params):
+    through = RELATIONS[relation][0]
+    connection = connections[router.db_for_write(through)]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {row[0] for row in cursor.fetchall()}
+
+
+def table_and_columns(relation):
+    through, target, owner = RELATIONS[relation]
+    quote = connections[router.db_for_write(through)].ops.quote_name
+    target_field = through._meta.get_field(target)
+    return (
+        quote(through._meta.db_table),
+        quote(target_field.column),
+        quote(through._meta.get_field(owner).column),
+        quote(target_field.related_model._meta.db_table),
+        quote(target_field.related_model._meta.pk.column),
+    )
+
+
+@transaction.atomic(savepoint=False)
+def add(relation, user_id, target_ids):
+    """
+    Link existing targets to the user, return ids which got linked.
+
+    One INSERT ... SELECT skips missing targets and, with ON CONFLICT DO
+    NOTHING, already linked ones, so concurrent requests can't link twice.
+    """
+    if not target_ids:
+        return set()
+    table, target, owner, target_table, target_pk = table_and_columns(
+        relation)
+    placeholders = ', '.join(['%s'] * len(target_ids))
+    added = execute(
+        relation,
+        f'INSERT INTO {table} ({owner}, {target}) '
+        f'SELECT %s, {target_pk} FROM {target_table} '
+        f'WHERE {target_pk} IN ({placeholders}) '
+        f'ON CONFLICT DO NOTHING RETURNING {target}',
+        [user_id, *target_ids],
+    )
+    relation_changed(relation, user_id, added, 1)
+    return added
+
+
+@transaction.atomic(savepoint=False)
+def remove(relation, user_id, target_ids):
+    """Unlink targets from the user, return ids which were linked."""
+    if not target_ids:
+        return set()
+    table, target, owner, _, _ = table_and_columns(relation)
+    placeholders = ', '.join(['%s'] * len(target_ids))
+    removed = execute(
+        relation,
+        f'DELETE FROM {table} WHERE {owner} = %s '
+        f'AND {target} IN ({placeholders}) RETURNING {target}',
+        [user_id, *target_ids],
+    )
+    relation_changed(relation, user_id, removed, -1)
+    return removed
+
+
+def relation_changed(relation, user_id, target_ids, delta):
+    """Do what m2m_changed handlers do, raw SQL doesn't send signals."""
+    if not target_ids:
+        return
+    through = RELATIONS[relation][0]
+    model, field, _, _ = M2M_COUNTERS[through]
+    increment(model, target_ids, field, delta)
+    if through in RANKED_RELATIONS:
+        log_events(through, None, True, target_ids, delta)
+    if relation == 'subscribe':
+        feed.follows_changed(
+            [(user_id, author_id) for author_id in target_ids], delta)
+    invalidate_user_state([user_id])
@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.urls import include, path, re_path
 from djoser.views import TokenCreateView, TokenDestroyView
 from rest_framework.routers import DefaultRouter
 
-from .views import (IngredientViewSet, RecipeViewSet, ShoppingViewSet,
-                    SubscriptionsViewSet, TagViewSet, UserViewSet)
+from .async_views import asyncify
+from .views import (IngredientViewSet, JobViewSet, MetricsView, RecipeViewSet,
+                    ShoppingViewSet, SubscriptionsViewSet, TagViewSet,
+                    UserViewSet)
 
 router = DefaultRouter()
 
@@ -20,10 +23,15 @@ router.register(r'ingredients', IngredientViewSet)
 router.register(r'users/subscriptions', SubscriptionsViewSet,
                 basename='subscriptions')
 router.register(r'users', UserViewSet)
+router.register(r'jobs', JobViewSet, basename='jobs')
 
+router_urls = router.urls
+if settings.ASYNC_VIEWS:
+    router_urls = asyncify(router_urls)
 
 urlpatterns = [
-    path('', include(router.urls)),
+    path('', include(router_urls)),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     re_path(r'^auth/token/login/?$', TokenCreateView.as_view(),
             name='login'),
     re_path(r'^auth/token/logout/?$', TokenDestroyView.as_view(),
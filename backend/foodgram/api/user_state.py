@@ -0,0 +1,80 @@
+"""Per-user sets of favorite and cart recipes and followed authors."""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Value
+
+from foodgram.db.routers import primary_reads
+from recipes.models import Recipes, User
+
+
+class UserState:
+    """Ids serializers check membership in instead of querying per object."""
+
+    def __init__(self, favorites=(), shopping_cart=(), subscriptions=()):
+        self.favorites = frozenset(favorites)
+        self.shopping_cart = frozenset(shopping_cart)
+        self.subscriptions = frozenset(subscriptions)
+
+
+ANONYMOUS_STATE = UserState()
+FAVORITES, SHOPPING_CART, SUBSCRIPTIONS = range(3)
+
+
+def cache_key(user_id):
+    return f'user_state:{user_id}'
+
+
+def load_user_state(user_id):
+    """Load the three sets with one query."""
+    relations = (
+        Recipes.favorited.through.objects.filter(
+            customuser_id=user_id).values_list(
+                'recipes_id', Value(FAVORITES)),
+        Recipes.shopping_cart.through.objects.filter(
+            customuser_id=user_id).values_list(
+                'recipes_id', Value(SHOPPING_CART)),
+        User.subscribed.through.objects.filter(
+            to_customuser_id=user_id).values_list(
+                'from_customuser_id', Value(SUBSCRIPTIONS)),
+    )
+    ids = {FAVORITES: [], SHOPPING_CART: [], SUBSCRIPTIONS: []}
+    with primary_reads():
+        for pk, relation in relations[0].union(*relations[1:], all=True):
+            ids[relation].append(pk)
+    return UserState(ids[FAVORITES], ids[SHOPPING_CART],
+                     ids[SUBSCRIPTIONS])
+
+
+def get_user_state(request):
+    """
+    Return state of the request user.
+
+    It's loaded once per request and, with USER_STATE['CACHED'], kept in
+    a shared cache for a short time, changes of the relations invalidate it.
+    """
+    if request is None or not request.user.is_authenticated:
+        return ANONYMOUS_STATE
+    state = getattr(request, '_user_state', None)
+    if state is None:
+        user_id = request.user.pk
+        if settings.USER_STATE['CACHED']:
+            state = caches[settings.USER_STATE['CACHE_ALIAS']].get_or_set(
+                cache_key(user_id), lambda: load_user_state(user_id),
+                settings.USER_STATE['TIMEOUT'],
+            )
+        else:
+            state = load_user_state(user_id)
+        request._user_state = state
+    return state
+
+
+def invalidate_user_state(user_ids):
+    """Drop cached states now and again after commit."""
+    # a state loaded before commit could still miss the change
+    keys = [cache_key(user_id) for user_id in user_ids]
+    if not keys or not settings.USER_STATE['CACHED']:
+        return
+    cache = caches[settings.USER_STATE['CACHE_ALIAS']]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
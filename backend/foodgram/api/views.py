@@ -1,25 +1,43 @@
-import tempfile
+import time
+from collections import defaultdict
 
-from django.db.models import Sum
-from django.http import FileResponse
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as DjoserUserView
 from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from recipes.models import Ingredients, Recipes, Tags, User
+from recipes.models import Ingredients, Job, Recipes, Tags, User
 
-from .filters import IngredientFilter, RecipeFilter
-from .mixins import ListViewSet, ReadOrListOnlyViewSet
-from .permissions import IsAuthorOrReadOnlyPermission
+from . import toggles
+from .autocomplete import ingredient_index
+from .feed import feed_entries, followed_authors
+from .filters import RecipeFilter
+from .jobs import enqueue
+from .matching import recipe_matcher
+from .mixins import CachedResponseMixin, ListViewSet, ReadOrListOnlyViewSet
+from .paginators import KeysetPagination
+from .permissions import CanReadMetrics, IsAuthorOrReadOnlyPermission
+from .profiling import metrics
+from .recipe_io import (RecipeImporter, chunks, export_recipes, ndjson,
+                        parse_lines)
+from .reference import ingredients_reference, list_response, tags_reference
+from .response_cache import (bump_generations, recipe_detail_cache,
+                             recipe_list_cache, user_cache)
 from .serializers import (CustomSetPasswordSerializer,
                           CustomUserCreateSerializer, CustomUserSerializer,
-                          DownloadSerializer, FavoritesSerializer,
-                          FollowSerializer, IngredientSerializer,
-                          RecipeCreateSerializer, RecipeSerializer,
-                          ShoppingSerializer, TagSerializer)
+                          FavoritesSerializer, FollowSerializer,
+                          IngredientSerializer, JobSerializer,
+                          RecipeCreateSerializer, RecipeMatchSerializer,
+                          RecipeSerializer, ShoppingSerializer, TagSerializer,
+                          TogglesSerializer)
+from .shopping import FILENAME, FORMATS, cart_rows
 
 
 class TagViewSet(ReadOrListOnlyViewSet):
@@ -28,21 +46,68 @@ class TagViewSet(ReadOrListOnlyViewSet):
     permission_classes = [permissions.AllowAny]
     pagination_class = None
 
+    def get_object(self):
+        return tags_reference.get_or_404(self.kwargs['pk'])
+
+    def list(self, request, *args, **kwargs):
+        return list_response(request, tags_reference)
+
 
 class IngredientViewSet(ReadOrListOnlyViewSet):
     queryset = Ingredients.objects.all()
     serializer_class = IngredientSerializer
-    filter_backends = [DjangoFilterBackend]
-    filterset_class = IngredientFilter
     permission_classes = [permissions.AllowAny]
     pagination_class = None
 
+    def get_object(self):
+        return ingredients_reference.get_or_404(self.kwargs['pk'])
+
+    def list(self, request, *args, **kwargs):
+        """
+        Serve the whole table from the reference cache.
+
+        Name lookups are served from the in-process autocomplete index,
+        prefix matches go first, then substring ones, capped at 'limit'.
+        """
+        name = request.query_params.get('name')
+        if not name:
+            return list_response(request, ingredients_reference)
+        max_limit = settings.INGREDIENT_AUTOCOMPLETE['LIMIT']
+        try:
+            limit = min(int(request.query_params.get('limit', max_limit)),
+                        max_limit)
+        except ValueError:
+            limit = max_limit
+        return Response(ingredient_index.search(name, max(limit, 1)))
+
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Recipes.objects.all()
     serializer_class = RecipeSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_class = RecipeFilter
+    cursor_ordering = ('-pub_date', '-id')
+    lookup_value_regex = r'\d+'
+    response_caches = {
+        'list': recipe_list_cache,
+        'retrieve': recipe_detail_cache,
+    }
+    # is_favorited and is_in_shopping_cart lists are personal
+    cached_query_params = ('tags', 'author', 'page', 'limit', 'search',
+                           'ordering', 'pagination', 'cursor')
+
+    def get_queryset(self):
+        # the number of queries per page doesn't depend on the page size,
+        # user flags come from the cached user state
+        return Recipes.objects.with_related()
+
+    def filter_queryset(self, queryset):
+        # search and rankings order by their own scores, keyset mode would
+        # re-sort their pages by date
+        if any(self.request.query_params.get(param)
+               for param in ('search', 'ordering')):
+            self.cursor_ordering = None
+        return super().filter_queryset(queryset)
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -52,7 +117,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
     # списку пользователей и переопределение метода get_permissions позволяет
     # нам определить пользовательские разрешения достаточно сжатым кодом
     def get_permissions(self):
-        if self.action == 'create':
+        if self.action in ['create', 'feed', 'export', 'import_recipes']:
             permission_classes = [permissions.IsAuthenticated]
         elif self.action in ['favorite', 'shopping_cart', 'partial_update']:
             permission_classes = [
@@ -68,57 +133,181 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return RecipeCreateSerializer
         return RecipeSerializer
 
+    def toggle(self, request, relation, pk, serializer_class, messages):
+        """
+        Add or remove the recipe for the request user in one statement.
+
+        The recipe is read only to render a successful POST, extra queries
+        are made only to tell an error apart.
+        """
+        already_there, not_there = messages
+        if request.method == 'POST':
+            if toggles.add(relation, request.user.pk, [pk]):
+                recipe = Recipes.objects.get(pk=pk)
+                serializer = serializer_class(
+                    recipe, context=self.get_serializer_context())
+                return Response(serializer.data,
+                                status=status.HTTP_201_CREATED)
+            recipe = get_object_or_404(Recipes, pk=pk)
+            return Response({'errors': already_there.format(recipe)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if not toggles.remove(relation, request.user.pk, [pk]):
+            recipe = get_object_or_404(Recipes, pk=pk)
+            return Response({'errors': not_there.format(recipe)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
     @action(
         detail=True,
         methods=['POST', 'DELETE'],
     )
     def favorite(self, request, pk=None):
-        recipe = get_object_or_404(Recipes, pk=pk)
-        if request.method == 'POST':
-            data = {'favorited': request.user}
-            serializer = FavoritesSerializer(recipe, data=data, partial=True)
-            serializer.is_valid(raise_exception=True)
-            recipe.favorited.add(request.user)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        if request.method == 'DELETE':
-            if request.user not in recipe.favorited.all():
-                return Response(
-                    {'errors': (f'Рецепт {recipe} не '
-                                'находился в Избранном')},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-            recipe.favorited.remove(request.user)
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        return None
+        return self.toggle(
+            request, 'favorite', pk, FavoritesSerializer,
+            ('Данный рецепт уже в избранных.',
+             'Рецепт {} не находился в Избранном'),
+        )
 
     @action(
         detail=True,
         methods=['POST', 'DELETE'],
     )
     def shopping_cart(self, request, pk=None):
-        recipe = get_object_or_404(Recipes, pk=pk)
-        if request.method == 'POST':
-            data = {'shopping_cart': request.user}
-            serializer = ShoppingSerializer(recipe, data=data, partial=True)
-            serializer.is_valid(raise_exception=True)
-            recipe.shopping_cart.add(request.user)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        if request.method == 'DELETE':
-            if request.user not in recipe.shopping_cart.all():
-                return Response(
-                    {'errors': (f'Рецепт {recipe} не находился в корзине')},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-            recipe.shopping_cart.remove(request.user)
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        return None
+        return self.toggle(
+            request, 'shopping_cart', pk, ShoppingSerializer,
+            ('Данный рецепт уже в корзине.',
+             'Рецепт {} не находился в корзине'),
+        )
 
+    @action(detail=False)
+    def feed(self, request):
+        """
+        List recipes of followed authors, newest first.
+
+        Always paginated by keyset. Recipes are merged with one query on
+        read, users following many authors get their precomputed feed.
+        """
+        paginator = KeysetPagination()
+        entries = feed_entries(request.user.pk)
+        if entries is None:
+            self.cursor_ordering = ('-pub_date', '-id')
+            recipes = paginator.paginate_queryset(
+                self.get_queryset().filter(
+                    author_id__in=followed_authors(request.user.pk)),
+                request, view=self)
+        else:
+            self.cursor_ordering = ('-pub_date', '-recipe_id')
+            page = paginator.paginate_queryset(entries, request, view=self)
+            found = self.get_queryset().in_bulk(
+                [entry.recipe_id for entry in page])
+            recipes = [found[entry.recipe_id] for entry in page
+                       if entry.recipe_id in found]
+        serializer = self.get_serializer(recipes, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False)
+    def export(self, request):
+        """Stream recipes matching the list filters as NDJSON."""
+        rows = export_recipes(
+            self.filter_queryset(Recipes.objects.all()),
+            settings.RECIPE_BULK['EXPORT_CHUNK_SIZE'])
+        response = StreamingHttpResponse(
+            ndjson(rows), content_type='application/x-ndjson')
+        response['Content-Disposition'] = (
+            'attachment; filename=recipes.ndjson')
+        return response
+
+    @action(detail=False, methods=['POST'], url_path='import')
+    def import_recipes(self, request):
+        """
+        Create recipes from NDJSON lines of the request body.
+
+        The body is read line by line and loaded in batches, each in its
+        own transaction. Invalid lines are reported and skipped, so are
+        recipes the author already has. Staff may import recipes of other
+        authors, everybody else imports as themselves.
+        """
+        options = settings.RECIPE_BULK
+        started = time.monotonic()
+        importer = RecipeImporter(
+            author_id=None if request.user.is_staff else request.user.pk)
+        for batch in chunks(parse_lines(request.stream or ()),
+                            options['IMPORT_BATCH_SIZE']):
+            with transaction.atomic():
+                importer.load(batch)
+        if importer.created:
+            recipe_matcher.invalidate()
+            bump_generations('recipes')
+        elapsed = time.monotonic() - started
+        return Response(
+            {
+                'created': importer.created,
+                'skipped': importer.skipped,
+                'errors': [
+                    {'line': number, 'errors': messages}
+                    for number, messages in importer.errors[
+                        :options['MAX_ERRORS']]
+                ],
+                'seconds': round(elapsed, 3),
+                'recipes_per_second': round(
+                    importer.created / elapsed if elapsed else 0, 1),
+            },
+            status=(status.HTTP_400_BAD_REQUEST
+                    if importer.errors and not importer.created
+                    else status.HTTP_200_OK),
+        )
 
-class UserViewSet(DjoserUserView):
-    queryset = User.objects.all()
+    @action(detail=False)
+    def match(self, request):
+        """
+        List recipes which can be cooked from the given ingredients.
+
+        Takes 'ingredients' ids (repeated or comma separated) and 'missing',
+        how many recipe ingredients may be absent from the set. Matching is
+        done by the in-memory inverted index, only the page is queried.
+        """
+        options = settings.RECIPE_MATCHING
+        try:
+            ingredient_ids = {
+                int(pk) for value in request.query_params.getlist(
+                    'ingredients') for pk in value.split(',') if pk.strip()
+            }
+            missing = int(request.query_params.get('missing', 0))
+        except ValueError:
+            return Response(
+                {'errors': 'Ингредиенты и missing должны быть числами'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not 0 < len(ingredient_ids) <= options['MAX_INGREDIENTS']:
+            return Response(
+                {'errors': ('Укажите от 1 до '
+                            f'{options["MAX_INGREDIENTS"]} ингредиентов')},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        missing = min(max(missing, 0), options['MAX_MISSING'])
+        # ranking comes from the index, keyset mode doesn't apply here
+        self.cursor_ordering = None
+        page = self.paginate_queryset(
+            recipe_matcher.match(ingredient_ids, missing))
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for recipe_id, _ in page])
+        results = []
+        for recipe_id, missing in page:
+            if recipe_id in recipes:
+                recipes[recipe_id].missing_ingredients = missing
+                results.append(recipes[recipe_id])
+        serializer = RecipeMatchSerializer(
+            results, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+
+class UserViewSet(CachedResponseMixin, DjoserUserView):
+    queryset = User.objects.order_by('id')
     serializer_class = CustomUserSerializer
+    lookup_value_regex = r'\d+'
+    response_caches = {'list': user_cache, 'retrieve': user_cache}
+    cached_query_params = ('page', 'limit')
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -128,7 +317,8 @@ class UserViewSet(DjoserUserView):
         return CustomUserSerializer
 
     def get_permissions(self):
-        if self.action in ['retrieve', 'me', 'set_password', 'subscribe']:
+        if self.action in ['retrieve', 'me', 'set_password', 'subscribe',
+                           'batch_toggle']:
             permission_classes = [permissions.IsAuthenticated]
         else:
             permission_classes = [permissions.AllowAny]
@@ -154,76 +344,157 @@ class UserViewSet(DjoserUserView):
         permission_classes=[IsAuthorOrReadOnlyPermission],
     )
     def subscribe(self, request, id=None):
-        writer = get_object_or_404(User, pk=id)
         if request.method == 'POST':
-            data = {'subscribed': request.user}
-            serializer = FollowSerializer(writer, data=data, partial=True)
-            serializer.is_valid(raise_exception=True)
-            writer.subscribed.add(request.user)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        if request.method == 'DELETE':
-            links = writer.subscribed.through.objects.all()
-            if not links.filter(
-                from_customuser=writer, to_customuser=request.user
-            ).exists():
+            if str(request.user.pk) == str(id):
                 return Response(
-                    {'errors': (f'Вы не подписаны на автора {writer}.')},
+                    {'errors': 'Подписаться на самого себя не возможно'},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            writer.subscribed.remove(request.user)
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        return None
+            if toggles.add('subscribe', request.user.pk, [id]):
+                serializer = FollowSerializer(
+                    User.objects.get(pk=id),
+                    context=self.get_serializer_context())
+                return Response(serializer.data,
+                                status=status.HTTP_201_CREATED)
+            get_object_or_404(User, pk=id)
+            return Response(
+                {'errors': 'Вы уже подписаны на данного автора'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if not toggles.remove('subscribe', request.user.pk, [id]):
+            writer = get_object_or_404(User, pk=id)
+            return Response(
+                {'errors': (f'Вы не подписаны на автора {writer}.')},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(['post'], detail=False, url_path='me/toggles')
+    def batch_toggle(self, request):
+        """
+        Apply many favorite, cart and subscription changes at once.
+
+        Returns ids which were actually added and removed, ids already in
+        the requested state or missing altogether are skipped.
+        """
+        serializer = TogglesSerializer(
+            data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        result = {}
+        with transaction.atomic():
+            for relation, changes in serializer.validated_data.items():
+                result[relation] = {
+                    'added': sorted(toggles.add(
+                        relation, request.user.pk, changes['add'])),
+                    'removed': sorted(toggles.remove(
+                        relation, request.user.pk, changes['remove'])),
+                }
+        return Response(result)
 
 
 class SubscriptionsViewSet(ListViewSet):
     serializer_class = FollowSerializer
+    cursor_ordering = ('id',)
 
     def get_queryset(self):
-        return self.request.user.customuser_set.all()
+        return self.request.user.customuser_set.order_by('id')
+
+    def list(self, request, *args, **kwargs):
+        """
+        List followed authors with their latest recipes.
+
+        Recipes for the whole page are fetched with a single query no matter
+        how many authors are on it.
+        """
+        authors = self.paginate_queryset(self.get_queryset())
+        limit = self.get_serializer().get_recipes_limit()
+        recipes = Recipes.objects.filter(author__in=authors)
+        if limit is not None:
+            recipes = recipes.latest_per_author(limit)
+        by_author = defaultdict(list)
+        for recipe in recipes:
+            by_author[recipe.author_id].append(recipe)
+        for author in authors:
+            author.latest_recipes = by_author[author.id]
+        serializer = self.get_serializer(authors, many=True)
+        return self.get_paginated_response(serializer.data)
 
 
 class ShoppingViewSet(ListViewSet):
-    serializer_class = DownloadSerializer
+    # DRF reserves the "format" query parameter for content negotiation
+    format_query_param = 'file_format'
 
     def list(self, request, *args, **kwargs):
         """
-        Calculate and return list on ingredients for a shopping cart.
-
-        Annotate ingredients, filter them against the list of chosen recipes
-        then return it in txt file.
-        """
-        # select recipes in shopping cart of a request user
-        user_shopping_recipes = self.request.user.shopping.select_related()
-        # get annotated queryset for ingredients
-        # use Sum(distinct=True) to get total amount w\o double counting
-        qs = Ingredients.objects.filter(
-            recipeingredients__recipe__in=user_shopping_recipes).values(
-                'name').annotate(
-                    total=Sum('recipeingredients__amount'))
-
-        qs_list = []
-        for ingredient in qs:
-            ingredient_object = get_object_or_404(
-                Ingredients, name=ingredient['name'])
-            ingredient_object.total = ingredient['total']
-            qs_list.append(ingredient_object)
-        serializer = self.get_serializer(qs_list, many=True)
-        # get a string to write into txt file
-        result = [
-            f' - {i["name"]} ({i["measurement_unit"]}) - {i["amount"]}'
-            for i in serializer.data
-        ]
-        # use temp directory keep working directory clean
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            # write list of ingredients into txt file
-            with open(tmpdirname + '/shopping_list.txt', 'w') as f:
-                f.write('\n'.join(result))
-            response = FileResponse(
-                open(tmpdirname + '/shopping_list.txt', 'rb'),
-                content_type='text/plain'
+        Calculate and stream list of ingredients for a shopping cart.
+
+        Sum amounts of ingredients from recipes in the request user's cart
+        with a single grouped query and stream it as txt (default), csv or
+        json depending on the 'file_format' query parameter.
+        """
+        file_format = request.query_params.get(
+            self.format_query_param, 'txt')
+        if file_format not in FORMATS:
+            return Response(
+                {'errors': (f'Формат {file_format} не поддерживается, '
+                            f'доступны: {", ".join(FORMATS)}')},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        content_type, writer = FORMATS[file_format]
+        response = StreamingHttpResponse(
+            writer(cart_rows(request.user.pk).iterator()),
+            content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename={FILENAME}.{file_format}')
+        return response
+
+    def create(self, request, *args, **kwargs):
+        """
+        Render the shopping list into a file in the background.
+
+        Returns the job, its result links to the file once it's done.
+        """
+        file_format = request.data.get(self.format_query_param, 'txt')
+        if file_format not in FORMATS:
+            return Response(
+                {'errors': (f'Формат {file_format} не поддерживается, '
+                            f'доступны: {", ".join(FORMATS)}')},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            response[
-                'Content-Disposition'
-            ] = 'attachment; filename=shopping_list.txt'
-            return response
+        job = enqueue(
+            'shopping_list',
+            {'user_id': request.user.pk, 'file_format': file_format},
+            user=request.user,
+        )
+        # runs right away when there are no workers
+        job.refresh_from_db()
+        return Response(
+            JobSerializer(job, context={'request': request}).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('api:jobs-detail', args=[job.pk])},
+        )
+
+
+class JobViewSet(ReadOrListOnlyViewSet):
+    """Background jobs started by the user, every job for staff."""
+
+    serializer_class = JobSerializer
+
+    def get_queryset(self):
+        jobs = Job.objects.order_by('-id')
+        if self.request.user.is_staff:
+            return jobs
+        return jobs.filter(user=self.request.user)
+
+
+class MetricsView(APIView):
+    """Profiling metrics of this worker process in Prometheus format."""
+
+    permission_classes = [CanReadMetrics]
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8',
+        )
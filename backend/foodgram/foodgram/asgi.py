@@ -1,7 +1,70 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Produce streaming bodies off the event loop.
+
+    Django 3.2 iterates them in the event loop, so every chunk waiting on
+    the database would stall all other requests of the worker. Chunks are
+    pulled in a thread of the response's own, its queries and cursors
+    stay on one connection, which is closed when the body ends.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': self.response_headers(response),
+        })
+        executor = ThreadPoolExecutor(max_workers=1)
+        pull = sync_to_async(next, thread_sensitive=False, executor=executor)
+        parts, done = iter(response), object()
+        try:
+            part = await pull(parts, done)
+            while part is not done:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+                part = await pull(parts, done)
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(connections.close_all, thread_sensitive=False,
+                                executor=executor)()
+            executor.shutdown(wait=False)
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+    @staticmethod
+    def response_headers(response):
+        # as ASGIHandler.send_response collects them
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((
+                b'Set-Cookie',
+                cookie.output(header='').encode('ascii').strip(),
+            ))
+        return headers
+
+
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
@@ -0,0 +1 @@
+"""Database connection management: pooling, health checks, replicas."""
@@ -0,0 +1,125 @@
+"""Middleware checking persistent connections and routing reads."""
+import hashlib
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import Error, connections
+from rest_framework.permissions import SAFE_METHODS
+
+from ..middleware import HybridMiddleware
+from .routers import replica_alias
+
+REPLICA_ACTIONS = ('list', 'retrieve')
+
+
+def check_connections():
+    """Close connections of this thread idle too long and dropped since."""
+    now = time.monotonic()
+    for connection in connections.all():
+        check_after = connection.settings_dict.get('HEALTH_CHECK_AFTER')
+        if (check_after and connection.connection is not None
+                and not connection.in_atomic_block
+                and now - getattr(connection, 'last_used', 0) >= check_after
+                and not connection.is_usable()):
+            try:
+                connection.close()
+            except Error:
+                pass
+
+
+def mark_connections_used():
+    now = time.monotonic()
+    for connection in connections.all():
+        connection.last_used = now
+
+
+class ConnectionHealthMiddleware(HybridMiddleware):
+    """
+    Ping persistent connections idle for HEALTH_CHECK_AFTER seconds.
+
+    Connections dropped by the server (restarts, idle timeouts) are
+    closed before the request, so it opens a new one instead of failing.
+    Async views query from executor threads, api.concurrency.in_thread
+    checks connections there.
+    """
+
+    def __init__(self, get_response):
+        if not any(database.get('HEALTH_CHECK_AFTER')
+                   and database.get('CONN_MAX_AGE') != 0
+                   for database in settings.DATABASES.values()):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def handle(self, request):
+        check_connections()
+        try:
+            return self.get_response(request)
+        finally:
+            mark_connections_used()
+
+    async def ahandle(self, request):
+        return await self.get_response(request)
+
+
+def primary_reads_key(request):
+    authorization = request.META.get('HTTP_AUTHORIZATION')
+    if not authorization:
+        return None
+    return 'primary_reads:' + hashlib.md5(authorization.encode()).hexdigest()
+
+
+class ReplicaRoutingMiddleware(HybridMiddleware):
+    """
+    Let list and retrieve actions of viewsets read from a replica.
+
+    A client whose token made a write in the last READ_AFTER_WRITE
+    seconds keeps reading from the primary and sees its own changes.
+    """
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_ROUTING['REPLICAS']:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.cache = caches[settings.DATABASE_ROUTING['CACHE_ALIAS']]
+
+    def handle(self, request):
+        token = replica_alias.set(None)
+        try:
+            response = self.get_response(request)
+        finally:
+            replica_alias.reset(token)
+        self.remember_write(request, response)
+        return response
+
+    async def ahandle(self, request):
+        token = replica_alias.set(None)
+        try:
+            response = await self.get_response(request)
+        finally:
+            replica_alias.reset(token)
+        if request.method not in SAFE_METHODS:
+            await sync_to_async(self.remember_write, thread_sensitive=False)(
+                request, response)
+        return response
+
+    def remember_write(self, request, response):
+        key = primary_reads_key(request)
+        if (key and request.method not in SAFE_METHODS
+                and response.status_code < 400):
+            self.cache.set(key, True,
+                           settings.DATABASE_ROUTING['READ_AFTER_WRITE'])
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        actions = getattr(view_func, 'actions', None) or {}
+        if actions.get(request.method.lower()) not in REPLICA_ACTIONS:
+            return None
+        key = primary_reads_key(request)
+        if key and self.cache.get(key):
+            return None
+        replica_alias.set(
+            random.choice(settings.DATABASE_ROUTING['REPLICAS']))
+        return None
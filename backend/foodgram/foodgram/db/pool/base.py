@@ -0,0 +1,125 @@
+"""PostgreSQL backend taking connections from a per-process pool."""
+import threading
+import time
+
+import psycopg2
+from django.db.backends.postgresql import base, creation
+from psycopg2 import extensions
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def is_usable(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except psycopg2.Error:
+        return False
+    return True
+
+
+class ConnectionPool:
+    """
+    Idle connections of one database shared by threads of the process.
+
+    At most 'max_size' connections exist at a time, a thread waits for a
+    free one up to 'timeout' seconds. Connections idle for longer than
+    'check_after' seconds are pinged when taken, broken ones are replaced.
+    """
+
+    def __init__(self, max_size, timeout, check_after):
+        self.timeout = timeout
+        self.check_after = check_after
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def checkout(self, connect):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(
+                'No free connection in the pool after %s s' % self.timeout)
+        try:
+            while True:
+                with self.lock:
+                    released, connection = (
+                        self.idle.pop() if self.idle else (None, None))
+                if connection is None:
+                    return connect()
+                if not connection.closed and (
+                        time.monotonic() - released < self.check_after
+                        or is_usable(connection)):
+                    return connection
+                connection.close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, connection):
+        try:
+            if not connection.closed and (
+                    connection.get_transaction_status()
+                    != extensions.TRANSACTION_STATUS_IDLE):
+                connection.rollback()
+        except psycopg2.Error:
+            connection.close()
+        if not connection.closed:
+            with self.lock:
+                self.idle.append((time.monotonic(), connection))
+        self.slots.release()
+
+    def close_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for _, connection in idle:
+            connection.close()
+
+
+def get_pool(settings_dict):
+    key = tuple(settings_dict[name]
+                for name in ('HOST', 'PORT', 'NAME', 'USER'))
+    with _pools_lock:
+        if key not in _pools:
+            options = settings_dict['POOL']
+            _pools[key] = ConnectionPool(
+                options['MAX_SIZE'], options['TIMEOUT'],
+                settings_dict.get('HEALTH_CHECK_AFTER') or 0,
+            )
+        return _pools[key]
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # idle pooled connections would keep the database from being dropped
+        with _pools_lock:
+            pools = [pool for (_, _, name, _), pool in _pools.items()
+                     if name == test_database_name]
+        for pool in pools:
+            pool.close_idle()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The stock PostgreSQL backend returning closed connections to a pool.
+
+    Configured by the 'POOL' dict of the database settings: 'MAX_SIZE'
+    connections per process and 'TIMEOUT' seconds to wait for one. Keep
+    CONN_MAX_AGE at 0 so that connections go back after every request.
+    """
+
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        connection = get_pool(self.settings_dict).checkout(
+            lambda: super(DatabaseWrapper, self).get_new_connection(
+                conn_params))
+        # connections made by other threads' wrappers
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                get_pool(self.settings_dict).checkin(self.connection)
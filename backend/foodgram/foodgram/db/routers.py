@@ -0,0 +1,51 @@
+"""Routing of viewset reads to read-only replicas."""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# replica chosen for the current request, None sends reads to the primary
+replica_alias = ContextVar('replica_alias', default=None)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Read from the primary in the block.
+
+    Data stored in shared caches must not come from a lagging replica, it
+    would outlive the lag under the new cache generation.
+    """
+    token = replica_alias.set(None)
+    try:
+        yield
+    finally:
+        replica_alias.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Read from the replica the request was given, write to the primary.
+
+    ReplicaRoutingMiddleware gives one to list and retrieve actions only.
+    The first write of a request sends its further reads to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return replica_alias.get()
+
+    def db_for_write(self, model, **hints):
+        replica_alias.set(None)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {'default', *settings.DATABASE_ROUTING['REPLICAS']}
+        if {obj1._state.db, obj2._state.db} <= databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema from the primary
+        if db in settings.DATABASE_ROUTING['REPLICAS']:
+            return False
+        return None
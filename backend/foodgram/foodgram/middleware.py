@@ -0,0 +1,35 @@
+"""Base of middleware serving both WSGI and ASGI deployments."""
+import asyncio
+
+
+class HybridMiddleware:
+    """
+    Middleware with a sync and an async implementation.
+
+    Django runs sync-only middleware under ASGI in a single shared thread,
+    which would serialize every request passing through it. Subclasses
+    implement 'handle' and 'ahandle', the one matching the handler chain
+    is used.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # makes the instance look like a coroutine function to Django,
+            # as django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.ahandle(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def ahandle(self, request):
+        raise NotImplementedError
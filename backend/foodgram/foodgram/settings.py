@@ -30,6 +30,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.profiling.ProfilingMiddleware',
+    'foodgram.db.middleware.ConnectionHealthMiddleware',
+    'foodgram.db.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,6 +62,15 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'foodgram.wsgi.application'
 
+# async views of hot read endpoints, on by default in foodgram.asgi,
+# see api.async_views
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', default='0') == '1'
+
+# DB_POOL_SIZE > 0 keeps PostgreSQL connections in a per-process pool of
+# that size instead of one persistent connection per thread, see
+# foodgram.db.pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', default=0))
+
 DATABASES = {
     'default': {
         'ENGINE': os.getenv('DB_ENGINE', default='django.db.backends.postgresql'),
@@ -67,8 +79,45 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', default='postgres'),
         'HOST': os.getenv('DB_HOST', default='localhost'),
         'PORT': os.getenv('DB_PORT', default='5432'),
+        'CONN_MAX_AGE': int(os.getenv(
+            'DB_CONN_MAX_AGE', default=0 if DB_POOL_SIZE else 60)),
+        # connections idle for longer are pinged before use
+        'HEALTH_CHECK_AFTER': int(os.getenv(
+            'DB_HEALTH_CHECK_AFTER', default=10)),
+        'POOL': {
+            'MAX_SIZE': DB_POOL_SIZE,
+            'TIMEOUT': int(os.getenv('DB_POOL_TIMEOUT', default=10)),
+        },
     },
 }
+if (DB_POOL_SIZE and DATABASES['default']['ENGINE']
+        == 'django.db.backends.postgresql'):
+    DATABASES['default']['ENGINE'] = 'foodgram.db.pool'
+
+# read-only replicas separated by commas: host[:port] of PostgreSQL ones,
+# database files for SQLite; list and retrieve actions read from them,
+# see foodgram.db.routers
+DATABASE_ROUTING = {
+    'REPLICAS': [],
+    'READ_AFTER_WRITE': int(os.getenv('DB_READ_AFTER_WRITE', default=5)),
+    'CACHE_ALIAS': 'default',
+}
+for number, replica in enumerate(
+        filter(None, os.getenv('DB_REPLICAS', default='').split(',')), 1):
+    alias = f'replica{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    if 'sqlite' in DATABASES[alias]['ENGINE']:
+        DATABASES[alias]['NAME'] = replica.strip()
+    else:
+        host, _, port = replica.strip().partition(':')
+        DATABASES[alias]['HOST'] = host
+        DATABASES[alias]['PORT'] = port or DATABASES[alias]['PORT']
+    DATABASE_ROUTING['REPLICAS'].append(alias)
+
+DATABASE_ROUTERS = ['foodgram.db.routers.ReplicaRouter']
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -127,3 +176,142 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'api.paginators.'
                                 'MyPageNumberPagination',
 }
+
+# LIMIT - max number of suggestions returned for ?name= queries,
+# TTL - seconds an in-process copy of ingredients may live without rebuild
+INGREDIENT_AUTOCOMPLETE = {
+    'LIMIT': int(os.getenv('INGREDIENT_AUTOCOMPLETE_LIMIT', default=20)),
+    'TTL': int(os.getenv('INGREDIENT_AUTOCOMPLETE_TTL', default=300)),
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', default=''),
+    },
+}
+
+# LocMemCache is private to a process, caches invalidated by other workers,
+# commands and the job worker have to live in a shared backend
+SHARED_CACHE = not CACHES['default']['BACKEND'].endswith('LocMemCache')
+
+# BACKEND - 'local' keeps tags and ingredients in every worker's memory,
+# 'shared' keeps them in CACHE_ALIAS so invalidation reaches all workers.
+# Local copies miss changes made by other processes, so they live for a
+# minute only
+REFERENCE_CACHE = {
+    'BACKEND': os.getenv('REFERENCE_CACHE_BACKEND',
+                         default='shared' if SHARED_CACHE else 'local'),
+    'CACHE_ALIAS': 'default',
+}
+REFERENCE_CACHE['TIMEOUT'] = int(os.getenv(
+    'REFERENCE_CACHE_TIMEOUT',
+    default=3600 if REFERENCE_CACHE['BACKEND'] == 'shared' else 60))
+
+# scores of recipes for ?ordering=popular|trending, the trending window
+# covers last TRENDING_DAYS days, events are applied SETTLE_SECONDS after
+# they are logged, see the rankrecipes command
+RECIPE_RANKING = {
+    'TRENDING_DAYS': int(os.getenv('RECIPE_TRENDING_DAYS', default=7)),
+    'SETTLE_SECONDS': int(os.getenv('RECIPE_RANKING_SETTLE', default=30)),
+    'WEIGHTS': {
+        'favorite': 2,
+        'shopping_cart': 1,
+    },
+}
+
+# unfiltered lists are counted with PostgreSQL's estimate from
+# ESTIMATE_COUNT_FROM rows, smaller counts are cached for
+# COUNT_CACHE_TIMEOUT seconds, see api.paginators
+PAGINATION = {
+    'ESTIMATE_COUNT_FROM': int(
+        os.getenv('PAGINATION_ESTIMATE_COUNT_FROM', default=100000)),
+    'COUNT_CACHE_TIMEOUT': int(
+        os.getenv('PAGINATION_COUNT_CACHE_TIMEOUT', default=30)),
+}
+
+# resized copies of recipe images made off the request path, VARIANTS maps
+# a variant name to the longest side in pixels, see api.images
+IMAGE_PIPELINE = {
+    'ASYNC': os.getenv('IMAGE_PIPELINE_ASYNC', default='1') == '1',
+    'WORKERS': int(os.getenv('IMAGE_PIPELINE_WORKERS', default=2)),
+    'VARIANTS': {
+        'small': 480,
+    },
+    'WEBP_QUALITY': 80,
+}
+
+RECIPE_MATCHING = {
+    'TTL': int(os.getenv('RECIPE_MATCHING_TTL', default=300)),
+    'MAX_INGREDIENTS': 50,
+    'MAX_MISSING': 3,
+}
+
+# /api/recipes/feed/ of users following MATERIALIZE_FROM authors or more
+# is read from a precomputed table of their MAX_ENTRIES latest recipes,
+# see the buildfeeds command
+FEED = {
+    'MATERIALIZE_FROM': int(os.getenv('FEED_MATERIALIZE_FROM', default=500)),
+    'MAX_ENTRIES': int(os.getenv('FEED_MAX_ENTRIES', default=1000)),
+}
+
+# background jobs, see api.jobs. Without ENABLED image variants and feed
+# fan-out stay in the request process and queued jobs run on commit.
+# Failed jobs are retried after RETRY_DELAY seconds doubled per attempt,
+# running ones are requeued after TIMEOUT, finished ones are deleted after
+# KEEP_FINISHED. SCHEDULE maps tasks to seconds between their runs.
+JOBS = {
+    'ENABLED': os.getenv('JOBS_ENABLED', default='0') == '1',
+    'PROCESSES': int(os.getenv('JOBS_PROCESSES', default=1)),
+    'THREADS': int(os.getenv('JOBS_THREADS', default=2)),
+    'POLL_INTERVAL': 1,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 10,
+    'TIMEOUT': 600,
+    'KEEP_FINISHED': 24 * 60 * 60,
+    'SCHEDULE': {
+        'rank_recipes': int(os.getenv('JOBS_RANK_RECIPES_EVERY',
+                                      default=600)),
+        'build_feeds': int(os.getenv('JOBS_BUILD_FEEDS_EVERY',
+                                     default=3600)),
+    },
+}
+
+# recipes/export/ and recipes/import/, see api.recipe_io
+RECIPE_BULK = {
+    'EXPORT_CHUNK_SIZE': 2000,
+    'IMPORT_BATCH_SIZE': int(os.getenv('RECIPE_IMPORT_BATCH_SIZE',
+                                       default=1000)),
+    'MAX_ERRORS': 100,
+}
+
+# favorites, cart and subscriptions of a user kept for TIMEOUT seconds,
+# see api.user_state; cached by default only in a shared CACHE_BACKEND
+USER_STATE = {
+    'CACHED': os.getenv('USER_STATE_CACHED',
+                        default='1' if SHARED_CACHE else '0') == '1',
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': int(os.getenv('USER_STATE_TIMEOUT', default=60)),
+}
+
+# rendered recipe and user responses, shared by anonymous and authenticated
+# requests and invalidated by generation counters, see api.response_cache;
+# on by default only with a shared CACHE_BACKEND
+RESPONSE_CACHE = {
+    'ENABLED': os.getenv('RESPONSE_CACHE_ENABLED',
+                         default='1' if SHARED_CACHE else '0') == '1',
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': int(os.getenv('RESPONSE_CACHE_TIMEOUT', default=300)),
+}
+
+# request profiling middleware, off unless PROFILING_ENABLED=1
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING_ENABLED', default='0') == '1',
+    'SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', default=0.05)),
+    'SLOW_REQUEST_MS': int(os.getenv('PROFILING_SLOW_REQUEST_MS',
+                                     default=500)),
+    'DUPLICATE_QUERIES': 5,
+    'METRICS_TOKEN': os.getenv('METRICS_TOKEN', default=''),
+}
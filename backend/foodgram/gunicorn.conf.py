@@ -0,0 +1,10 @@
+"""Gunicorn settings, ASGI=1 serves foodgram.asgi with uvicorn workers."""
+import os
+
+asgi = os.getenv('ASGI', default='0') == '1'
+
+wsgi_app = ('foodgram.asgi:application' if asgi
+            else 'foodgram.wsgi:application')
+worker_class = 'uvicorn.workers.UvicornWorker' if asgi else 'sync'
+workers = int(os.getenv('GUNICORN_WORKERS', default=1))
+bind = os.getenv('GUNICORN_BIND', default='0:8000')
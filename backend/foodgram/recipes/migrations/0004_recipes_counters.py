@@ -0,0 +1,38 @@
+# Generated by Django 3.2.16 on 2026-10-18 04:33
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_relations(apps, schema_editor):
+    Recipes = apps.get_model('recipes', 'Recipes')
+    for field, through in (
+        ('favorites_count', Recipes.favorited.through),
+        ('shopping_cart_count', Recipes.shopping_cart.through),
+    ):
+        Recipes.objects.update(**{field: Coalesce(Subquery(
+            through.objects.filter(recipes_id=OuterRef('pk')).order_by()
+            .values('recipes_id').annotate(total=Count('*')).values('total')
+        ), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_remove_recipes_unique recipe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipes',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipes',
+            name='shopping_cart_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В списках покупок'),
+        ),
+        migrations.RunPython(count_relations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.16 on 2026-10-18 04:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_recipes_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankingState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(choices=[('popular', 'За всё время'), ('trending', 'За последние дни')], max_length=20, unique=True)),
+                ('last_event_id', models.BigIntegerField(default=0)),
+                ('cutoff', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecipeRank',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(choices=[('popular', 'За всё время'), ('trending', 'За последние дни')], max_length=20)),
+                ('score', models.IntegerField()),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranks', to='recipes.recipes')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecipeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('favorite', 'Избранное'), ('shopping_cart', 'Список покупок')], max_length=20)),
+                ('delta', models.SmallIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='recipes.recipes')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reciperank',
+            index=models.Index(fields=['window', '-score', 'recipe'], name='recipe_rank_window_score'),
+        ),
+        migrations.AddConstraint(
+            model_name='reciperank',
+            constraint=models.UniqueConstraint(fields=('window', 'recipe'), name='unique_recipe_rank'),
+        ),
+    ]
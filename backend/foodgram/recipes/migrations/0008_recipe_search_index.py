@@ -0,0 +1,91 @@
+from django.db import migrations
+
+# Search index is maintained by the database itself, so rows written with
+# bulk_create, update() or COPY are indexed as well. PostgreSQL keeps a
+# weighted tsvector column (russian stemming) under a GIN index, SQLite
+# gets an external content FTS5 table. Triggers only fire when name or
+# text change, counter updates don't touch the index.
+FORWARD_SQL = {
+    'postgresql': [
+        'ALTER TABLE recipes_recipes '
+        'ADD COLUMN IF NOT EXISTS search_vector tsvector',
+        """
+        CREATE OR REPLACE FUNCTION recipes_recipes_search_update()
+        RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('russian', coalesce(NEW.name, '')),
+                          'A') ||
+                setweight(to_tsvector('russian', coalesce(NEW.text, '')),
+                          'B');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        'CREATE TRIGGER recipes_recipes_search_update '
+        'BEFORE INSERT OR UPDATE OF name, text ON recipes_recipes '
+        'FOR EACH ROW EXECUTE PROCEDURE recipes_recipes_search_update()',
+        # fires the trigger for existing rows
+        'UPDATE recipes_recipes SET name = name',
+        'CREATE INDEX IF NOT EXISTS recipes_recipes_search_vector '
+        'ON recipes_recipes USING gin (search_vector)',
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS recipes_recipes_search "
+        "USING fts5(name, text, content='recipes_recipes', "
+        "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS recipes_recipes_search_insert '
+        'AFTER INSERT ON recipes_recipes BEGIN '
+        'INSERT INTO recipes_recipes_search (rowid, name, text) '
+        'VALUES (new.id, new.name, new.text); END',
+        'CREATE TRIGGER IF NOT EXISTS recipes_recipes_search_delete '
+        'AFTER DELETE ON recipes_recipes BEGIN '
+        'INSERT INTO recipes_recipes_search '
+        '(recipes_recipes_search, rowid, name, text) '
+        "VALUES ('delete', old.id, old.name, old.text); END",
+        'CREATE TRIGGER IF NOT EXISTS recipes_recipes_search_update '
+        'AFTER UPDATE OF name, text ON recipes_recipes BEGIN '
+        'INSERT INTO recipes_recipes_search '
+        '(recipes_recipes_search, rowid, name, text) '
+        "VALUES ('delete', old.id, old.name, old.text); "
+        'INSERT INTO recipes_recipes_search (rowid, name, text) '
+        'VALUES (new.id, new.name, new.text); END',
+        "INSERT INTO recipes_recipes_search (recipes_recipes_search) "
+        "VALUES ('rebuild')",
+    ],
+}
+BACKWARD_SQL = {
+    'postgresql': [
+        'DROP INDEX IF EXISTS recipes_recipes_search_vector',
+        'DROP TRIGGER IF EXISTS recipes_recipes_search_update '
+        'ON recipes_recipes',
+        'DROP FUNCTION IF EXISTS recipes_recipes_search_update()',
+        'ALTER TABLE recipes_recipes DROP COLUMN IF EXISTS search_vector',
+    ],
+    'sqlite': [
+        'DROP TRIGGER IF EXISTS recipes_recipes_search_insert',
+        'DROP TRIGGER IF EXISTS recipes_recipes_search_delete',
+        'DROP TRIGGER IF EXISTS recipes_recipes_search_update',
+        'DROP TABLE IF EXISTS recipes_recipes_search',
+    ],
+}
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_recipe_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(FORWARD_SQL), run_for_vendor(BACKWARD_SQL)
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+# tag filter selects recipes_id by tags_id, the composite index answers it
+# with an index-only scan
+INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS recipes_recipes_tags_tag_recipe '
+    'ON recipes_recipes_tags (tags_id, recipes_id)'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_recipe_search_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            INDEX_SQL,
+            'DROP INDEX IF EXISTS recipes_recipes_tags_tag_recipe',
+        ),
+    ]
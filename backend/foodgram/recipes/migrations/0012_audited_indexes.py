@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+# favorites and shopping carts are filtered by user, the composite index
+# answers them with an index-only scan as 0009 does for tags. Newer
+# recipes come first, so sorting the page newest first keeps the first
+# rows instead of replacing them on every row.
+INDEX_SQL = [
+    ('CREATE INDEX IF NOT EXISTS recipes_recipes_favorited_user_recipe '
+     'ON recipes_recipes_favorited (customuser_id, recipes_id DESC)',
+     'DROP INDEX IF EXISTS recipes_recipes_favorited_user_recipe'),
+    ('CREATE INDEX IF NOT EXISTS recipes_recipes_shopping_cart_user_recipe '
+     'ON recipes_recipes_shopping_cart (customuser_id, recipes_id DESC)',
+     'DROP INDEX IF EXISTS recipes_recipes_shopping_cart_user_recipe'),
+]
+# recipe_author_pub_date_id of 0010 covers lookups by author. Altering
+# the field would remake recipes_recipes on SQLite and lose the search
+# triggers of 0008, so the index Django named for the foreign key is
+# dropped by its name.
+AUTHOR_INDEX_SQL = (
+    'DROP INDEX IF EXISTS recipes_recipes_author_id_ce70baba',
+    'CREATE INDEX IF NOT EXISTS recipes_recipes_author_id_ce70baba '
+    'ON recipes_recipes (author_id)',
+)
+
+
+def merge_repeated_ingredients(apps, schema_editor):
+    """Sum amounts of an ingredient given several times into one row."""
+    RecipeIngredients = apps.get_model('recipes', 'RecipeIngredients')
+    repeated = RecipeIngredients.objects.order_by().values(
+        'recipe_id', 'ingredient_id').annotate(
+        rows=Count('id'), first=Min('id'), total=Sum('amount')).filter(
+        rows__gt=1)
+    for row in repeated:
+        RecipeIngredients.objects.filter(pk=row['first']).update(
+            amount=row['total'])
+        RecipeIngredients.objects.filter(
+            recipe_id=row['recipe_id'], ingredient_id=row['ingredient_id']
+        ).exclude(pk=row['first']).delete()
+
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0011_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='recipeingredients',
+            options={'ordering': ['id']},
+        ),
+        migrations.RunPython(
+            merge_repeated_ingredients, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='recipeingredients',
+            constraint=models.UniqueConstraint(
+                fields=('recipe', 'ingredient'),
+                name='unique_recipe_ingredient'),
+        ),
+        migrations.AlterField(
+            model_name='recipeingredients',
+            name='recipe',
+            field=models.ForeignKey(
+                db_index=False, on_delete=models.deletion.CASCADE,
+                to='recipes.recipes'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='recipes',
+                    name='author',
+                    field=models.ForeignKey(
+                        db_index=False, on_delete=models.deletion.CASCADE,
+                        related_name='recipes', to=settings.AUTH_USER_MODEL,
+                        verbose_name='Author'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(*AUTHOR_INDEX_SQL),
+            ],
+        ),
+        *(migrations.RunSQL(forward, backward)
+          for forward, backward in INDEX_SQL),
+    ]
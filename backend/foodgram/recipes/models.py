@@ -1,6 +1,13 @@
+import re
+
 from django.contrib.auth import get_user_model
+from django.core.exceptions import EmptyResultSet
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connections, models
+from django.db.models import F, Prefetch, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -28,15 +35,94 @@ class Tags(models.Model):
         return self.name
 
 
+class RecipesQuerySet(models.QuerySet):
+    """Query shapes used by the recipes API."""
+
+    def with_related(self):
+        """Fetch author, tags and ingredients in a fixed number of queries."""
+        return self.select_related('author').prefetch_related(
+            Prefetch('tags', queryset=Tags.objects.all()),
+            Prefetch(
+                'recipeingredients_set',
+                queryset=RecipeIngredients.objects.select_related(
+                    'ingredient'),
+            ),
+        )
+
+    def search(self, query):
+        """
+        Filter recipes matching a full-text query, best matches first.
+
+        Uses the index kept up to date by triggers (see migration 0008):
+        the stemmed search_vector column on PostgreSQL and the FTS5 table
+        with prefix matching on SQLite. Name matches weigh more than text.
+        """
+        if connections[self.db].vendor == 'postgresql':
+            tsquery = "websearch_to_tsquery('russian', %s)"
+            match = RawSQL(
+                f'recipes_recipes.search_vector @@ {tsquery}', (query,),
+                output_field=models.BooleanField())
+            rank = RawSQL(
+                f'ts_rank(recipes_recipes.search_vector, {tsquery})',
+                (query,), output_field=models.FloatField())
+        else:
+            words = re.findall(r'\w+', query.lower())
+            if not words:
+                return self.none()
+            query = ' '.join(f'"{word}"*' for word in words)
+            match = RawSQL(
+                'recipes_recipes.id IN (SELECT rowid FROM '
+                'recipes_recipes_search WHERE recipes_recipes_search '
+                'MATCH %s)', (query,), output_field=models.BooleanField())
+            # bm25() is lower for better matches
+            rank = RawSQL(
+                '(SELECT -bm25(recipes_recipes_search, 2.5, 1.0) FROM '
+                'recipes_recipes_search WHERE recipes_recipes_search '
+                'MATCH %s AND rowid = recipes_recipes.id)', (query,),
+                output_field=models.FloatField())
+        return self.filter(match).annotate(search_rank=rank).order_by(
+            '-search_rank', '-pub_date', '-id')
+
+    def latest_per_author(self, limit):
+        """
+        Return at most limit latest recipes of each author in one query.
+
+        Recipes are ranked with ROW_NUMBER() partitioned by author, the rank
+        is filtered in an outer query as Django can't filter on windows.
+        """
+        ranked = self.annotate(
+            recipe_rank=Window(
+                expression=RowNumber(),
+                partition_by=[F('author_id')],
+                order_by=[F('pub_date').desc(), F('id').desc()],
+            )
+        ).order_by().values('id', 'author_id', 'name', 'image',
+                            'image_variants', 'cooking_time', 'pub_date',
+                            'recipe_rank')
+        try:
+            sql, params = ranked.query.sql_with_params()
+        except EmptyResultSet:
+            return []
+        return self.model.objects.raw(
+            f'SELECT * FROM ({sql}) ranked WHERE recipe_rank <= %s '
+            'ORDER BY author_id, recipe_rank',
+            (*params, limit),
+        )
+
+
 class Recipes(models.Model):
     tags = models.ManyToManyField(Tags, related_name='recipes')
     text = models.TextField('Text')
     pub_date = models.DateTimeField('Publication date', auto_now_add=True)
+    # recipe_author_pub_date_id serves lookups by author
     author = models.ForeignKey(
-        User,
+        User, db_index=False,
         on_delete=models.CASCADE, verbose_name='Author', related_name='recipes'
     )
     image = models.ImageField(upload_to='recipes/')
+    # variant name -> storage name, filled in by api.images
+    image_variants = models.JSONField(default=dict, blank=True,
+                                      editable=False)
     ingredients = models.ManyToManyField(
         Ingredients,
         verbose_name='Ingredients',
@@ -47,6 +133,11 @@ class Recipes(models.Model):
     shopping_cart = models.ManyToManyField(User, related_name='shopping',
                                            blank=True)
     name = models.CharField('Name', max_length=200)
+    # maintained by api.signals, repaired by the recount command
+    favorites_count = models.PositiveIntegerField(
+        'В избранном', default=0, editable=False)
+    shopping_cart_count = models.PositiveIntegerField(
+        'В списках покупок', default=0, editable=False)
     cooking_time = models.IntegerField(
         verbose_name='Время приготовления',
         validators=[
@@ -67,22 +158,180 @@ class Recipes(models.Model):
         ],
     )
 
+    objects = RecipesQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Recipe'
         verbose_name_plural = 'Recipes'
         ordering = ['-pub_date']
+        indexes = [
+            # keyset pagination and the default ordering
+            models.Index(fields=('-pub_date', '-id'),
+                         name='recipe_pub_date_id'),
+            # recipes of given authors newest first: the feed, ?author=
+            models.Index(fields=('author', '-pub_date', '-id'),
+                         name='recipe_author_pub_date_id'),
+        ]
 
     def __str__(self):
         return self.text
 
 
 class RecipeIngredients(models.Model):
-    recipe = models.ForeignKey(Recipes, on_delete=models.CASCADE)
+    # unique_recipe_ingredient serves lookups by recipe
+    recipe = models.ForeignKey(Recipes, on_delete=models.CASCADE,
+                               db_index=False)
     ingredient = models.ForeignKey(Ingredients, on_delete=models.CASCADE)
     amount = models.IntegerField()
 
     class Meta:
-        ordering = ['recipe__pub_date']
+        # the order ingredients were given in, without joining recipes
+        ordering = ['id']
+        constraints = [
+            models.UniqueConstraint(fields=('recipe', 'ingredient'),
+                                    name='unique_recipe_ingredient'),
+        ]
 
     def __str__(self):
         return f'{self.recipe} {self.ingredient}'
+
+
+class RecipeEvent(models.Model):
+    """Log of favorite and shopping cart changes feeding the rankings."""
+
+    FAVORITE = 'favorite'
+    SHOPPING_CART = 'shopping_cart'
+    KINDS = (
+        (FAVORITE, 'Избранное'),
+        (SHOPPING_CART, 'Список покупок'),
+    )
+
+    recipe = models.ForeignKey(Recipes, on_delete=models.CASCADE,
+                               related_name='events')
+    kind = models.CharField(max_length=20, choices=KINDS)
+    delta = models.SmallIntegerField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.recipe_id} {self.kind} {self.delta:+}'
+
+
+class RecipeRank(models.Model):
+    """Materialized recipe scores, rebuilt by the rankrecipes command."""
+
+    POPULAR = 'popular'
+    TRENDING = 'trending'
+    WINDOWS = (
+        (POPULAR, 'За всё время'),
+        (TRENDING, 'За последние дни'),
+    )
+
+    recipe = models.ForeignKey(Recipes, on_delete=models.CASCADE,
+                               related_name='ranks')
+    window = models.CharField(max_length=20, choices=WINDOWS)
+    score = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('window', 'recipe'),
+                                    name='unique_recipe_rank'),
+        ]
+        indexes = [
+            models.Index(fields=('window', '-score', 'recipe'),
+                         name='recipe_rank_window_score'),
+        ]
+
+    def __str__(self):
+        return f'{self.window} {self.recipe_id} {self.score}'
+
+
+class RankingState(models.Model):
+    """Position of the last incremental refresh for a ranking window."""
+
+    window = models.CharField(max_length=20, unique=True,
+                              choices=RecipeRank.WINDOWS)
+    last_event_id = models.BigIntegerField(default=0)
+    cutoff = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f'{self.window} {self.last_event_id}'
+
+
+class UserFeed(models.Model):
+    """User whose following feed is precomputed into FeedEntry rows."""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+                                primary_key=True, related_name='feed')
+    built = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user_id} {self.built}'
+
+
+class FeedEntry(models.Model):
+    """Recipe of a followed author in a precomputed feed."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='feed_entries')
+    recipe = models.ForeignKey(Recipes, on_delete=models.CASCADE,
+                               related_name='+')
+    # copies of recipe fields to unfollow and page without a join
+    author = models.ForeignKey(User, on_delete=models.CASCADE,
+                               related_name='+')
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('user', 'recipe'),
+                                    name='unique_feed_entry'),
+        ]
+        indexes = [
+            models.Index(fields=('user', '-pub_date', '-recipe'),
+                         name='feed_entry_user_pub_date'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.recipe_id}'
+
+
+class Job(models.Model):
+    """Deferred work run by the runworker command, see api.jobs."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнено'),
+        (FAILED, 'Ошибка'),
+    )
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True,
+                             blank=True, related_name='jobs')
+    status = models.CharField(max_length=20, choices=STATUSES,
+                              default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=1)
+    run_at = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # workers only ever look for due queued jobs
+            models.Index(fields=('run_at', 'id'),
+                         condition=models.Q(status='queued'),
+                         name='job_queued_run_at'),
+            models.Index(fields=('status', 'finished'),
+                         name='job_status_finished'),
+        ]
+
+    def __str__(self):
+        return f'{self.pk} {self.name} {self.status}'
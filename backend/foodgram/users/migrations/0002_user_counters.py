@@ -0,0 +1,41 @@
+# Generated by Django 3.2.16 on 2026-10-18 04:33
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_relations(apps, schema_editor):
+    CustomUser = apps.get_model('users', 'CustomUser')
+    Recipes = apps.get_model('recipes', 'Recipes')
+    for field, source, column in (
+        ('followers_count', CustomUser.subscribed.through,
+         'from_customuser_id'),
+        ('recipes_count', Recipes, 'author_id'),
+    ):
+        CustomUser.objects.update(**{field: Coalesce(Subquery(
+            source.objects.filter(**{column: OuterRef('pk')}).order_by()
+            .values(column).annotate(total=Count('*')).values('total')
+        ), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+        ('recipes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Followers'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Recipes'),
+        ),
+        migrations.RunPython(count_relations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+# followers of an author are looked up by to_customuser_id for feeds and
+# subscriptions, the composite index answers it with an index-only scan
+INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS users_customuser_subscribed_to_from '
+    'ON users_customuser_subscribed (to_customuser_id, from_customuser_id)'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_counters'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            INDEX_SQL,
+            'DROP INDEX IF EXISTS users_customuser_subscribed_to_from',
+        ),
+    ]
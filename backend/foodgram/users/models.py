@@ -26,6 +26,12 @@ class CustomUser(AbstractUser):
     subscribed = models.ManyToManyField('self', default=None,
                                         symmetrical=False)
 
+    # maintained by api.signals, repaired by the recount command
+    recipes_count = models.PositiveIntegerField(
+        verbose_name="Recipes", default=0, editable=False)
+    followers_count = models.PositiveIntegerField(
+        verbose_name="Followers", default=0, editable=False)
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
 